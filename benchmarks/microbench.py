@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the header parsing, the policy client, the relay
+transports and the startup of the proxy.
+
+Each benchmark reports the best time per call over several rounds. Results
+can be saved as JSON, named after the current git commit, and compared
+against an earlier run:
+
+    python -m benchmarks.microbench --save .benchmarks
+    python -m benchmarks.microbench --compare .benchmarks/<commit>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from aiosmtpd.lmtp import LMTP
+from aiosmtpd.smtp import SMTP
+
+from greylistfilter.controller import ServerController
+from greylistfilter.postgrey_client import greylist_status
+from greylistfilter.relay import RelayPool
+from greylistfilter.smtpproxy import OK_REPLY, PostfixProxyHandler, byte_lines, parse_dcc
+
+ENTRY_POINT = os.path.join(os.path.dirname(__file__), os.pardir, 'greylist_proxy_filter.py')
+STARTUP_ARGS = ('--check-config', '--relay', '127.0.0.1:10026')
+
+TESTMAIL = os.path.join(os.path.dirname(__file__), os.pardir, 'greylistfilter', 'tests', 'data', 'testmail.eml')
+
+STATUS_HEADER = (b'X-Spam-Status: No, score=1.1 required=5.0 tests=BAYES_00,FREEMAIL_FROM,\r\n'
+                 b'\tKAM_LAZY_DOMAIN_SECURITY autolearn=no autolearn_force=no version=3.4.1\r\n')
+DCC_HEADER = b'X-Spam-DCC: URT:bloggs 1060; Body=1 Fuz1=2 Fuz2=many\r\n'
+RECEIVED_HEADER = (b'Received: from mail.example.com (mail.example.com [192.0.2.1])\r\n'
+                   b'\tby mx.example.org (Postfix) with ESMTP id 4A1B2C3D4E\r\n'
+                   b'\tfor <user@example.org>; Wed, 24 Oct 2018 13:20:28 +0200 (CEST)\r\n')
+BODY = b'\r\nThis is the body of the message.\r\n' * 100
+
+
+def header_fixtures():
+    """
+    Message fixtures, from the ordinary to the pathological
+    """
+    with open(TESTMAIL, 'rb') as input:
+        testmail = input.read()
+
+    return {
+        'testmail': testmail,
+        # the status headers come after a long trace, as after many relays
+        'huge_headers': RECEIVED_HEADER * 2000 + STATUS_HEADER + DCC_HEADER + BODY,
+        # a DCC header with a long run of folded continuation lines
+        'folded_dcc': (STATUS_HEADER + b'X-Spam-DCC: URT:bloggs 1060;\r\n' +
+                       b'\tcontinued=1234567890\r\n' * 500 + b'\tBody=1 Fuz1=2 Fuz2=many\r\n' + BODY),
+        'non_utf8': (b'Subject: \xe4\xf6\xfc \xff\xfe\r\n' * 200 + STATUS_HEADER +
+                     b'X-Spam-DCC: URT:\xe9\xe8 1060; Body=3\r\n' + BODY),
+        # no blank line, so there is no end of headers to be found
+        'no_separator': (b'X-Junk: ' + b'x' * 70 + b'\r\n') * 20000,
+    }
+
+
+def dcc_fixtures():
+    """
+    Single X-Spam-DCC header values
+    """
+    return {
+        'dcc_plain': DCC_HEADER[11:],
+        'dcc_long_tokens': b' URT:bloggs 1060; ' + b'Body=1 ' * 1000,
+        # whitespace runs made the old regular expression backtrack heavily
+        'dcc_whitespace': b' ' * 10000 + b'x',
+    }
+
+
+def best_time(func, number, repeat):
+    return min(timeit.Timer(func).repeat(repeat, number)) / number
+
+
+async def handle_policy_request(reader, writer):
+    while True:
+        line = await reader.readline()
+        if not line or line == b'\n':
+            break
+
+    writer.write(b'action=DUNNO\n\n')
+    await writer.drain()
+    writer.close()
+
+
+async def time_greylist_status(queries, concurrency, path=None):
+    """
+    Time policy queries over TCP, or over the Unix socket at `path`
+    """
+    if path:
+        server = await asyncio.start_unix_server(handle_policy_request, path)
+        host, port = 'unix:%s' % path, None
+    else:
+        server = await asyncio.start_server(handle_policy_request, host='127.0.0.1', port=0)
+        host, port = '127.0.0.1', server.sockets[0].getsockname()[1]
+
+    async def worker(count):
+        for _ in range(count):
+            await greylist_status('a@test.com', 'b@test.com', '192.0.2.1', 'mail.example.com', host, port)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(queries // concurrency) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    server.close()
+    await server.wait_closed()
+
+    return elapsed / queries
+
+
+class RelayHandler:
+    async def handle_DATA(self, server, session, envelope):
+        return OK_REPLY
+
+
+class RelayServer:
+    """
+    An SMTP or LMTP server taking every message, on a Unix socket or a TCP
+    port, to be run by a ServerController
+    """
+
+    def __init__(self, protocol, path=None):
+        self.protocol = protocol
+        self.path = path
+        self.port = None
+        self._server = None
+
+    async def start(self, hostname, port):
+        loop = asyncio.get_event_loop()
+        if self.path:
+            self._server = await loop.create_unix_server(lambda: self.protocol(RelayHandler()), self.path)
+        else:
+            self._server = await loop.create_server(lambda: self.protocol(RelayHandler()), hostname, port)
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+def relay_transports(directory):
+    """
+    The relay servers to compare, by name, with the name to relay to each
+    """
+    return {
+        'smtp': (RelayServer(SMTP), '127.0.0.1:%d'),
+        'smtp-unix': (RelayServer(SMTP, os.path.join(directory, 'smtp.sock')), 'unix:%s'),
+        'lmtp': (RelayServer(LMTP), 'lmtp:127.0.0.1:%d'),
+        'lmtp-unix': (RelayServer(LMTP, os.path.join(directory, 'lmtp.sock')), 'lmtp:unix:%s'),
+    }
+
+
+def time_relay(server, relay, messages, pool=None):
+    """
+    Time relaying messages one at a time as the proxy does, a connection
+    each unless through a RelayPool
+    """
+    controller = ServerController(server)
+    controller.start()
+    try:
+        handler = PostfixProxyHandler(relay % (server.path or server.port), 1.0, 2, relay_pool=pool)
+        data = header_fixtures()['testmail']
+
+        start = time.perf_counter()
+        for _ in range(messages):
+            handler.send_to_relay('b@test.com', ['a@test.com'], data)
+        return (time.perf_counter() - start) / messages
+    finally:
+        if pool is not None:
+            pool.close()
+        controller.stop()
+
+
+def time_startup(args=STARTUP_ARGS, repeat=5):
+    """
+    Best time to start the proxy in a new interpreter and have it exit
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, ENTRY_POINT] + list(args), check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def imported_modules(args=STARTUP_ARGS):
+    """
+    The modules imported by the proxy starting with `args`, from the
+    output of `python -X importtime`
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', ENTRY_POINT] + list(args), check=True,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = set()
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            modules.add(line.rsplit('|', 1)[1].strip())
+    return modules
+
+
+def run(number=20, repeat=5, queries=500, messages=100):
+    handler = PostfixProxyHandler(None, 1.0, 2)
+    results = {}
+
+    for name, data in sorted(header_fixtures().items()):
+        results['byte_lines/%s' % name] = best_time(lambda: sum(1 for _ in byte_lines(data)), number, repeat)
+        results['get_spam_status/%s' % name] = best_time(lambda: handler.get_spam_status(data), number, repeat)
+
+    for name, line in sorted(dcc_fixtures().items()):
+        results['parse_dcc/%s' % name] = best_time(lambda: parse_dcc(line), number, repeat)
+
+    with tempfile.TemporaryDirectory() as directory:
+        loop = asyncio.new_event_loop()
+        try:
+            for concurrency in (1, 10):
+                results['greylist_status/concurrency=%d' % concurrency] = loop.run_until_complete(
+                    time_greylist_status(queries, concurrency))
+                results['greylist_status/unix/concurrency=%d' % concurrency] = loop.run_until_complete(
+                    time_greylist_status(queries, concurrency, os.path.join(directory, 'postgrey.sock')))
+        finally:
+            loop.close()
+
+        for name, (server, relay) in sorted(relay_transports(directory).items()):
+            results['relay/%s' % name] = time_relay(server, relay, messages)
+        results['relay/smtp-pooled'] = time_relay(RelayServer(SMTP), '127.0.0.1:%d', messages, RelayPool())
+
+    results['startup/check-config'] = time_startup(repeat=repeat)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save(directory, results):
+    os.makedirs(directory, exist_ok=True)
+    commit = git_commit()
+    path = os.path.join(directory, '%s.json' % commit)
+    with open(path, 'w') as output:
+        json.dump({
+            'commit': commit,
+            'python': platform.python_version(),
+            'timestamp': time.time(),
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+    return path
+
+
+def report(results, baseline=None):
+    for name, seconds in sorted(results.items()):
+        line = '%-45s %12.2f us' % (name, seconds * 1e6)
+        if baseline and name in baseline:
+            line += '  %6.2fx' % (seconds / baseline[name])
+        print(line)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Header parsing and policy client micro-benchmarks.')
+    parser.add_argument('-n', '--number', type=int, default=20,
+                        help='Calls per timing round. Default: %(default)s')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Timing rounds, the best is reported. Default: %(default)s')
+    parser.add_argument('-q', '--queries', type=int, default=500,
+                        help='Policy queries per client benchmark. Default: %(default)s')
+    parser.add_argument('-m', '--messages', type=int, default=100,
+                        help='Messages per relay transport benchmark. Default: %(default)s')
+    parser.add_argument('--save', metavar='DIR', help='Save the results to DIR/<commit>.json')
+    parser.add_argument('--compare', metavar='FILE', help='Show the results relative to an earlier saved run')
+
+    args = parser.parse_args()
+
+    results = run(args.number, args.repeat, args.queries, args.messages)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as input:
+            baseline = json.load(input)['results']
+
+    report(results, baseline)
+
+    if args.save:
+        print('Saved results to %s' % save(args.save, results))
@@ -2,15 +2,25 @@
 
 import argparse
 import logging
+import os
+import sys
 
-from logging.handlers import SysLogHandler
+from greylistfilter.config import (SETTINGS, ConfigError, load_config, parse_count, parse_dcc_threshold,
+                                   parse_positive, parse_relay)
+from greylistfilter.defaults import DEFAULT_TIMEOUT, MAX_HEADER_BYTES, MAX_LINE_LENGTH
+from greylistfilter.ratelimit import ACTIONS
 
-from greylistfilter.smtpproxy import PostfixProxyController, PostfixProxyHandler
+# The servers, and the optional subsystems, are only imported once they are
+# needed, so that checking the command line and configuration is quick
 
 logger = logging.getLogger('SpamFilterProxy')
 
+SERVER_NAMES = {'proxy': 'SMTP', 'policy': 'Policy', 'milter': 'Milter'}
+
 
 def configure_logging(level=None, config_file=None):
+    from logging.handlers import SysLogHandler
+
     level = getattr(logging, level, logging.INFO)
     logger.setLevel(level)
     syslog_handler = SysLogHandler(address='/dev/log', facility=SysLogHandler.LOG_MAIL)
@@ -20,39 +30,159 @@ def configure_logging(level=None, config_file=None):
     logger.addHandler(syslog_handler)
 
 
-def main(host, port, relay, spam, dcc, pghost, pgport):
-    handler = PostfixProxyHandler(relay, spam, dcc, pghost, pgport)
-    controller = PostfixProxyController(handler, hostname=host, port=port)
+def main(host, port, relay, spam, dcc, pghost, pgport, early_lookup, defer_ttl,
+         state_file=None, state_interval=60,
+         max_header_bytes=MAX_HEADER_BYTES, max_line_length=MAX_LINE_LENGTH,
+         pgtimeout=DEFAULT_TIMEOUT, mode='proxy', shared_cache=None, adaptive=None,
+         config_file=None, control_socket=None, rate_limit=None, spool_dir=None, spool_retry=30, whitelist=None,
+         lanes=None, relay_pool=None, spool_max_age=5 * 86400, fixed=()):
+    import asyncio
+
+    # Every mode scores and looks up through the proxy's handler, so aiosmtpd and the relay client are
+    # always imported; the policy and milter servers only in their own mode
+    from greylistfilter.smtpproxy import PostfixProxyHandler
+
+    spool = None
+    if spool_dir:
+        from greylistfilter.spool import Spool
+        spool = Spool(spool_dir, retry_delay=spool_retry, max_age=spool_max_age)
+    handler = PostfixProxyHandler(relay, spam, dcc, pghost, pgport, early_lookup, defer_ttl,
+                                  max_header_bytes, max_line_length, pgtimeout, shared_cache, adaptive, rate_limit,
+                                  spool, whitelist, lanes, relay_pool)
+    if state_file:
+        from greylistfilter.snapshot import restore_state, save_snapshot, snapshot_periodically
+        restore_state(state_file, handler.verdicts)
+
+    if mode == 'policy':
+        from greylistfilter.controller import ServerController
+        from greylistfilter.policyserver import PolicyServer
+        controller = ServerController(PolicyServer(handler), hostname=host, port=port)
+    elif mode == 'milter':
+        from greylistfilter.controller import ServerController
+        from greylistfilter.milter import MilterServer
+        controller = ServerController(MilterServer(handler), hostname=host, port=port)
+    else:
+        from greylistfilter.smtpproxy import PostfixProxyController
+        controller = PostfixProxyController(handler, hostname=host, port=port)
     # Run the event loop in a separate thread.
     controller.start()
+
+    if state_file:
+        from concurrent.futures import ThreadPoolExecutor
+        snapshot_writer = ThreadPoolExecutor(1, thread_name_prefix='snapshot')
+        snapshots = asyncio.run_coroutine_threadsafe(
+            snapshot_periodically(state_file, handler.verdicts, state_interval, snapshot_writer), controller.loop)
+
+    if spool:
+        redelivery = asyncio.run_coroutine_threadsafe(spool.run(handler.redeliver), controller.loop)
+
+    if config_file:
+        import signal
+
+        from greylistfilter.config import reload_config
+
+        def reload():
+            try:
+                reload_config(config_file, handler, fixed)
+            except ConfigError as ex:
+                logger.error('Configuration not reloaded: %s', ex)
+
+        # The settings are applied on the event loop's thread, between sessions' steps
+        signal.signal(signal.SIGHUP, lambda signum, frame: controller.loop.call_soon_threadsafe(reload))
+
+    control = None
+    if control_socket:
+        from greylistfilter.control import ControlServer
+        control = ControlServer(handler, config_file, fixed)
+        asyncio.run_coroutine_threadsafe(control.start(control_socket), controller.loop).result()
+
     # Wait for the user to press Return.
-    input('SMTP server running. Press Return to stop server and exit.')
+    input('%s server running. Press Return to stop server and exit.' % SERVER_NAMES[mode])
+
+    if state_file:
+        snapshots.cancel()
+    if control:
+        asyncio.run_coroutine_threadsafe(control.stop(), controller.loop).result()
+    if spool:
+        redelivery.cancel()
     controller.stop()
+    handler.lanes.close()
+    if relay_pool is not None:
+        relay_pool.close()
+    if spool:
+        spool.close()
+
+    if state_file:
+        # With the loop stopped no periodic save can start; let one in progress finish before the final one
+        snapshot_writer.shutdown()
+        save_snapshot(state_file, handler.verdicts.export())
 
 
 def check_dcc_type(value):
-    if value == 'many':
-        val = 999999
-    else:
-        try:
-            val = int(value)
-        except ValueError:
-            raise argparse.ArgumentTypeError('value must be either an integer or "many": %s' % value)
+    try:
+        return parse_dcc_threshold(value)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
 
-    if val < 2:
-        raise argparse.ArgumentTypeError('value must be greater than 1: %s' % val)
 
-    return val
+def check_relay_type(value):
+    try:
+        return parse_relay(value)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
 
 
-def check_relay_type(value):
-    if value == 'None':
-        return None
-    return value
+def check_count_type(value):
+    try:
+        return parse_count(value)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+def check_positive_type(value):
+    try:
+        return parse_positive(value)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+def check_path(path, directory=False):
+    """
+    Return why the file or directory at `path` couldn't be written, or None.
+    Its directory has to be writable as well, for the files created or
+    replaced there; a missing directory is created along with the spool.
+    """
+    if os.path.exists(path):
+        if os.path.isdir(path) != directory:
+            return '%s is %s' % (path, 'not a directory' if directory else 'a directory')
+        if not os.access(path, os.R_OK | os.W_OK | (os.X_OK if directory else 0)):
+            return 'no permission to write to %s' % path
+        if directory:
+            return None
+
+    parent = os.path.dirname(os.path.abspath(path))
+    while directory and not os.path.exists(parent):
+        parent = os.path.dirname(parent)
+    if not os.path.isdir(parent):
+        return 'directory %s does not exist' % parent
+    if not os.access(parent, os.W_OK | os.X_OK):
+        return 'no permission to write to directory %s' % parent
+    return None
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Spam-filtering SMTP proxy server.')
+    parser.add_argument('-c', '--config',
+                        help='Configuration file, re-read on SIGHUP. Options given on the command line take '
+                             'precedence at startup.')
+    parser.add_argument('--control-socket', help='Unix socket on which to accept the status and reload commands')
+    parser.add_argument('--check-config', action='store_true',
+                        help='Check the command line, the configuration file, the files they name and that the '
+                             'spool, state, shared cache and control socket paths can be written, then exit '
+                             'without starting the server')
+    parser.add_argument('-m', '--mode', choices=sorted(SERVER_NAMES), default='proxy',
+                        help='Run as a before-queue SMTP proxy, as a policy service for '
+                             'smtpd_end_of_data_restrictions, or as a milter. Default: %(default)s')
     parser.add_argument('-l', '--loglevel', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
                         default='INFO', help='Logging level. Default: %(default)s')
     parser.add_argument('-a', '--address', default='127.0.0.1',
@@ -64,14 +194,187 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--spam', default=1.0, type=float,
                         help='Minimum required SpamAssassin score. Default: %(default)s')
 
-    parser.add_argument('-r', '--relay', type=check_relay_type, required=True, help='Relay SMTP server')
-    parser.add_argument('--pghost', default='127.0.0.1', help='Postgrey server host. Default: %(default)s')
-    parser.add_argument('--pgport', type=int, default=10023, help='Postgrey server port. Default: %(default)s')
+    parser.add_argument('-r', '--relay', type=check_relay_type, default=argparse.SUPPRESS,
+                        help='Relay server as host:port, unix:/path, lmtp:host:port or lmtp:unix:/path, '
+                             'required in proxy mode')
+    parser.add_argument('--pghost', default='127.0.0.1',
+                        help='Postgrey server host, or unix:/path for its Unix socket. Default: %(default)s')
+    parser.add_argument('--pgport', type=check_positive_type, default=10023,
+                        help='Postgrey server port. Default: %(default)s')
+    parser.add_argument('--pgtimeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Seconds to wait for a Postgrey reply. Default: %(default)s')
+    parser.add_argument('--early-lookup', action='store_true',
+                        help='Query Postgrey at RCPT TO time, in parallel with receiving the message. '
+                             'Postgrey will then see all triplets, not only those meeting the conditions.')
+    parser.add_argument('--defer-ttl', type=check_count_type, default=0,
+                        help='Seconds to cache greylisting deferrals locally, should be below the Postgrey '
+                             'delay. Default: %(default)s')
+    parser.add_argument('--shared-cache', metavar='PATH',
+                        help='Keep the deferral cache in this memory-mapped file, shared by all processes '
+                             'using the same file, e.g. under /dev/shm')
+    parser.add_argument('--max-header-bytes', type=check_positive_type, default=MAX_HEADER_BYTES,
+                        help='Maximum bytes of headers scanned per message. Default: %(default)s')
+    parser.add_argument('--max-line-length', type=check_positive_type, default=MAX_LINE_LENGTH,
+                        help='Header lines longer than this are not parsed. Default: %(default)s')
+    parser.add_argument('--state-file', help='File in which to keep a snapshot of the in-memory state across restarts')
+    parser.add_argument('--spool-dir',
+                        help='Directory in which to keep messages the relay temporarily refuses, accepting them '
+                             'for redelivery rather than having Postfix send them again')
+    parser.add_argument('--spool-retry', type=int, default=30,
+                        help='Seconds before the first redelivery attempt, doubled on each failure. '
+                             'Default: %(default)s')
+    parser.add_argument('--spool-max-age', type=int, default=5 * 86400,
+                        help='Seconds after which a spooled message still not delivered is set aside in the '
+                             'spool\'s failed directory, as Postfix\'s maximal_queue_lifetime. Default: %(default)s')
+    parser.add_argument('--state-interval', type=int, default=60,
+                        help='Seconds between state snapshots. Default: %(default)s')
+
+    whitelist_group = parser.add_argument_group(
+        'whitelists', 'Never look up whitelisted mail in Postgrey. Each option may be given several times, the '
+                      'files are reloaded when they change.')
+    whitelist_group.add_argument('--whitelist-clients', action='append', default=[], metavar='FILE',
+                                 help='Postgrey whitelist_clients file')
+    whitelist_group.add_argument('--whitelist-recipients', action='append', default=[], metavar='FILE',
+                                 help='Postgrey whitelist_recipients file')
+    whitelist_group.add_argument('--whitelist-ips', action='append', default=[], metavar='FILE',
+                                 help='rbldnsd style list of IP addresses and networks')
+
+    adaptive_group = parser.add_argument_group(
+        'adaptive thresholds', 'Move the thresholds with the load on Postgrey, enabled by --spam-max or --dcc-max')
+    adaptive_group.add_argument('--spam-max', type=float, help='Highest SpamAssassin threshold under load')
+    adaptive_group.add_argument('--dcc-max', type=check_dcc_type, help='Highest DCC threshold under load')
+    adaptive_group.add_argument('--spam-min', type=float,
+                                help='Lowest SpamAssassin threshold when idle. Default: --spam')
+    adaptive_group.add_argument('--dcc-min', type=check_dcc_type, help='Lowest DCC threshold when idle. Default: --dcc')
+    adaptive_group.add_argument('--latency-target', type=float, default=0.5,
+                                help='Postgrey latency in seconds above which to raise the thresholds. '
+                                     'Default: %(default)s')
+    adaptive_group.add_argument('--max-pending', type=int, default=50,
+                                help='Pending Postgrey lookups above which to raise the thresholds. '
+                                     'Default: %(default)s')
+    adaptive_group.add_argument('--max-lookup-rate', type=float,
+                                help='Messages per second meeting the conditions above which to raise the thresholds')
+
+    relay_group = parser.add_argument_group(
+        'relay connections', 'Keep connections to the relay open between messages, optionally secured with STARTTLS')
+    relay_group.add_argument('--relay-pool', type=check_count_type, default=0, metavar='N',
+                             help='Idle relay connections to keep open. Default: %(default)s')
+    relay_group.add_argument('--relay-starttls', action='store_true',
+                             help='Require STARTTLS on relay connections, resuming TLS sessions')
+    relay_group.add_argument('--relay-cafile', metavar='FILE',
+                             help='CA certificates, or the relay\'s own self-signed certificate, to verify it against. '
+                                  'Default: the system CA certificates')
+    relay_group.add_argument('--relay-no-verify', action='store_true',
+                             help='Do not verify the relay\'s certificate')
+    relay_group.add_argument('--relay-tls-name', metavar='NAME',
+                             help='Name to check the relay\'s certificate against, needed for a relay on a Unix '
+                                  'socket. Default: the relay\'s host name')
+
+    lanes_group = parser.add_argument_group(
+        'traffic lanes', 'Clean mail and greylisting candidates are processed and relayed separately, so that a '
+                         'slow Postgrey does not hold up clean mail')
+    lanes_group.add_argument('--clean-concurrency', type=check_positive_type, default=100,
+                             help='Clean messages processed at once. Default: %(default)s')
+    lanes_group.add_argument('--candidate-concurrency', type=check_positive_type, default=20,
+                             help='Greylisting candidates processed at once. Default: %(default)s')
+    lanes_group.add_argument('--clean-relay-workers', type=check_positive_type, default=8,
+                             help='Threads relaying clean messages. Default: %(default)s')
+    lanes_group.add_argument('--candidate-relay-workers', type=check_positive_type, default=4,
+                             help='Threads relaying greylisting candidates. Default: %(default)s')
+
+    rate_group = parser.add_argument_group(
+        'client rate limits', 'Shed the load of clients sending too much mail, enabled by --rate-limit')
+    rate_group.add_argument('--rate-limit', type=int, help='Messages per client network per window')
+    rate_group.add_argument('--rate-window', type=int, default=60,
+                            help='Length of the sliding window in seconds. Default: %(default)s')
+    rate_group.add_argument('--rate-action', choices=ACTIONS, default=ACTIONS[0],
+                            help='What to do with clients over the limit: temporarily reject them, delay them, or '
+                                 'greylist them without scoring. Default: %(default)s')
+    rate_group.add_argument('--tarpit-delay', type=float, default=10,
+                            help='Seconds by which to delay clients in the tarpit. Default: %(default)s')
+    rate_group.add_argument('--ipv4-prefix', type=int, default=32,
+                            help='Prefix length by which IPv4 clients are grouped. Default: %(default)s')
+    rate_group.add_argument('--ipv6-prefix', type=int, default=64,
+                            help='Prefix length by which IPv6 clients are grouped. Default: %(default)s')
 
     args = parser.parse_args()
+    fixed = ()
+    if args.config:
+        # The settings given on the command line, which the file doesn't override on reload either
+        unset = object()
+        given = parser.parse_args(namespace=argparse.Namespace(**dict.fromkeys(SETTINGS, unset)))
+        fixed = tuple(name for name in SETTINGS if getattr(given, name) is not unset)
+        try:
+            parser.set_defaults(**load_config(args.config))
+        except ConfigError as ex:
+            parser.error(str(ex))
+        args = parser.parse_args()
+
+    if args.mode == 'proxy' and not hasattr(args, 'relay'):
+        parser.error('the following arguments are required in proxy mode: -r/--relay')
+    # The policy service never sees the message, so it only acts on clients over their rate limit
+    if args.mode == 'policy' and args.rate_limit is None:
+        parser.error('the following arguments are required in policy mode: --rate-limit')
+
+    adaptive = None
+    if args.spam_max is not None or args.dcc_max is not None:
+        from greylistfilter.adaptive import AdaptiveThresholds
+        adaptive = AdaptiveThresholds(
+            args.spam, args.dcc,
+            args.spam if args.spam_max is None else args.spam_max,
+            args.dcc if args.dcc_max is None else args.dcc_max,
+            args.spam_min, args.dcc_min, args.latency_target, args.max_pending, args.max_lookup_rate)
+
+    whitelist = None
+    if args.whitelist_clients or args.whitelist_recipients or args.whitelist_ips:
+        from greylistfilter.whitelist import Whitelist
+        try:
+            whitelist = Whitelist(args.whitelist_clients, args.whitelist_recipients, args.whitelist_ips)
+        except OSError as ex:
+            parser.error('cannot read whitelist: %s' % ex)
+
+    rate_limit = None
+    if args.rate_limit is not None:
+        from greylistfilter.ratelimit import ClientRateLimit
+        rate_limit = ClientRateLimit(args.rate_limit, args.rate_action, args.rate_window, args.tarpit_delay,
+                                     args.ipv4_prefix, args.ipv6_prefix)
+
+    relay_pool = None
+    if args.relay_pool or args.relay_starttls:
+        from greylistfilter.relay import RelayPool, make_tls_context
+        from greylistfilter.relayaddress import parse_relay_address
+        tls_context = None
+        if args.relay_starttls:
+            try:
+                tls_context = make_tls_context(args.relay_cafile, not args.relay_no_verify)
+            except (OSError, ValueError) as ex:
+                parser.error('cannot set up TLS: %s' % ex)
+            relay = getattr(args, 'relay', None)
+            if relay and tls_context.check_hostname and not args.relay_tls_name and parse_relay_address(relay).path:
+                parser.error('--relay-tls-name is needed to verify the certificate of a relay on a Unix socket')
+        relay_pool = RelayPool(args.relay_pool, tls_context, tls_name=args.relay_tls_name)
+
+    if args.check_config:
+        for option, path, directory in (('--spool-dir', args.spool_dir, True),
+                                        ('--state-file', args.state_file, False),
+                                        ('--shared-cache', args.shared_cache, False),
+                                        ('--control-socket', args.control_socket, False)):
+            problem = path and check_path(path, directory)
+            if problem:
+                parser.error('%s: %s' % (option, problem))
+        print('Configuration OK')
+        sys.exit(0)
+
+    from greylistfilter.lanes import TrafficLanes
+    lanes = TrafficLanes(args.clean_concurrency, args.candidate_concurrency,
+                         args.clean_relay_workers, args.candidate_relay_workers)
 
     configure_logging(level=args.loglevel)
     logger.info('SpamFilterProxy starting')
 
-    main(args.address, args.port, args.relay, args.spam, args.dcc,
-         args.pghost, args.pgport)
+    main(args.address, args.port, getattr(args, 'relay', None), args.spam, args.dcc,
+         args.pghost, args.pgport, args.early_lookup, args.defer_ttl,
+         args.state_file, args.state_interval, args.max_header_bytes, args.max_line_length,
+         args.pgtimeout, args.mode, args.shared_cache, adaptive, args.config, args.control_socket,
+         rate_limit, args.spool_dir, args.spool_retry, whitelist, lanes, relay_pool, args.spool_max_age,
+         fixed)
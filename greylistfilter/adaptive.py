@@ -0,0 +1,145 @@
+"""
+Greylisting thresholds which follow the load on Postgrey.
+
+Under load, that is when Postgrey replies slowly, too many lookups are in
+flight or too many messages meet the conditions, the effective thresholds
+are raised step by step towards their upper bounds, so that only the more
+suspicious mail is looked up. Once the load has gone, they step back down,
+and with spare capacity further down towards their lower bounds.
+"""
+import logging
+import time
+
+logger = logging.getLogger('SpamFilterProxy')
+
+
+class AdaptiveThresholds:
+    """
+    Effective spam and DCC thresholds between configured bounds.
+
+    The level runs from -1 (lower bounds) through 0 (the configured
+    thresholds) to 1 (upper bounds), and only goes below 0 if a lower
+    bound below a configured threshold was given, as it would otherwise
+    only delay the thresholds rising when load arrives. It is re-evaluated at most every
+    `interval` seconds from the load pressure: the largest of the Postgrey
+    latency against `latency_target`, the pending lookups against
+    `max_pending` and the rate of messages meeting the conditions against
+    `max_rate`. The spam threshold moves linearly with the level, the DCC
+    threshold geometrically, as DCC counts span several orders of magnitude.
+
+    Raised thresholds mean few lookups, so the latency average can't rely
+    on new samples to come back down: over an interval without any, it
+    decays towards zero with a half-life of LATENCY_HALF_LIFE seconds.
+    """
+
+    # Pressure below which the thresholds are lowered again
+    LOW_WATER = 0.5
+    # Weight of the latest latency in the moving average
+    SMOOTHING = 0.2
+    # Seconds in which the latency average halves while there are no lookups
+    LATENCY_HALF_LIFE = 10
+
+    def __init__(self, spam, dcc, spam_max, dcc_max, spam_min=None, dcc_min=None, latency_target=0.5,
+                 max_pending=50, max_rate=None, step=0.1, interval=5, clock=time.monotonic):
+        self._bounds = (spam_min, spam_max, dcc_min, dcc_max)
+        self.latency_target = latency_target
+        self.max_pending = max_pending
+        self.max_rate = max_rate
+        self.step = step
+        self.interval = interval
+        self.clock = clock
+
+        self.level = 0.0
+        self.latency = 0.0
+        self.pending = 0
+        self.configure(spam, dcc)
+        self._verdicts = 0
+        self._samples = 0
+        self._next_adjust = clock() + interval
+        self._window_start = clock()
+
+    def configure(self, spam, dcc):
+        """
+        Set the configured thresholds, keeping the current level
+        """
+        spam_min, spam_max, dcc_min, dcc_max = self._bounds
+        self.spam = spam
+        self.dcc = dcc
+        self.spam_max = max(spam, spam_max)
+        self.dcc_max = max(dcc, dcc_max)
+        self.spam_min = spam if spam_min is None else min(spam, spam_min)
+        self.dcc_min = dcc if dcc_min is None else min(dcc, dcc_min)
+        self.floor = -1.0 if self.spam_min < spam or self.dcc_min < dcc else 0.0
+        self.level = max(self.level, self.floor)
+        self.effective = (self._spam_at(self.level), self._dcc_at(self.level))
+
+    def lookup_started(self):
+        self.pending += 1
+
+    def lookup_finished(self, seconds):
+        self.pending -= 1
+        self._samples += 1
+        self.latency += self.SMOOTHING * (seconds - self.latency)
+
+    def observe_verdict(self, conditions_met):
+        if conditions_met:
+            self._verdicts += 1
+
+    def thresholds(self):
+        """
+        Return the effective (spam, dcc) thresholds
+        """
+        now = self.clock()
+        if now >= self._next_adjust:
+            self.adjust(now)
+        return self.effective
+
+    def pressure(self, now):
+        pressure = max(self.latency / self.latency_target, self.pending / self.max_pending)
+        if self.max_rate:
+            elapsed = max(now - self._window_start, 1e-9)
+            pressure = max(pressure, self._verdicts / elapsed / self.max_rate)
+        return pressure
+
+    def adjust(self, now):
+        if not self._samples:
+            self.latency *= 0.5 ** ((now - self._window_start) / self.LATENCY_HALF_LIFE)
+        pressure = self.pressure(now)
+        self._samples = 0
+        self._verdicts = 0
+        self._window_start = now
+        self._next_adjust = now + self.interval
+
+        if pressure > 1:
+            level = min(1.0, self.level + self.step)
+        elif pressure < self.LOW_WATER:
+            level = max(self.floor, self.level - self.step)
+        else:
+            return
+
+        if level != self.level:
+            self.level = level
+            self.effective = (self._spam_at(level), self._dcc_at(level))
+            logger.info('Load pressure %.2f, greylisting thresholds now spam=%g dcc=%d',
+                        pressure, *self.effective)
+
+    def _spam_at(self, level):
+        bound = self.spam_max if level > 0 else self.spam_min
+        return self.spam + abs(level) * (bound - self.spam)
+
+    def _dcc_at(self, level):
+        bound = self.dcc_max if level > 0 else self.dcc_min
+        return int(round(self.dcc * (bound / self.dcc) ** abs(level)))
+
+    def state(self):
+        """
+        The effective thresholds and the load figures behind them
+        """
+        spam, dcc = self.effective
+        return {
+            'spam': spam,
+            'dcc': dcc,
+            'level': self.level,
+            'latency': self.latency,
+            'pending': self.pending,
+        }
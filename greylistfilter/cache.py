@@ -0,0 +1,335 @@
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+
+from collections import OrderedDict
+
+logger = logging.getLogger('SpamFilterProxy')
+
+DEFER_ACTION = 'DEFER_IF_PERMIT'
+# The delay in a greylisting text such as Postgrey's 'Greylisted for 300 seconds'
+RE_DELAY = re.compile(r'\b(\d+) seconds\b')
+
+SHARED_MAGIC = b'GLVC'
+SHARED_VERSION = 1
+
+# magic | version | reserved | buckets | slot size
+SHARED_HEADER = struct.Struct('<4sHHII')
+# sequence | expires | key length | reply length, followed by the key and reply bytes
+SLOT = struct.Struct('<IdHH')
+SEQUENCE = struct.Struct('<I')
+
+DATA_OFFSET = 64
+SLOT_SIZE = 512
+SLOT_CAPACITY = SLOT_SIZE - SLOT.size
+BUCKET_SLOTS = 8
+LOCK_SHARDS = 64
+READ_RETRIES = 100
+
+
+def age_reply(reply, elapsed):
+    """
+    Take `elapsed` seconds off the delay given in a deferral's text, so that
+    a reply answered from the cache tells the client the delay remaining
+    now rather than when Postgrey answered
+    """
+    return RE_DELAY.sub(lambda m: '%d seconds' % max(0, int(m.group(1)) - int(elapsed)), reply, count=1)
+
+
+class VerdictCache:
+    """
+    Front for greylist lookups, keyed on the triplet.
+
+    Concurrent lookups for the same key share a single in-flight query, and
+    DEFER_IF_PERMIT replies are kept for `ttl` seconds so that retries
+    within that window are answered locally, with the delay in their text
+    brought up to date. Any other reply is never cached, as Postgrey needs
+    to see the passes to do its bookkeeping.
+
+    Keep `ttl` below Postgrey's --delay: a cached deferral can hold up a
+    triplet for at most `ttl` seconds longer than Postgrey itself would.
+    """
+
+    def __init__(self, ttl=0, maxsize=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._deferred = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._deferred)
+
+    def get_cached(self, key):
+        """
+        Return the cached reply for `key` and the seconds it remains valid,
+        or (None, 0)
+        """
+        entry = self._deferred.get(key)
+        if entry is None:
+            return None, 0
+
+        reply, expires = entry
+        remaining = expires - self.clock()
+        if remaining <= 0:
+            del self._deferred[key]
+            return None, 0
+
+        return reply, remaining
+
+    def cacheable(self, reply):
+        return self.ttl > 0 and DEFER_ACTION in reply.split(' ', 1)[0]
+
+    def store(self, key, reply):
+        if not self.cacheable(reply):
+            return
+
+        self._deferred[key] = (reply, self.clock() + self.ttl)
+        self._deferred.move_to_end(key)
+        while len(self._deferred) > self.maxsize:
+            self._deferred.popitem(last=False)
+
+    def export(self):
+        """
+        Return the live cached replies as (key, reply, remaining seconds)
+        """
+        now = self.clock()
+        return [(key, reply, expires - now) for key, (reply, expires) in self._deferred.items() if expires > now]
+
+    def restore(self, entries):
+        """
+        Load entries as returned by `export`
+        """
+        if self.ttl <= 0:
+            return
+
+        now = self.clock()
+        for key, reply, remaining in entries:
+            self._deferred[tuple(key)] = (reply, now + min(remaining, self.ttl))
+        while len(self._deferred) > self.maxsize:
+            self._deferred.popitem(last=False)
+
+    async def lookup(self, key, fetch):
+        """
+        Return the reply for `key`, calling the coroutine function `fetch`
+        only if neither a cached reply nor an identical query in flight exists
+        """
+        reply, remaining = self.get_cached(key)
+        if reply is not None:
+            logger.debug('Cached greylist reply for %s, %.0fs remaining', key, remaining)
+            self.hits += 1
+            return age_reply(reply, max(0, self.ttl - remaining))
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            # Every waiter may have gone away by the time it fails
+            task.add_done_callback(_retrieve_exception)
+            self._inflight[key] = task
+        else:
+            logger.debug('Joining in-flight greylist lookup for %s', key)
+            self.hits += 1
+
+        # One waiter going away must not cancel the query for the others
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, fetch):
+        try:
+            reply = await fetch()
+            self.store(key, reply)
+            return reply
+        finally:
+            del self._inflight[key]
+
+
+def _retrieve_exception(task):
+    if not task.cancelled():
+        task.exception()
+
+
+class SharedCacheError(Exception):
+    pass
+
+
+def encode_key(key):
+    return '\0'.join(key).encode('utf8', errors='surrogateescape')
+
+
+def decode_key(data):
+    return tuple(data.decode('utf8', errors='surrogateescape').split('\0'))
+
+
+class SharedVerdictCache(VerdictCache):
+    """
+    VerdictCache keeping its deferrals in a memory-mapped file, so that all
+    processes on the host mapping the same file share them.
+
+    The file is a fixed-size hash table: a key hashes to a bucket of
+    BUCKET_SLOTS slots, and a full bucket evicts the entry closest to expiry.
+    Writers hold an fcntl lock on one of LOCK_SHARDS bytes, chosen by bucket.
+    Readers take no lock, but retry when the slot's sequence number shows a
+    write in progress. Expiry times are wall-clock, as they have to mean the
+    same to every process. In-flight lookups are only shared within a process.
+    """
+
+    def __init__(self, path, ttl=0, maxsize=10000, clock=time.time):
+        super().__init__(ttl, maxsize, clock)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self.buckets = self._init_file(-(-maxsize // BUCKET_SLOTS))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(self._fd, self._file_size(self.buckets))
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    @staticmethod
+    def _file_size(buckets):
+        return DATA_OFFSET + buckets * BUCKET_SLOTS * SLOT_SIZE
+
+    def _init_file(self, buckets):
+        """
+        Lay out a new file, or check an existing one and adopt its size
+        """
+        if os.fstat(self._fd).st_size == 0:
+            os.ftruncate(self._fd, self._file_size(buckets))
+            os.pwrite(self._fd, SHARED_HEADER.pack(SHARED_MAGIC, SHARED_VERSION, 0, buckets, SLOT_SIZE), 0)
+            return buckets
+
+        header = os.pread(self._fd, SHARED_HEADER.size, 0)
+        if len(header) < SHARED_HEADER.size:
+            raise SharedCacheError('%s: truncated header' % self.path)
+
+        magic, version, _, buckets, slot_size = SHARED_HEADER.unpack(header)
+        if magic != SHARED_MAGIC or version != SHARED_VERSION or slot_size != SLOT_SIZE or not buckets:
+            raise SharedCacheError('%s is not a shared cache file of this version' % self.path)
+        if os.fstat(self._fd).st_size < self._file_size(buckets):
+            raise SharedCacheError('%s: truncated file' % self.path)
+
+        return buckets
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _slots(self, bucket):
+        start = DATA_OFFSET + bucket * BUCKET_SLOTS * SLOT_SIZE
+        return range(start, start + BUCKET_SLOTS * SLOT_SIZE, SLOT_SIZE)
+
+    def _bucket(self, key_bytes):
+        return zlib.crc32(key_bytes) % self.buckets
+
+    def _read_slot(self, offset):
+        """
+        Return a consistent (expires, key, reply) copy of the slot at
+        `offset`, or None if it kept changing
+        """
+        for _ in range(READ_RETRIES):
+            sequence, expires, key_length, reply_length = SLOT.unpack_from(self._map, offset)
+            if sequence & 1:
+                continue
+            start = offset + SLOT.size
+            data = self._map[start:start + min(key_length + reply_length, SLOT_CAPACITY)]
+            if SEQUENCE.unpack_from(self._map, offset)[0] == sequence:
+                return expires, data[:key_length], data[key_length:]
+        return None
+
+    def _live_slots(self):
+        now = self.clock()
+        for bucket in range(self.buckets):
+            for offset in self._slots(bucket):
+                slot = self._read_slot(offset)
+                if slot is not None and slot[1] and slot[0] > now:
+                    yield slot
+
+    def __len__(self):
+        return sum(1 for _ in self._live_slots())
+
+    def get_cached(self, key):
+        key_bytes = encode_key(key)
+
+        for offset in self._slots(self._bucket(key_bytes)):
+            slot = self._read_slot(offset)
+            if slot is None or slot[1] != key_bytes:
+                continue
+
+            expires, _, reply = slot
+            remaining = min(expires - self.clock(), self.ttl)
+            if remaining <= 0:
+                break
+            return reply.decode('utf8', errors='surrogateescape'), remaining
+
+        return None, 0
+
+    def store(self, key, reply):
+        if self.cacheable(reply):
+            self._put(encode_key(key), reply, self.clock() + self.ttl)
+
+    def _put(self, key_bytes, reply, expires):
+        reply_bytes = reply.encode('utf8', errors='surrogateescape')
+        if len(key_bytes) + len(reply_bytes) > SLOT_CAPACITY:
+            logger.debug('Greylist reply too large for the shared cache, not cached')
+            return
+
+        bucket = self._bucket(key_bytes)
+        shard = bucket % LOCK_SHARDS
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, shard)
+        try:
+            target = self._choose_slot(bucket, key_bytes)
+            sequence = SEQUENCE.unpack_from(self._map, target)[0] | 1
+            SEQUENCE.pack_into(self._map, target, sequence)
+            start = target + SLOT.size
+            self._map[start:start + len(key_bytes) + len(reply_bytes)] = key_bytes + reply_bytes
+            SLOT.pack_into(self._map, target, sequence, expires, len(key_bytes), len(reply_bytes))
+            SEQUENCE.pack_into(self._map, target, (sequence + 1) & 0xffffffff)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, shard)
+
+    def _choose_slot(self, bucket, key_bytes):
+        """
+        The slot already holding `key_bytes`, else a free or expired one,
+        else the one closest to expiry. Called with the bucket's lock held.
+        """
+        now = self.clock()
+        free = oldest = None
+        oldest_expires = None
+
+        for offset in self._slots(bucket):
+            _, expires, key_length, _ = SLOT.unpack_from(self._map, offset)
+            start = offset + SLOT.size
+            if key_length and self._map[start:start + key_length] == key_bytes:
+                return offset
+            if expires <= now or not key_length:
+                if free is None:
+                    free = offset
+            elif oldest_expires is None or expires < oldest_expires:
+                oldest, oldest_expires = offset, expires
+
+        return free if free is not None else oldest
+
+    def export(self):
+        now = self.clock()
+        return [(decode_key(key), reply.decode('utf8', errors='surrogateescape'), expires - now)
+                for expires, key, reply in self._live_slots()]
+
+    def restore(self, entries):
+        if self.ttl <= 0:
+            return
+
+        now = self.clock()
+        for key, reply, remaining in entries:
+            self._put(encode_key(key), reply, now + min(remaining, self.ttl))
@@ -0,0 +1,127 @@
+"""
+Configuration file for the settings which can be changed while running.
+
+The file is in INI format, with the settings in a [greylistfilter]
+section, named as the long command line options:
+
+    [greylistfilter]
+    spam = 1.0
+    dcc = many
+    relay = 127.0.0.1:10026
+    pghost = 127.0.0.1
+
+At startup the file supplies the defaults for the command line. While
+running it is read again on SIGHUP or a `reload` on the control socket,
+and the settings given on the command line still take precedence.
+"""
+import configparser
+
+from .defaults import DCC_MANY
+from .relayaddress import parse_relay_address
+
+SECTION = 'greylistfilter'
+
+
+class ConfigError(Exception):
+    pass
+
+
+def parse_dcc_threshold(value):
+    if value == 'many':
+        val = DCC_MANY
+    else:
+        try:
+            val = int(value)
+        except ValueError:
+            raise ValueError('value must be either an integer or "many": %s' % value)
+
+    if val < 2:
+        raise ValueError('value must be greater than 1: %s' % val)
+
+    return val
+
+
+def parse_relay(value):
+    if value == 'None':
+        return None
+    parse_relay_address(value)
+    return value
+
+
+def parse_count(value, minimum=0):
+    val = int(value)
+    if val < minimum:
+        raise ValueError('value must be at least %d: %s' % (minimum, val))
+    return val
+
+
+def parse_positive(value):
+    return parse_count(value, 1)
+
+
+def parse_bool(value):
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError('not a boolean: %s' % value)
+
+
+SETTINGS = {
+    'spam': float,
+    'dcc': parse_dcc_threshold,
+    'relay': parse_relay,
+    'pghost': str,
+    'pgport': parse_positive,
+    'pgtimeout': float,
+    'early_lookup': parse_bool,
+    'defer_ttl': parse_count,
+    'max_header_bytes': parse_positive,
+    'max_line_length': parse_positive,
+    'clean_concurrency': parse_positive,
+    'candidate_concurrency': parse_positive,
+    'clean_relay_workers': parse_positive,
+    'candidate_relay_workers': parse_positive,
+    'relay_pool': parse_count,
+}
+
+
+def load_config(path):
+    """
+    Read the configuration file, returning the converted settings by name.
+    Raises ConfigError if the file can't be read or any setting is invalid,
+    so that a bad file is never partly applied.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(path) as input:
+            parser.read_file(input)
+    except (OSError, configparser.Error) as ex:
+        raise ConfigError('%s: %s' % (path, ex))
+
+    if not parser.has_section(SECTION):
+        raise ConfigError('%s: no [%s] section' % (path, SECTION))
+
+    settings = {}
+    for name, value in parser.items(SECTION):
+        key = name.replace('-', '_')
+        if key not in SETTINGS:
+            raise ConfigError('%s: unknown or not reloadable setting: %s' % (path, name))
+        try:
+            settings[key] = SETTINGS[key](value)
+        except ValueError as ex:
+            raise ConfigError('%s: %s: %s' % (path, name, ex))
+
+    return settings
+
+
+def reload_config(path, handler, fixed=()):
+    """
+    Apply the configuration file to the handler, but for the `fixed`
+    settings, those given on the command line. Call this from the thread
+    running the handler's event loop.
+    """
+    settings = load_config(path)
+    for name in fixed:
+        settings.pop(name, None)
+    handler.reconfigure(settings)
+    return settings
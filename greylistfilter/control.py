@@ -0,0 +1,89 @@
+"""
+Control socket for the running filter.
+
+Commands are single lines, and each reply is a block of `name=value` lines
+ending with an empty line, as in the policy protocol:
+
+    status   the current settings and counters
+    reload   re-read the configuration file
+"""
+import asyncio
+import logging
+import os
+import stat
+
+from .config import ConfigError, reload_config
+
+logger = logging.getLogger('SpamFilterProxy')
+
+
+def format_reply(values):
+    return b''.join(b'%s=%s\n' % (str(name).encode(), str(value).encode()) for name, value in values) + b'\n'
+
+
+class ControlServer:
+    """
+    Serves the control commands on a Unix socket
+    """
+
+    def __init__(self, handler, config_file=None, fixed=()):
+        self.handler = handler
+        self.config_file = config_file
+        self.fixed = fixed
+        self.server = None
+        self.path = None
+        self._connections = set()
+
+    async def start(self, path):
+        # Remove the socket left behind by an earlier run, but nothing else
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self.path = path
+        self.server = await asyncio.start_unix_server(self.handle_connection, path=path)
+        os.chmod(path, 0o600)
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for task in self._connections:
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(format_reply(self.command(line.decode('utf8', errors='replace').strip())))
+                await writer.drain()
+        except ConnectionError as ex:
+            logger.debug('Control connection lost: %s', ex)
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    def command(self, command):
+        if command == 'status':
+            return sorted(self.handler.status().items())
+
+        if command == 'reload':
+            if not self.config_file:
+                return [('error', 'no configuration file')]
+            try:
+                settings = reload_config(self.config_file, self.handler, self.fixed)
+            except ConfigError as ex:
+                logger.error('Configuration not reloaded: %s', ex)
+                return [('error', ex)]
+            return [('reloaded', ','.join(sorted(settings)))]
+
+        return [('error', 'unknown command: %s' % command)]
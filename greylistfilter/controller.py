@@ -0,0 +1,47 @@
+import asyncio
+import threading
+
+
+class ServerController:
+    """
+    Runs an asyncio server, i.e. an object with `start(host, port)` and
+    `stop()` coroutines, on an event loop in a separate thread, in the same
+    way as aiosmtpd's Controller does for the SMTP proxy
+    """
+
+    def __init__(self, server, hostname='127.0.0.1', port=0):
+        self.server = server
+        self.hostname = hostname
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def start(self):
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(self.server.start(self.hostname, self.port))
+            except Exception as ex:
+                errors.append(ex)
+                ready.set()
+                return
+            ready.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.server.stop())
+            self.loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+
+        if errors:
+            self._thread.join()
+            raise errors[0]
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
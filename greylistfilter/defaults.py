@@ -0,0 +1,18 @@
+"""
+Defaults and limits shared by the command line and the modules using them,
+kept apart so that the command line can be checked without importing the
+servers and their dependencies.
+"""
+
+# Stands for a DCC count of "many"
+DCC_MANY = 999999
+
+# Seconds to wait for a Postgrey reply
+DEFAULT_TIMEOUT = 10
+
+# Bounds on the cost of scanning the headers of any one message
+MAX_HEADER_BYTES = 256 * 1024
+MAX_LINE_LENGTH = 8192
+
+# Reply to clients over their rate limit, in every mode
+RATE_LIMIT_REPLY = '450 4.7.1 Too many messages, try again later'
@@ -0,0 +1,137 @@
+"""
+Separate lanes for clean mail and greylisting candidates.
+
+Candidates wait on Postgrey, and when Postgrey slows down they pile up.
+Each lane has its own limit on the messages being processed at once and
+its own pool of threads relaying them, so that the candidates queueing
+in their lane never hold up the clean majority in the other.
+"""
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+CLEAN = 'clean'
+CANDIDATE = 'candidate'
+
+
+class Lane:
+    """
+    A concurrency budget and relay pool for one class of traffic, used as
+    an async context manager around the processing of a message
+    """
+
+    def __init__(self, name, concurrency, relay_workers, clock=time.monotonic):
+        self.name = name
+        self.concurrency = concurrency
+        self.relay_workers = relay_workers
+        self.executor = ThreadPoolExecutor(relay_workers, thread_name_prefix='relay-%s' % name)
+        self.clock = clock
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # created on first use, in the event loop's thread
+        self._semaphore = None
+        # permits still to be withheld after the concurrency was lowered
+        self._shortfall = 0
+
+    async def __aenter__(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        start = self.clock()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        wait = self.clock() - start
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.active -= 1
+        self.processed += 1
+        if self._shortfall:
+            self._shortfall -= 1
+        else:
+            self._semaphore.release()
+
+    def resize(self, concurrency=None, relay_workers=None):
+        """
+        Change the lane's budget and relay pool. Permits can't be taken back
+        from a semaphore, so a lower concurrency takes effect as messages in
+        progress finish. Relaying already under way finishes in the old pool.
+        """
+        if concurrency is not None and concurrency != self.concurrency:
+            change = concurrency - self.concurrency
+            self.concurrency = concurrency
+            if self._semaphore is not None:
+                if change < 0:
+                    self._shortfall -= change
+                else:
+                    settled = min(change, self._shortfall)
+                    self._shortfall -= settled
+                    for _ in range(change - settled):
+                        self._semaphore.release()
+
+        if relay_workers is not None and relay_workers != self.relay_workers:
+            executor, self.executor = self.executor, ThreadPoolExecutor(
+                relay_workers, thread_name_prefix='relay-%s' % self.name)
+            self.relay_workers = relay_workers
+            executor.shutdown(wait=False)
+
+    async def run_in_pool(self, func, *args):
+        """
+        Run the blocking `func` in the lane's relay pool
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def metrics(self):
+        return {
+            'waiting': self.waiting,
+            'active': self.active,
+            'processed': self.processed,
+            'wait_avg': self.total_wait / self.processed if self.processed else 0.0,
+            'wait_max': self.max_wait,
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class TrafficLanes:
+    """
+    The clean and candidate lanes
+    """
+
+    def __init__(self, clean_concurrency=100, candidate_concurrency=20, clean_workers=8, candidate_workers=4,
+                 clock=time.monotonic):
+        self.clean = Lane(CLEAN, clean_concurrency, clean_workers, clock)
+        self.candidate = Lane(CANDIDATE, candidate_concurrency, candidate_workers, clock)
+
+    def lane(self, candidate):
+        return self.candidate if candidate else self.clean
+
+    def resize(self, clean_concurrency=None, candidate_concurrency=None, clean_workers=None, candidate_workers=None):
+        self.clean.resize(clean_concurrency, clean_workers)
+        self.candidate.resize(candidate_concurrency, candidate_workers)
+
+    def metrics(self):
+        """
+        The queue metrics of both lanes, by name
+        """
+        metrics = {}
+        for lane in (self.clean, self.candidate):
+            metrics.update(('lane_%s_%s' % (lane.name, name), value) for name, value in lane.metrics().items())
+        return metrics
+
+    def close(self):
+        self.clean.close()
+        self.candidate.close()
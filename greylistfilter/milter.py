@@ -0,0 +1,268 @@
+"""
+Milter frontend, as an alternative to the before-queue SMTP proxy.
+
+Postfix hands the milter the envelope and the headers only, the body is
+never requested. The decision is made as soon as the headers are complete:
+greylisted messages are temporarily rejected there and then, and the
+greylisting header Postgrey asks for on a pass is prepended at end of
+message, if the MTA lets the milter add headers.
+Postfix keeps the message itself, so nothing is re-injected.
+"""
+import asyncio
+import logging
+import struct
+
+from .defaults import RATE_LIMIT_REPLY
+from .ratelimit import GREYLIST, TEMPFAIL
+
+logger = logging.getLogger('SpamFilterProxy')
+
+MILTER_VERSION = 6
+MAX_PACKET = 1024 * 1024
+
+# Commands from the MTA
+SMFIC_ABORT = b'A'
+SMFIC_BODY = b'B'
+SMFIC_CONNECT = b'C'
+SMFIC_MACRO = b'D'
+SMFIC_BODYEOB = b'E'
+SMFIC_HELO = b'H'
+SMFIC_QUIT_NC = b'K'
+SMFIC_HEADER = b'L'
+SMFIC_MAIL = b'M'
+SMFIC_EOH = b'N'
+SMFIC_OPTNEG = b'O'
+SMFIC_QUIT = b'Q'
+SMFIC_RCPT = b'R'
+SMFIC_DATA = b'T'
+SMFIC_UNKNOWN = b'U'
+
+# Replies to the MTA
+SMFIR_CONTINUE = b'c'
+SMFIR_INSHEADER = b'i'
+SMFIR_REPLYCODE = b'y'
+
+# Actions we may take
+SMFIF_ADDHDRS = 0x01
+
+# Protocol steps we don't need, or need no reply for
+SMFIP_NOHELO = 0x02
+SMFIP_NOBODY = 0x10
+SMFIP_NR_HDR = 0x80
+SMFIP_NOUNKNOWN = 0x100
+SMFIP_NODATA = 0x200
+PROTOCOL_FLAGS = SMFIP_NOHELO | SMFIP_NOBODY | SMFIP_NR_HDR | SMFIP_NOUNKNOWN | SMFIP_NODATA
+
+
+class MilterError(Exception):
+    pass
+
+
+def encode_packet(command, data=b''):
+    return struct.pack('>I', len(data) + 1) + command + data
+
+
+async def read_packet(reader):
+    """
+    Read one milter packet, returning (command, data), or (None, b'') once
+    the MTA has closed the connection
+    """
+    try:
+        header = await reader.readexactly(4)
+    except asyncio.IncompleteReadError:
+        return None, b''
+
+    length = struct.unpack('>I', header)[0]
+    if not 0 < length <= MAX_PACKET:
+        raise MilterError('Invalid packet length: %d' % length)
+
+    packet = await reader.readexactly(length)
+    return packet[:1], packet[1:]
+
+
+def split_strings(data):
+    """
+    Split NUL-terminated strings
+    """
+    return [x.decode('utf8', errors='surrogateescape') for x in data.split(b'\0')[:-1]]
+
+
+def strip_address(arg):
+    return arg[1:-1] if arg.startswith('<') and arg.endswith('>') else arg
+
+
+class MilterOptions:
+    """
+    What was negotiated with the MTA on a milter connection. Until then,
+    every command is replied to.
+    """
+    __slots__ = ('version', 'actions', 'protocol')
+
+    def __init__(self):
+        self.version = MILTER_VERSION
+        self.actions = 0
+        self.protocol = 0
+
+
+class MilterMessage:
+    """
+    State of the message currently being received on a milter connection
+    """
+    __slots__ = ('sender', 'recipient', 'headers', 'header_bytes', 'add_header', 'skip_scoring')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sender = None
+        self.recipient = None
+        self.headers = []
+        self.header_bytes = 0
+        self.add_header = None
+        self.skip_scoring = False
+
+
+class MilterServer:
+    """
+    Asyncio milter server using the handler's scoring and greylist lookup
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.server = None
+        self._connections = set()
+
+    async def start(self, host='127.0.0.1', port=10030):
+        self.server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for task in self._connections:
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        client = {}
+        message = MilterMessage()
+        options = MilterOptions()
+
+        try:
+            while True:
+                command, data = await read_packet(reader)
+                if command is None or command == SMFIC_QUIT:
+                    break
+
+                replies = await self.handle_command(command, data, client, message, options)
+                if replies:
+                    writer.write(b''.join(encode_packet(*reply) for reply in replies))
+                    await writer.drain()
+        except (MilterError, ConnectionError) as ex:
+            logger.warning('Milter connection aborted: %s', ex)
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    async def handle_command(self, command, data, client, message, options):
+        """
+        Handle one command, returning the list of (reply, data) to send
+        """
+        if command == SMFIC_OPTNEG:
+            version, actions, protocol = struct.unpack('>III', data[:12])
+            if version < 2:
+                raise MilterError('Unsupported milter protocol version: %d' % version)
+            options.version = min(version, MILTER_VERSION)
+            options.actions = actions & SMFIF_ADDHDRS
+            options.protocol = protocol & PROTOCOL_FLAGS
+            return [(SMFIC_OPTNEG, struct.pack('>III', options.version, options.actions, options.protocol))]
+
+        if command in (SMFIC_ABORT, SMFIC_QUIT_NC):
+            message.reset()
+            if command == SMFIC_QUIT_NC:
+                client.clear()
+            return []
+
+        if command == SMFIC_MACRO:
+            macros = split_strings(data[1:])
+            client.update(zip(macros[::2], macros[1::2]))
+            return []
+
+        if command == SMFIC_CONNECT:
+            hostname, _, rest = data.partition(b'\0')
+            client['name'] = hostname.decode('utf8', errors='replace')
+            # family, then for IP connections the port and address
+            client['addr'] = rest[3:-1].decode() if rest[:1] in (b'4', b'6') else None
+        elif command == SMFIC_MAIL:
+            message.reset()
+            action = await self.handler.check_client_rate(client.get('addr'))
+            if action == TEMPFAIL:
+                return [(SMFIR_REPLYCODE, RATE_LIMIT_REPLY.encode() + b'\0')]
+            message.skip_scoring = action == GREYLIST
+            message.sender = strip_address(split_strings(data)[0])
+        elif command == SMFIC_RCPT:
+            if message.recipient is None:
+                message.recipient = strip_address(split_strings(data)[0])
+        elif command == SMFIC_HEADER:
+            self.add_header_line(data, message)
+            # An MTA which didn't agree to send headers without waiting for a reply waits for one
+            return [] if options.protocol & SMFIP_NR_HDR else [(SMFIR_CONTINUE,)]
+        elif command == SMFIC_EOH:
+            return await self.end_of_headers(client, message)
+        elif command == SMFIC_BODYEOB:
+            replies = []
+            if message.add_header and options.actions & SMFIF_ADDHDRS:
+                # Postgrey's PREPEND, so inserted before the first header
+                name, _, value = message.add_header.partition(':')
+                header = b'%s\0%s\0' % (name.encode(), value.strip().encode())
+                replies.append((SMFIR_INSHEADER, struct.pack('>I', 0) + header))
+            elif message.add_header:
+                logger.warning('The MTA does not let the milter add headers, not adding: %s', message.add_header)
+            message.reset()
+            return replies + [(SMFIR_CONTINUE,)]
+
+        return [(SMFIR_CONTINUE,)]
+
+    def add_header_line(self, data, message):
+        # The header scan stops at the handler's limit, no need to keep more
+        if message.skip_scoring or message.header_bytes > self.handler.max_header_bytes:
+            return
+
+        name, _, value = data.partition(b'\0')
+        line = b'%s: %s\r\n' % (name, value.rstrip(b'\0').replace(b'\r\n', b'\n').replace(b'\n', b'\r\n'))
+        message.headers.append(line)
+        message.header_bytes += len(line)
+
+    async def end_of_headers(self, client, message):
+        headers, message.headers = message.headers, []
+
+        if not message.skip_scoring:
+            status = self.handler.get_spam_status(b''.join(headers) + b'\r\n')
+            if not self.handler.status_conditions_met(status):
+                return [(SMFIR_CONTINUE,)]
+
+        client_ip = client.get('addr')
+        if not client_ip or not message.recipient:
+            logger.debug('No client address or recipient, not greylisting')
+            return [(SMFIR_CONTINUE,)]
+
+        try:
+            response = await self.handler.lookup_triplet(message.recipient, message.sender or '', client_ip,
+                                                         client.get('name') or 'unknown')
+        except Exception as ex:
+            logger.error('Problem while checking with greylisting server: %s', ex)
+            return [(SMFIR_CONTINUE,)]
+
+        do_grey = response.split(' ', 1)
+        if do_grey[0].endswith('DEFER_IF_PERMIT'):
+            logger.info('Greylisting message %s', client.get('i', ''))
+            text = do_grey[1] if len(do_grey) > 1 else 'greylisted'
+            return [(SMFIR_REPLYCODE, b'451 4.7.1 %s\0' % text.encode())]
+        elif do_grey[0].endswith('PREPEND') and len(do_grey) > 1:
+            message.add_header = do_grey[1]
+
+        return [(SMFIR_CONTINUE,)]
@@ -0,0 +1,114 @@
+"""
+Postfix policy delegation server (check_policy_service) giving the
+greylisting decision at the END-OF-MESSAGE stage, so that no before-queue
+proxy and re-injection is needed.
+
+The policy protocol carries no message content, and smtpd evaluates
+smtpd_end_of_data_restrictions before the message reaches cleanup, where
+milters see the headers, so the spam status of a message is never known
+here. The decision is made on what the request carries: clients over
+their rate limit are temporarily refused, or greylisted without being
+scored, as the proxy does, and everything else is answered DUNNO.
+"""
+import asyncio
+import logging
+
+from .defaults import RATE_LIMIT_REPLY
+from .ratelimit import GREYLIST, TEMPFAIL
+
+logger = logging.getLogger('SpamFilterProxy')
+
+DUNNO = 'action=DUNNO'
+END_OF_MESSAGE = 'END-OF-MESSAGE'
+RATE_LIMIT_ACTION = 'action=%s' % RATE_LIMIT_REPLY
+
+
+async def read_request(reader):
+    """
+    Read one policy request, returning a dict of its attributes, or None
+    once the client has closed the connection
+    """
+    request = {}
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            return None
+        if line == b'\n':
+            return request
+        name, _, value = line.decode('utf8', errors='replace').rstrip('\n').partition('=')
+        request[name] = value
+
+
+class PolicyServer:
+    """
+    Answers policy requests for the clients the handler's rate limit
+    greylists with the Postgrey reply, see the module documentation.
+    Postfix keeps its connections to the policy service open, so each
+    connection serves requests until it is closed or idle for too long.
+    """
+
+    def __init__(self, handler, idle_timeout=600):
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self._connections = set()
+
+    async def start(self, host='127.0.0.1', port=10040):
+        self.server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for task in self._connections:
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request = await asyncio.wait_for(read_request(reader), self.idle_timeout)
+                if request is None:
+                    break
+
+                action = await self.decide(request)
+                writer.write(b'%s\n\n' % action.encode())
+                await writer.drain()
+        except asyncio.TimeoutError:
+            logger.debug('Closing idle policy connection')
+        except ConnectionError as ex:
+            logger.debug('Policy connection lost: %s', ex)
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    async def decide(self, request):
+        if request.get('protocol_state') != END_OF_MESSAGE:
+            return DUNNO
+
+        client_ip = request.get('client_address')
+        action = await self.handler.check_client_rate(client_ip)
+        if action == TEMPFAIL:
+            return RATE_LIMIT_ACTION
+        if action != GREYLIST:
+            return DUNNO
+
+        # Postfix only gives the recipient here for single-recipient messages
+        recipient = request.get('recipient')
+        if not recipient or not client_ip:
+            logger.debug('No client address or recipient for queue id %s, not greylisting', request.get('queue_id'))
+            return DUNNO
+
+        try:
+            response = await self.handler.lookup_triplet(recipient, request.get('sender', ''), client_ip,
+                                                         request.get('client_name') or 'unknown')
+        except Exception as ex:
+            logger.error('Problem while checking with greylisting server: %s', ex)
+            return DUNNO
+
+        return response if response.startswith('action=') else DUNNO
@@ -1,49 +1,182 @@
-#!/usr/bin/env python3
+"""
+Client for Postgrey's policy protocol.
+
+Also a command line tool to query Postgrey or load test it, run as
+`python -m greylistfilter.postgrey_client`.
+"""
 import argparse
 import asyncio
+import collections
+import time
+
+from .defaults import DEFAULT_TIMEOUT
+
+# Prefix of a host naming a Unix domain socket, as for Postgrey's --unix
+UNIX_PREFIX = 'unix:'
+
 
+class PolicyError(Exception):
+    pass
 
-async def greylist_status(recipient, sender, client_ip, client_name, host='127.0.0.1', port=10023):
-    reader, writer = await asyncio.open_connection(host, port)
 
-    data = (b'request=smtpd_access_policy\n'
+def encode_request(recipient, sender, client_ip, client_name):
+    return (b'request=smtpd_access_policy\n'
             b'recipient=%s\n'
             b'sender=%s\n'
             b'client_address=%s\n'
             b'client_name=%s\n'
             b'\n') % (recipient.encode(), sender.encode(), client_ip.encode(), client_name.encode())
 
-    writer.write(data)
-    await writer.drain()
 
+async def read_reply(reader):
+    """
+    Read a policy server reply, up to the terminating empty line, and
+    return its last attribute line
+    """
     reply = b''
     while True:
         line = await reader.readline()
         if line == b'\n':
             break
+        if not line:
+            raise PolicyError('Connection closed before end of reply')
         reply = line
 
-    writer.close()
-    print(reply)
     return reply.decode().rstrip()
 
 
+def open_policy_connection(host, port):
+    """
+    Connect to the policy server on `host` and `port`, or on the Unix
+    socket named by a host such as 'unix:/var/run/postgrey.sock'
+    """
+    if host.startswith(UNIX_PREFIX):
+        return asyncio.open_unix_connection(host[len(UNIX_PREFIX):])
+    return asyncio.open_connection(host, port)
+
+
+async def _query(data, host, port):
+    reader, writer = await open_policy_connection(host, port)
+
+    try:
+        writer.write(data)
+        await writer.drain()
+        return await read_reply(reader)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def greylist_status(recipient, sender, client_ip, client_name, host='127.0.0.1', port=10023,
+                          timeout=DEFAULT_TIMEOUT):
+    """
+    Ask the policy server about the triplet, returning the reply line,
+    e.g. 'action=DUNNO'. Raises asyncio.TimeoutError if there is no complete
+    reply within `timeout` seconds.
+    """
+    data = encode_request(recipient, sender, client_ip, client_name)
+
+    return await asyncio.wait_for(_query(data, host, port), timeout)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of the sorted list `values`
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+async def run_bench(host='127.0.0.1', port=10023, requests=1000, concurrency=10, timeout=DEFAULT_TIMEOUT,
+                    triplets=100):
+    """
+    Fire `requests` lookups at the policy server, `concurrency` at a time,
+    cycling through `triplets` distinct triplets. Returns the statistics.
+    """
+    latencies = []
+    actions = collections.Counter()
+    errors = collections.Counter()
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            n = i % triplets
+            start = time.perf_counter()
+            try:
+                reply = await greylist_status('rcpt%d@bench.test' % n, 'sender%d@bench.test' % n,
+                                              '192.0.2.%d' % (n % 254 + 1), 'host%d.bench.test' % n,
+                                              host, port, timeout)
+            except Exception as ex:
+                errors[type(ex).__name__] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            actions[reply.split(' ', 1)[0]] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    return {
+        'requests': requests,
+        'completed': len(latencies),
+        'errors': dict(errors),
+        'actions': dict(actions),
+        'seconds': elapsed,
+        'qps': len(latencies) / elapsed if elapsed else 0.0,
+        'latency': {name: percentile(latencies, fraction)
+                    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+    }
+
+
+def print_bench(stats):
+    print('%d/%d requests completed in %.2fs: %.1f requests/s' % (
+        stats['completed'], stats['requests'], stats['seconds'], stats['qps']))
+    print('latency: %s' % ', '.join('%s=%.2fms' % (name, stats['latency'][name] * 1000)
+                                    for name in ('p50', 'p90', 'p99', 'max')))
+    for action, count in sorted(stats['actions'].items()):
+        print('  %s: %d' % (action, count))
+    for error, count in sorted(stats['errors'].items()):
+        print('  error %s: %d' % (error, count))
+
+
 if __name__ == '__main__':  # pragma: no cover
     parser = argparse.ArgumentParser(description='Postgrey client.')
     parser.add_argument('-s', '--server', default='127.0.0.1',
-                        help='Name or IP of the Postgrey server. Default: %(default)s')
+                        help='Name or IP of the Postgrey server, or unix:/path for its Unix socket. '
+                             'Default: %(default)s')
     parser.add_argument('-p', '--port', type=int, default=10023,
                         help='Port of the Postgrey server. Default: %(default)s')
-    parser.add_argument('recipient', help='Recipient email address')
-    parser.add_argument('sender', help='Sender email address')
-    parser.add_argument('address', help='Client IP address')
-    parser.add_argument('hostname', help='Client hostname')
+    parser.add_argument('-t', '--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Seconds to wait for a reply. Default: %(default)s')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
 
-    args = parser.parse_args()
+    query = subparsers.add_parser('query', help='Look up a single triplet')
+    query.add_argument('recipient', help='Recipient email address')
+    query.add_argument('sender', help='Sender email address')
+    query.add_argument('address', help='Client IP address')
+    query.add_argument('hostname', help='Client hostname')
+
+    bench = subparsers.add_parser('bench', help='Load test the policy server')
+    bench.add_argument('-n', '--requests', type=int, default=1000,
+                       help='Total number of lookups. Default: %(default)s')
+    bench.add_argument('-c', '--concurrency', type=int, default=10,
+                       help='Lookups in flight at a time. Default: %(default)s')
+    bench.add_argument('--triplets', type=int, default=100,
+                       help='Number of distinct triplets to cycle through. Default: %(default)s')
 
-    loop = asyncio.get_event_loop()
-    result = loop.run_until_complete(greylist_status(
-        args.recipient, args.sender, args.address, args.hostname, args.server, args.port))
-    loop.close()
+    args = parser.parse_args()
 
-    print(result)
+    if args.command == 'query':
+        print(asyncio.run(greylist_status(
+            args.recipient, args.sender, args.address, args.hostname, args.server, args.port, args.timeout)))
+    else:
+        print_bench(asyncio.run(run_bench(
+            args.server, args.port, args.requests, args.concurrency, args.timeout, args.triplets)))
@@ -0,0 +1,139 @@
+"""
+Per-client message rates, counted in constant memory.
+
+Messages are counted per client network in a ring of count-min sketches,
+one per slice of the sliding window, so that memory doesn't grow with the
+number of clients seen. Estimates can only err on the high side, by at
+most a small fraction of the total count. The heaviest clients are also
+tracked by name, to be reported.
+"""
+import array
+import hashlib
+import ipaddress
+import struct
+import time
+
+TEMPFAIL = 'tempfail'
+TARPIT = 'tarpit'
+GREYLIST = 'greylist'
+ACTIONS = (TEMPFAIL, TARPIT, GREYLIST)
+
+
+class CountMinSketch:
+    """
+    `depth` rows of `width` counters, each row indexed by its own hash
+    """
+
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self._unpack = struct.Struct('<%dI' % depth).unpack
+        self.counters = array.array('I', bytes(4 * width * depth))
+
+    def indexes(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.depth).digest()
+        return [row * self.width + h % self.width for row, h in enumerate(self._unpack(digest))]
+
+    def add(self, indexes, count=1):
+        for index in indexes:
+            self.counters[index] += count
+
+    def estimate(self, indexes):
+        return min(self.counters[index] for index in indexes)
+
+    def clear(self):
+        self.counters = array.array('I', bytes(4 * self.width * self.depth))
+
+
+class ClientRateLimit:
+    """
+    Counts messages per client network over a sliding window of `window`
+    seconds, and tells which `action` to take against clients sending more
+    than `limit` of them:
+
+    tempfail   temporarily reject the transaction straight away
+    tarpit     delay the reply by `tarpit_delay` seconds
+    greylist   skip the header scan and go straight to the greylist lookup
+
+    Clients are grouped by IPv4 /`ipv4_prefix` and IPv6 /`ipv6_prefix`.
+    """
+
+    def __init__(self, limit, action=TEMPFAIL, window=60, tarpit_delay=10, ipv4_prefix=32, ipv6_prefix=64,
+                 slices=6, width=4096, depth=4, top=20, clock=time.monotonic):
+        if action not in ACTIONS:
+            raise ValueError('Unknown rate limit action: %s' % action)
+
+        self.limit = limit
+        self.action = action
+        self.window = window
+        self.tarpit_delay = tarpit_delay
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.top = top
+        self.clock = clock
+        self.limited = 0
+
+        self._slice_length = window / slices
+        self._sketches = [CountMinSketch(width, depth) for _ in range(slices)]
+        self._slice = int(clock() // self._slice_length)
+        self._heavy = {}
+
+    def client_key(self, addr):
+        try:
+            ip = ipaddress.ip_address(addr)
+        except ValueError:
+            return addr
+        prefix = self.ipv4_prefix if ip.version == 4 else self.ipv6_prefix
+        return str(ipaddress.ip_network((ip, prefix), strict=False))
+
+    def _advance(self):
+        current = int(self.clock() // self._slice_length)
+        # clear the slices which have left the window since the last call
+        for n in range(max(self._slice + 1, current - len(self._sketches) + 1), current + 1):
+            self._sketches[n % len(self._sketches)].clear()
+        if current > self._slice:
+            # age the heaviest clients with the window, so that a past burst doesn't keep its place
+            self._slice = current
+            estimates = ((key, self._estimate(self._sketches[0].indexes(key))) for key in self._heavy)
+            self._heavy = {key: estimate for key, estimate in estimates if estimate}
+
+    def _estimate(self, indexes):
+        return min(sum(sketch.counters[index] for sketch in self._sketches) for index in indexes)
+
+    def count(self, addr):
+        """
+        Count a message from `addr`, returning the estimated number of
+        messages from its network within the window
+        """
+        self._advance()
+        key = self.client_key(addr)
+        indexes = self._sketches[0].indexes(key)
+        self._sketches[self._slice % len(self._sketches)].add(indexes)
+        estimate = self._estimate(indexes)
+
+        if key in self._heavy or len(self._heavy) < self.top or estimate > min(self._heavy.values()):
+            self._heavy[key] = estimate
+            if len(self._heavy) > self.top:
+                del self._heavy[min(self._heavy, key=self._heavy.get)]
+
+        return estimate
+
+    def check(self, addr):
+        """
+        Count a message from `addr`, returning the action to take against
+        it or None
+        """
+        if not addr:
+            return None
+        if self.count(addr) <= self.limit:
+            return None
+        self.limited += 1
+        return self.action
+
+    def top_clients(self):
+        """
+        The heaviest client networks with their current estimates, heaviest first
+        """
+        self._advance()
+        estimates = ((key, self._estimate(self._sketches[0].indexes(key))) for key in self._heavy)
+        return sorted(((key, count) for key, count in estimates if count), key=lambda item: -item[1])
@@ -0,0 +1,281 @@
+"""
+Clients for the relay which accepted mail is handed on to.
+
+The relay is named as one of
+
+    host:port           SMTP over TCP
+    unix:/path          SMTP over a Unix domain socket
+    lmtp:host:port      LMTP over TCP, also lmtp:inet:host:port
+    lmtp:unix:/path     LMTP over a Unix domain socket
+
+the LMTP forms being those of Postfix's lmtp(8) destinations. Re-injecting
+into a Postfix on the same host over a Unix socket avoids the TCP/IP
+stack, and LMTP answers for each recipient rather than queueing.
+
+A relay on another host is best reached through a RelayPool, which keeps
+connections open between messages and can secure them with STARTTLS, so
+that neither the connection nor the TLS handshake is paid for every
+message.
+"""
+import collections
+import smtplib
+import socket
+import ssl
+import threading
+import time
+
+from .relayaddress import LMTP, parse_relay_address
+
+
+def connect_unix(client, path):
+    """
+    Connect an smtplib client to the Unix socket at `path`, returning the
+    server's greeting
+    """
+    client.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if client.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            client.sock.settimeout(client.timeout)
+        client.file = None
+        client.sock.connect(path)
+    except OSError:
+        client.sock.close()
+        client.sock = None
+        raise
+    return client.getreply()
+
+
+class UnixSMTP(smtplib.SMTP):
+    """
+    SMTP client on a Unix socket, named by the host
+    """
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        return connect_unix(self, host)
+
+
+class LMTPClient(smtplib.LMTP):
+    """
+    LMTP client which reads the reply to the end of data given for each
+    accepted recipient (RFC 2033, section 4.2), where smtplib only reads
+    the first. Recipients refused at that point are returned by sendmail
+    along with those refused at RCPT; if none was delivered, it raises
+    SMTPRecipientsRefused with every recipient's own reply, as smtplib
+    does when all are refused at RCPT.
+    """
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self._accepted = []
+        self._data_refused = {}
+        refused = super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        refused.update(self._data_refused)
+        if len(self._data_refused) == len(self._accepted):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def rcpt(self, recip, options=()):
+        code, resp = super().rcpt(recip, options)
+        if code in (250, 251):
+            self._accepted.append(recip)
+        return code, resp
+
+    def data(self, msg):
+        reply = super().data(msg)
+        replies = [reply] + [self.getreply() for _ in self._accepted[1:]]
+
+        for recip, (code, resp) in zip(self._accepted, replies):
+            if code != 250:
+                self._data_refused[recip] = (code, resp)
+
+        # Whether any recipient was delivered is for sendmail to tell, from the replies
+        return 250, reply[1]
+
+
+def connect_relay(relay, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    """
+    Return an smtplib client connected to the relay
+    """
+    address = parse_relay_address(relay)
+
+    if address.protocol == LMTP:
+        # smtplib.LMTP takes a host starting with '/' as a Unix socket
+        return LMTPClient(address.path or address.host, address.port or 0, timeout=timeout)
+    if address.path:
+        return UnixSMTP(address.path, timeout=timeout)
+    return smtplib.SMTP(address.host, address.port, timeout=timeout)
+
+
+def make_tls_context(cafile=None, verify=True):
+    """
+    The client SSL context shared by all relay connections. A relay with a
+    self-signed certificate is verified against that certificate as the
+    `cafile`.
+    """
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+IdleClient = collections.namedtuple('IdleClient', 'relay client since messages')
+
+
+class RelayPool:
+    """
+    Connections to the relay kept open between messages, at most `size` of
+    them idle at a time, each for at most `max_idle` seconds and
+    `max_messages` messages. As Postfix's SMTP connection cache does, an
+    idle connection is probed with RSET before it is used again.
+
+    With a `tls_context`, every connection is secured with STARTTLS, and
+    resumes the TLS session of the previous one so that even a new
+    connection is spared the full handshake. The relay's certificate is
+    checked against `tls_name`, by default the relay's host name; a relay
+    on a Unix socket has none, so it needs a `tls_name` unless the context
+    doesn't check host names.
+
+    The pool is used from the lanes' relay threads, so it is thread safe.
+    """
+
+    def __init__(self, size=4, tls_context=None, max_idle=60, max_messages=100, timeout=60, clock=time.monotonic,
+                 tls_name=None):
+        self.size = size
+        self.tls_context = tls_context
+        self.tls_name = tls_name
+        self.max_idle = max_idle
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.clock = clock
+        self.opened = 0
+        self.reused = 0
+        self.tls_resumed = 0
+
+        self._idle = collections.deque()
+        self._tls_sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def send(self, relay, mail_from, rcpt_tos, data):
+        """
+        Send a message to the relay as smtplib's sendmail does
+        """
+        client, messages = self._checkout(relay)
+        try:
+            refused = client.sendmail(mail_from, rcpt_tos, data)
+        except Exception:
+            client.close()
+            raise
+
+        self._checkin(relay, client, messages + 1)
+        return refused
+
+    def connect(self, relay):
+        client = connect_relay(relay, self.timeout)
+        try:
+            if self.tls_context is not None:
+                self.starttls(relay, client)
+        except Exception:
+            client.close()
+            raise
+
+        with self._lock:
+            self.opened += 1
+        return client
+
+    def starttls(self, relay, client):
+        """
+        Secure the connection, as smtplib's starttls does, but resuming the
+        last TLS session established with the relay
+        """
+        client.ehlo_or_helo_if_needed()
+        if not client.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by the relay')
+
+        server_hostname = self.tls_name or parse_relay_address(relay).host
+        if server_hostname is None and self.tls_context.check_hostname:
+            raise smtplib.SMTPException('No TLS name to check the certificate of the relay on %s against' % relay)
+
+        code, resp = client.docmd('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, resp)
+
+        client.sock = self.tls_context.wrap_socket(client.sock, server_hostname=server_hostname,
+                                                   session=self._tls_sessions.get(relay))
+        client.file = None
+        client.helo_resp = None
+        client.ehlo_resp = None
+        client.esmtp_features = {}
+        client.does_esmtp = False
+        client.ehlo()
+
+        # Only now, after a reply has been read, has a TLS 1.3 server's session ticket arrived
+        with self._lock:
+            self._tls_sessions[relay] = client.sock.session
+            if client.sock.session_reused:
+                self.tls_resumed += 1
+
+    def _checkout(self, relay):
+        while True:
+            with self._lock:
+                idle = self._idle.pop() if self._idle else None
+            if idle is None:
+                return self.connect(relay), 0
+
+            if idle.relay != relay or self.clock() - idle.since > self.max_idle:
+                self._quit(idle.client)
+                continue
+
+            try:
+                code, _ = idle.client.rset()
+            except (smtplib.SMTPException, OSError):
+                code = None
+            if code == 250:
+                with self._lock:
+                    self.reused += 1
+                return idle.client, idle.messages
+            idle.client.close()
+
+    def _checkin(self, relay, client, messages):
+        if messages < self.max_messages:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(IdleClient(relay, client, self.clock(), messages))
+                    return
+        self._quit(client)
+
+    def _quit(self, client):
+        try:
+            client.quit()
+        except (smtplib.SMTPException, OSError):
+            client.close()
+
+    def _quit_all(self, idle):
+        for entry in idle:
+            self._quit(entry.client)
+
+    def resize(self, size):
+        """
+        Change the number of idle connections kept, quitting any over it
+        """
+        with self._lock:
+            self.size = size
+            excess = [self._idle.popleft() for _ in range(max(0, len(self._idle) - size))]
+        if excess:
+            # Called from the event loop's thread, which mustn't wait for the relay's replies
+            threading.Thread(target=self._quit_all, args=(excess,), name='relay-pool-resize', daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        self._quit_all(idle)
+
+    def metrics(self):
+        return {
+            'relay_connections_opened': self.opened,
+            'relay_connections_reused': self.reused,
+            'relay_connections_idle': len(self._idle),
+            'relay_tls_resumed': self.tls_resumed,
+        }
@@ -0,0 +1,49 @@
+"""
+Names of the relay, as described in the relay module, parsed without
+importing the relay client, so that checking the configuration doesn't
+pull in smtplib and ssl.
+"""
+import collections
+
+SMTP = 'smtp'
+LMTP = 'lmtp'
+
+LMTP_PREFIX = 'lmtp:'
+UNIX_PREFIX = 'unix:'
+INET_PREFIX = 'inet:'
+
+# As smtplib.SMTP_PORT and smtplib.LMTP_PORT
+DEFAULT_PORTS = {SMTP: 25, LMTP: 2003}
+
+# The host and port for TCP, or the path of a Unix socket
+RelayAddress = collections.namedtuple('RelayAddress', 'protocol host port path')
+
+
+def parse_relay_address(value):
+    """
+    Parse a relay name as described in the relay module's documentation.
+    Raises ValueError if it can't be understood.
+    """
+    protocol = SMTP
+    if value.startswith(LMTP_PREFIX):
+        protocol, value = LMTP, value[len(LMTP_PREFIX):]
+
+    if value.startswith(UNIX_PREFIX):
+        path = value[len(UNIX_PREFIX):]
+        if not path.startswith('/'):
+            raise ValueError('the relay socket path must be absolute: %s' % path)
+        return RelayAddress(protocol, None, None, path)
+
+    if protocol == LMTP and value.startswith(INET_PREFIX):
+        value = value[len(INET_PREFIX):]
+    host, sep, port = value.rpartition(':')
+    if not sep:
+        host, port = value, DEFAULT_PORTS[protocol]
+    elif port.isdigit():
+        port = int(port)
+    else:
+        host = None
+    if not host:
+        raise ValueError('the relay must be host:port, unix:/path or lmtp:...: %s' % value)
+
+    return RelayAddress(protocol, host, port, None)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Offline replay of a mail corpus through the greylisting conditions, to see
+how many messages a given set of --spam/--dcc thresholds would greylist.
+
+Only the headers of each message are copied out of the memory-mapped
+corpus, and they are scanned across a pool of worker processes.
+"""
+import argparse
+import itertools
+import mmap
+import multiprocessing
+import os
+import time
+
+from .config import parse_dcc_threshold
+from .smtpproxy import DCC_MANY, PostfixProxyHandler
+
+_worker = {}
+
+
+def header_block(buf, start, end):
+    """
+    Return the header part, including the separating blank line, of the
+    message at buf[start:end]
+    """
+    lf = buf.find(b'\n\n', start, end)
+    crlf = buf.find(b'\n\r\n', start, end)
+
+    if lf == -1 and crlf == -1:
+        return buf[start:end]
+    if crlf == -1 or -1 < lf < crlf:
+        return buf[start:lf + 2]
+    return buf[start:crlf + 3]
+
+
+def mbox_spans(buf):
+    """
+    Generate the (start, end) offsets of the messages in an mbox buffer
+    """
+    if buf[:5] == b'From ':
+        start = 0
+    else:
+        start = buf.find(b'\nFrom ')
+        if start == -1:
+            return
+        start += 1
+
+    while True:
+        pos = buf.find(b'\nFrom ', start)
+        if pos == -1:
+            yield start, len(buf)
+            return
+        yield start, pos + 1
+        start = pos + 1
+
+
+def maildir_files(path):
+    for subdir in ('cur', 'new'):
+        folder = os.path.join(path, subdir)
+        for name in sorted(os.listdir(folder)):
+            if not name.startswith('.'):
+                yield os.path.join(folder, name)
+
+
+def is_maildir(path):
+    return os.path.isdir(os.path.join(path, 'cur')) and os.path.isdir(os.path.join(path, 'new'))
+
+
+def map_file(path):
+    with open(path, 'rb') as input:
+        size = os.fstat(input.fileno()).st_size
+        if size == 0:
+            return None
+        return mmap.mmap(input.fileno(), size, access=mmap.ACCESS_READ)
+
+
+def _init_worker(mbox_path=None):
+    _worker['handler'] = PostfixProxyHandler(None, 0, 0)
+    _worker['mbox'] = map_file(mbox_path) if mbox_path else None
+
+
+def _status(header):
+    status = _worker['handler'].get_spam_status(header)
+    return status['spam'], status['dcc'], len(header)
+
+
+def _scan_spans(spans):
+    buf = _worker['mbox']
+    return [_status(header_block(buf, start, end)) for start, end in spans]
+
+
+def _scan_files(paths):
+    results = []
+    for path in paths:
+        buf = map_file(path)
+        if buf is None:
+            continue
+        with buf:
+            results.append(_status(header_block(buf, 0, len(buf))))
+    return results
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def replay(path, thresholds, processes=None, chunksize=500):
+    """
+    Scan the mbox file or Maildir at `path`, counting for each (spam, dcc)
+    pair in `thresholds` how many messages would be greylisted.
+
+    With `processes` set to 0 everything is done in this process.
+    """
+    start_time = time.monotonic()
+    mbox = None
+
+    if is_maildir(path):
+        initargs = ()
+        scan = _scan_files
+        chunks = chunked(maildir_files(path), chunksize)
+    else:
+        initargs = (path,)
+        scan = _scan_spans
+        mbox = map_file(path)
+        chunks = chunked(mbox_spans(mbox) if mbox is not None else (), chunksize)
+
+    handlers = [(threshold, PostfixProxyHandler(None, *threshold)) for threshold in thresholds]
+    greylisted = {threshold: 0 for threshold in thresholds}
+    messages = 0
+    header_bytes = 0
+
+    if processes == 0:
+        _init_worker(*initargs)
+        results = map(scan, chunks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, initargs)
+        results = pool.imap_unordered(scan, chunks)
+
+    try:
+        for result in results:
+            for spam, dcc, size in result:
+                messages += 1
+                header_bytes += size
+                status = {'spam': spam, 'dcc': dcc}
+                for threshold, handler in handlers:
+                    if handler.status_conditions_met(status):
+                        greylisted[threshold] += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if mbox is not None:
+            mbox.close()
+
+    return {
+        'messages': messages,
+        'header_bytes': header_bytes,
+        'seconds': time.monotonic() - start_time,
+        'greylisted': greylisted,
+    }
+
+
+def check_dcc_type(value):
+    try:
+        return parse_dcc_threshold(value)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+def print_report(report):
+    messages = report['messages']
+    seconds = report['seconds'] or 1e-9
+
+    print('%-10s %-8s %10s %8s' % ('spam', 'dcc', 'greylisted', 'rate'))
+    for (spam, dcc), count in sorted(report['greylisted'].items()):
+        rate = 100.0 * count / messages if messages else 0.0
+        print('%-10g %-8s %10d %7.2f%%' % (spam, 'many' if dcc == DCC_MANY else dcc, count, rate))
+
+    print()
+    print('%d messages in %.2fs: %.0f msg/s, %.2f MB/s of headers' % (
+        messages, report['seconds'], messages / seconds, report['header_bytes'] / seconds / 2**20))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Replay a mail corpus through the greylisting conditions.')
+    parser.add_argument('-s', '--spam', type=float, nargs='+', default=[1.0],
+                        help='SpamAssassin score thresholds to evaluate. Default: %(default)s')
+    parser.add_argument('-d', '--dcc', type=check_dcc_type, nargs='+', default=[2],
+                        help='DCC score thresholds to evaluate (2-many). Default: %(default)s')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Number of worker processes, 0 to scan in-process. Default: number of CPUs')
+    parser.add_argument('--chunksize', type=int, default=500,
+                        help='Messages handed to a worker at a time. Default: %(default)s')
+    parser.add_argument('corpus', help='mbox file or Maildir directory')
+
+    args = parser.parse_args()
+
+    thresholds = list(itertools.product(args.spam, args.dcc))
+    print_report(replay(args.corpus, thresholds, args.processes, args.chunksize))
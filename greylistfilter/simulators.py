@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+In-process simulators of Postgrey and of the relay, for testing timeouts,
+pooling and backpressure under realistic degradation without external
+services.
+
+Both answer after a delay drawn from a latency distribution, and may
+inject faults at given rates: an error reply, a connection reset with no
+reply, or a stall, never answering at all. The Postgrey simulator keeps
+the state of each triplet as Postgrey does: deferred until `delay` seconds
+after it was first seen, then let through once with an X-Greylist header,
+then let through.
+
+Like the other servers they have `start(host, port)` and `stop()`
+coroutines, so they can be run by a ServerController, or standalone:
+
+    python -m greylistfilter.simulators postgrey --port 10023 --latency lognormal:0.02,0.8 --stall-rate 0.01
+    python -m greylistfilter.simulators relay --port 10026 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import math
+import random
+import time
+
+from aiosmtpd.lmtp import LMTP
+from aiosmtpd.smtp import SMTP
+
+from .policyserver import read_request
+from .postgrey_client import UNIX_PREFIX
+
+logger = logging.getLogger('SpamFilterProxy')
+
+RESET = 'reset'
+STALL = 'stall'
+ERROR = 'error'
+
+GREYLIST_TEXT = 'Greylisted by the Postgrey simulator'
+
+
+class Latency:
+    """
+    Distribution of response times in seconds, one of
+
+        fixed:seconds
+        uniform:low,high
+        normal:mean,stddev
+        lognormal:median,sigma
+        exponential:mean
+
+    A bare number is a fixed latency.
+    """
+
+    PARAMETERS = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2, 'exponential': 1}
+
+    def __init__(self, kind='fixed', *params):
+        if kind not in self.PARAMETERS:
+            raise ValueError('unknown latency distribution: %s' % kind)
+        if len(params) != self.PARAMETERS[kind]:
+            raise ValueError('%s latency takes %d parameters' % (kind, self.PARAMETERS[kind]))
+        self.kind = kind
+        self.params = params
+
+    def __repr__(self):
+        return '%s:%s' % (self.kind, ','.join('%g' % param for param in self.params))
+
+    @classmethod
+    def parse(cls, spec):
+        kind, sep, params = spec.partition(':')
+        if not sep:
+            kind, params = 'fixed', spec
+        try:
+            return cls(kind, *(float(param) for param in params.split(',')))
+        except ValueError as ex:
+            raise ValueError('invalid latency %r: %s' % (spec, ex))
+
+    def sample(self, rng):
+        if self.kind == 'fixed':
+            value = self.params[0]
+        elif self.kind == 'uniform':
+            value = rng.uniform(*self.params)
+        elif self.kind == 'normal':
+            value = rng.gauss(*self.params)
+        elif self.kind == 'lognormal':
+            value = rng.lognormvariate(math.log(self.params[0]), self.params[1])
+        else:
+            value = rng.expovariate(1 / self.params[0])
+        return max(0.0, value)
+
+
+class Simulator:
+    """
+    The latency and faults common to both simulators. `stats` counts the
+    requests and the faults injected.
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, reset_rate=0.0, stall_rate=0.0, seed=None):
+        self.latency = latency or Latency('fixed', 0.0)
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.stall_rate = stall_rate
+        self.rng = random.Random(seed)
+        self.stats = collections.Counter()
+        self.port = None
+
+    def fault(self):
+        """
+        Draw the fault to inject into the next reply, if any
+        """
+        draw = self.rng.random()
+        for fault, rate in ((RESET, self.reset_rate), (STALL, self.stall_rate), (ERROR, self.error_rate)):
+            if draw < rate:
+                self.stats[fault] += 1
+                return fault
+            draw -= rate
+        return None
+
+    async def respond(self):
+        """
+        Wait for the latency, returning the fault to inject. A stall waits
+        until the connection is cancelled.
+        """
+        self.stats['requests'] += 1
+        fault = self.fault()
+        await asyncio.sleep(self.latency.sample(self.rng))
+        if fault == STALL:
+            await asyncio.Event().wait()
+        return fault
+
+
+class PostgreySimulator(Simulator):
+    """
+    Policy server greylisting as Postgrey does, see the module documentation
+    """
+
+    def __init__(self, delay=300, latency=None, error_rate=0.0, reset_rate=0.0, stall_rate=0.0, seed=None,
+                 greylist_text=GREYLIST_TEXT, error_reply='action=DEFER_IF_PERMIT Server error',
+                 clock=time.monotonic):
+        super().__init__(latency, error_rate, reset_rate, stall_rate, seed)
+        self.delay = delay
+        self.greylist_text = greylist_text
+        self.error_reply = error_reply
+        self.clock = clock
+        self.requests = []
+        # triplet: (first seen, passed)
+        self.triplets = {}
+        self.server = None
+        self._connections = set()
+
+    async def start(self, host='127.0.0.1', port=10023):
+        if host.startswith(UNIX_PREFIX):
+            self.server = await asyncio.start_unix_server(self.handle_connection, host[len(UNIX_PREFIX):])
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+            self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for task in self._connections:
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    def decide(self, request):
+        """
+        The action for a request, updating the triplet's state
+        """
+        triplet = (request.get('client_address'), request.get('sender', '').lower(),
+                   request.get('recipient', '').lower())
+        now = self.clock()
+        first_seen, passed = self.triplets.get(triplet, (None, False))
+
+        if passed:
+            return 'action=DUNNO'
+        if first_seen is None:
+            self.triplets[triplet] = (now, False)
+            return 'action=DEFER_IF_PERMIT %s' % self.greylist_text
+        if now - first_seen < self.delay:
+            return 'action=DEFER_IF_PERMIT %s' % self.greylist_text
+
+        self.triplets[triplet] = (first_seen, True)
+        return 'action=PREPEND X-Greylist: delayed %d seconds by the Postgrey simulator' % (now - first_seen)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                self.requests.append(request)
+
+                fault = await self.respond()
+                if fault == RESET:
+                    writer.transport.abort()
+                    return
+                action = self.error_reply if fault == ERROR else self.decide(request)
+                self.stats[action.split(' ', 1)[0]] += 1
+                writer.write(b'%s\n\n' % action.encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+
+class RelaySimulator(Simulator):
+    """
+    SMTP or LMTP relay taking messages after a delay, or failing them with
+    the `error_reply`. `messages` lists the (sender, recipients, content)
+    of those taken. With a `tls_context`, STARTTLS is offered.
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, reset_rate=0.0, stall_rate=0.0, seed=None,
+                 error_reply='451 4.3.0 Simulated failure', lmtp=False, tls_context=None):
+        super().__init__(latency, error_rate, reset_rate, stall_rate, seed)
+        self.error_reply = error_reply
+        self.lmtp = lmtp
+        self.tls_context = tls_context
+        self.connections = 0
+        self.messages = []
+        self.server = None
+        self._protocols = set()
+
+    def factory(self):
+        protocol = (LMTP if self.lmtp else SMTP)(self, tls_context=self.tls_context)
+        self._protocols.add(protocol)
+        self.connections += 1
+        return protocol
+
+    async def start(self, host='127.0.0.1', port=10026):
+        loop = asyncio.get_event_loop()
+        if host.startswith(UNIX_PREFIX):
+            self.server = await loop.create_unix_server(self.factory, host[len(UNIX_PREFIX):])
+        else:
+            self.server = await loop.create_server(self.factory, host, port)
+            self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for protocol in self._protocols:
+                if protocol.transport is not None:
+                    protocol.transport.close()
+            self._protocols.clear()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_DATA(self, server, session, envelope):
+        fault = await self.respond()
+        if fault == RESET:
+            server.transport.abort()
+            return self.error_reply
+        if fault == ERROR:
+            replies = [self.error_reply]
+        else:
+            self.messages.append((envelope.mail_from, list(envelope.rcpt_tos), envelope.content))
+            replies = ['250 OK']
+
+        if self.lmtp:
+            # one reply for each recipient
+            replies = replies * len(envelope.rcpt_tos)
+        return '\r\n'.join(replies)
+
+
+def add_fault_arguments(parser):
+    parser.add_argument('-a', '--address', default='127.0.0.1',
+                        help='Hostname on which to listen, or unix:/path. Default: %(default)s')
+    parser.add_argument('--latency', type=Latency.parse, default=Latency('fixed', 0.0),
+                        help='Response time distribution, e.g. 0.01, uniform:0.01,0.1, normal:0.05,0.01, '
+                             'lognormal:0.02,0.8 or exponential:0.05. Default: %(default)s')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of error replies')
+    parser.add_argument('--reset-rate', type=float, default=0.0, help='Fraction of connections reset')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='Fraction of requests never answered')
+    parser.add_argument('--seed', type=int, help='Random seed, for reproducible runs')
+
+
+async def serve(simulator, host, port):
+    await simulator.start(host, port)
+    logger.info('Simulator listening on %s:%s', host, simulator.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await simulator.stop()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Postgrey and relay simulators.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    postgrey = subparsers.add_parser('postgrey', help='Simulate Postgrey')
+    postgrey.add_argument('-p', '--port', type=int, default=10023, help='Port. Default: %(default)s')
+    postgrey.add_argument('--delay', type=int, default=300,
+                          help='Seconds a triplet is greylisted for. Default: %(default)s')
+    add_fault_arguments(postgrey)
+
+    relay = subparsers.add_parser('relay', help='Simulate the relay')
+    relay.add_argument('-p', '--port', type=int, default=10026, help='Port. Default: %(default)s')
+    relay.add_argument('--lmtp', action='store_true', help='Speak LMTP rather than SMTP')
+    add_fault_arguments(relay)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    faults = (args.latency, args.error_rate, args.reset_rate, args.stall_rate, args.seed)
+    if args.command == 'postgrey':
+        simulator = PostgreySimulator(args.delay, *faults)
+    else:
+        simulator = RelaySimulator(*faults, lmtp=args.lmtp)
+
+    try:
+        asyncio.run(serve(simulator, args.address, args.port))
+    except KeyboardInterrupt:
+        for name, count in sorted(simulator.stats.items()):
+            print('%s: %d' % (name, count))
@@ -1,60 +1,331 @@
-import logging.handlers
+import asyncio
+import logging
 import re
 import smtplib
+import time
 
 from aiosmtpd.controller import Controller
-from aiosmtpd.smtp import SMTP, syntax
+from aiosmtpd.smtp import MISSING, SMTP, Envelope, Session, syntax
 
-from .postgrey_client import greylist_status
+from .cache import SharedVerdictCache, VerdictCache
+from .defaults import DCC_MANY, MAX_HEADER_BYTES, MAX_LINE_LENGTH, RATE_LIMIT_REPLY
+from .lanes import TrafficLanes
+from .postgrey_client import DEFAULT_TIMEOUT, greylist_status
+from .ratelimit import GREYLIST, TARPIT, TEMPFAIL
+from .relay import connect_relay
 
 logger = logging.getLogger('SpamFilterProxy')
 
 RE_STATUS = re.compile(r'^X-Spam-Status: No, score=(\S+) .*$')
-RE_DCC = re.compile(r'^X-Spam-DCC: .+?(?:Body=(?:(\d+|many)|\S+?))?\s*(?:Fuz1=(?:(\d+|many)|\S+?))?\s*(?:Fuz2=(?:(\d+|many)|\S+?))?$')  # noqa
+RE_XTEXT = re.compile(r'\+([0-9A-Fa-f]{2})')
 
-XFORWARD_ARGS = ('NAME', 'ADDR', 'PROTO', 'HELO')
+DCC_HEADER = b'X-Spam-DCC:'
+DCC_KEYS = (b'Body=', b'Fuz1=', b'Fuz2=')
+STATUS_HEADER = b'X-Spam-Status:'
+
+XFORWARD_ARGS = ('NAME', 'ADDR', 'PORT', 'PROTO', 'HELO', 'IDENT', 'SOURCE')
+XFORWARD_UNAVAILABLE = ('[UNAVAILABLE]', '[TEMPUNAVAIL]')
+ESMTP_EXTENSIONS = ('PIPELINING', 'CHUNKING')
+
+DATA_SIZE_LIMIT = 2**25
+# Largest read made while throwing away a rejected BDAT chunk
+DISCARD_READ_SIZE = 2**16
 
 OK_REPLY = '250 OK'
 ERROR_REPLY = '450 Exception'
+# Answer for whitelisted triplets, as Postgrey would give
+WHITELISTED_REPLY = 'action=DUNNO'
+# Settings resizing the TrafficLanes, in the order of its resize() arguments
+LANE_SETTINGS = ('clean_concurrency', 'candidate_concurrency', 'clean_relay_workers', 'candidate_relay_workers')
+# Relay failures after which a message is worth spooling
+SPOOLABLE_ERRORS = (OSError, smtplib.SMTPServerDisconnected)
 
 
-def byte_lines(data):
+def byte_lines(data, limit=None):
     """
     Generator to return byte objects line-by-line,
-    i.e. separated by a newline character
+    i.e. separated by a newline character. With a `limit`,
+    no more than that many bytes of `data` are returned.
     """
     if type(data) is not bytes:
         raise TypeError('requires a <bytes> object')
 
+    end = len(data) if limit is None else min(limit, len(data))
     start = 0
-    pos = 0
-    while pos < len(data):
-        if data[pos] == 0x0a:  # \n
-            pos += 1
-            yield data[start:pos]
-            start = pos
+    while start < end:
+        pos = data.find(b'\n', start, end)
+        if pos == -1:
+            yield data[start:end]
+            return
         pos += 1
-
-    if 0 < start < pos:
         yield data[start:pos]
+        start = pos
+
+
+def pending_input(reader):
+    """
+    The number of bytes a StreamReader has received but not yet returned.
+    There is no public API for this, so it relies on the reader's private
+    buffer.
+    """
+    return len(reader._buffer)
+
+
+def parse_dcc(value):
+    """
+    Return the Body, Fuz1 and Fuz2 counts found in (part of) an X-Spam-DCC
+    header, as integers or None. This is a single pass over the tokens, so
+    the cost is linear in the length of the header whatever its content.
+    """
+    counts = [None, None, None]
+
+    for token in value.split():
+        for i, key in enumerate(DCC_KEYS):
+            if token.startswith(key):
+                count = token[len(key):]
+                if count.isdigit():
+                    counts[i] = int(count)
+                elif count == b'many':
+                    counts[i] = DCC_MANY
+                break
+
+    return tuple(counts)
+
+
+def xtext_decode(value):
+    """
+    Decode an RFC 3461 xtext string, i.e. with '+XX' hex escapes
+    """
+    if '+' not in value:
+        return value
+
+    return RE_XTEXT.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+
+def parse_xforward(args):
+    """
+    Parse the arguments of an XFORWARD command into a list of
+    (attribute, value) tuples, with the attribute names lower-cased to
+    match the ForwardInfo slots. Values which Postfix marks as unavailable
+    are returned as None.
+
+    Raises ValueError if any of the arguments is not understood.
+    """
+    attrs = []
+
+    for arg in args.split():
+        name, sep, value = arg.partition('=')
+        name = name.upper()
+        if not sep or name not in XFORWARD_ARGS:
+            raise ValueError('Invalid XFORWARD attribute: %s' % arg)
+
+        if value in XFORWARD_UNAVAILABLE:
+            value = None
+        else:
+            value = xtext_decode(value)
+            if name == 'ADDR' and value[:5].upper() == 'IPV6:':
+                value = value[5:]
+
+        attrs.append((name.lower(), value))
+
+    if not attrs:
+        raise ValueError('No XFORWARD attributes given')
+
+    return attrs
+
+
+class ForwardInfo:
+    """
+    The client attributes forwarded by Postfix with XFORWARD. A single
+    instance lives for the whole connection and is reset between
+    transactions.
+    """
+    __slots__ = tuple(name.lower() for name in XFORWARD_ARGS)
+
+    def __init__(self):
+        self.reset()
+
+    def __repr__(self):
+        return 'ForwardInfo(%s)' % ', '.join('%s=%r' % (slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def reset(self):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+
+    def update(self, attrs):
+        for name, value in attrs:
+            setattr(self, name, value)
+
+
+class PostfixProxySession(Session):
+
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.fwd_info = ForwardInfo()
+
+
+class PostfixProxyEnvelope(Envelope):
+
+    def __init__(self):
+        super().__init__()
+        self.greylist_lookup = None
+        # Set for clients over their rate limit, whose mail is greylisted without being scored
+        self.skip_scoring = False
+
+    def discard_lookup(self):
+        """
+        Drop an early greylist lookup whose result is no longer needed
+        """
+        lookup, self.greylist_lookup = self.greylist_lookup, None
+        if lookup is None:
+            return
+
+        if not lookup.done():
+            lookup.cancel()
+        elif not lookup.cancelled():
+            # retrieve any exception, so that asyncio doesn't complain about it
+            lookup.exception()
 
 
 class PostfixProxyServer(SMTP):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._replies = []
+        self._bdat_chunks = None
+        self._bdat_size = 0
+
+    def _input_pending(self):
+        """
+        True if the client has already sent further (pipelined) input
+        which has not been consumed yet.
+        """
+        reader = getattr(self, '_reader', None)
+        return reader is not None and pending_input(reader) > 0
+
+    async def push(self, status):
+        """
+        Queue a reply, only writing the queued replies out once the client's
+        pipelined commands have all been read (RFC 2920, section 3.1).
+        """
+        if isinstance(status, str):
+            status = status.encode('utf-8' if self.enable_SMTPUTF8 else 'ascii')
+        self._replies.append(status + b'\r\n')
+
+        if not self._input_pending():
+            await self.flush_replies()
+
+    def connection_lost(self, error):
+        if self.envelope is not None:
+            self.envelope.discard_lookup()
+        super().connection_lost(error)
+
+    async def flush_replies(self):
+        if not self._replies:
+            return
+
+        data = b''.join(self._replies)
+        self._replies = []
+        logger.debug('%r << %r', self.session.peer, data)
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def _create_session(self):
+        return PostfixProxySession(self.loop)
+
+    def _create_envelope(self):
+        return PostfixProxyEnvelope()
+
+    def _set_post_data_state(self):
+        if self.envelope is not None:
+            self.envelope.discard_lookup()
+        super()._set_post_data_state()
+        self._bdat_chunks = None
+        self._bdat_size = 0
+        # Postfix sends the XFORWARD attributes anew for every transaction
+        if self.session is not None:
+            self.session.fwd_info.reset()
+
+    async def discard_input(self, size):
+        """
+        Consume and throw away `size` bytes of input, reading no more than
+        DISCARD_READ_SIZE at a time
+        """
+        while size > 0:
+            data = await self._reader.read(min(size, DISCARD_READ_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', size)
+            size -= len(data)
+
+    @syntax('DATA')
+    async def smtp_DATA(self, arg):
+        if self._bdat_chunks is not None:
+            await self.push('503 Error: DATA not permitted after BDAT')
+            return
+
+        await super().smtp_DATA(arg)
+
+    @syntax('BDAT chunk-size [LAST]')
+    async def smtp_BDAT(self, arg):
+        args = arg.split() if arg else []
+        if (not 0 < len(args) < 3 or not args[0].isdigit() or
+                (len(args) == 2 and args[1].upper() != 'LAST')):
+            await self.push('501 Syntax: BDAT chunk-size [LAST]')
+            return
+
+        size = int(args[0])
+        last = len(args) == 2
+
+        error = None
+        if not self.session.host_name:
+            error = '503 Error: send EHLO first'
+        elif not self.envelope.rcpt_tos:
+            error = '503 Error: need RCPT command'
+        elif self.data_size_limit and self._bdat_size + size > self.data_size_limit:
+            self._set_post_data_state()
+            error = '552 Error: Too much mail data'
+
+        if error:
+            # The chunk always has to be consumed, but a rejected one is never
+            # held in memory, whatever size the client announced
+            await self.push(error)
+            await self.flush_replies()
+            await self.discard_input(size)
+            return
+
+        chunk = await self._reader.readexactly(size) if size else b''
+        if self._bdat_chunks is None:
+            self._bdat_chunks = []
+        self._bdat_size += size
+        self._bdat_chunks.append(chunk)
+
+        if not last:
+            await self.push('250 %d octets received' % size)
+            return
+
+        content = b''.join(self._bdat_chunks)
+        self.envelope.content = content
+        self.envelope.original_content = content
+
+        status = await self._call_handler_hook('DATA')
+        self._set_post_data_state()
+        await self.push(OK_REPLY if status is MISSING else status)
+
     @syntax('XFORWARD %s' % ' '.join(XFORWARD_ARGS))
     async def smtp_XFORWARD(self, args):
-        kwargs = dict(x.split('=') for x in args.split(' '))
-        if not set(kwargs.keys()).issubset(XFORWARD_ARGS):
-            logger.error('Client sent invalid arguments: %s', kwargs.keys())
+        if self.envelope.mail_from:
+            await self.push('503 Error: MAIL transaction in progress')
+            return
+
+        try:
+            attrs = parse_xforward(args or '')
+        except ValueError as ex:
+            logger.error('Client sent invalid arguments: %s', ex)
             await self.push('501 Syntax error')
             return
 
-        if hasattr(self.session, 'fwd_info'):
-            logger.debug('Updating fwd_info: %s', kwargs)
-            self.session.fwd_info.update(kwargs)
-        else:
-            logger.debug('Setting fwd_info: %s', kwargs)
-            self.session.fwd_info = kwargs
+        self.session.fwd_info.update(attrs)
+        logger.debug('Updated fwd_info: %s', self.session.fwd_info)
 
         await self.push(OK_REPLY)
 
@@ -64,17 +335,117 @@ class PostfixProxyHandler:
     DEFAULT_SPAM_SCORE = -999999
     DEFAULT_DCC_SCORE = 0
 
-    def __init__(self, relay, spam, dcc, pghost='127.0.0.1', pgport=10023):
+    MAX_HEADER_BYTES = MAX_HEADER_BYTES
+    MAX_LINE_LENGTH = MAX_LINE_LENGTH
+
+    def __init__(self, relay, spam, dcc, pghost='127.0.0.1', pgport=10023, early_lookup=False, defer_ttl=0,
+                 max_header_bytes=MAX_HEADER_BYTES, max_line_length=MAX_LINE_LENGTH, pgtimeout=DEFAULT_TIMEOUT,
+                 shared_cache=None, adaptive=None, rate_limit=None, spool=None, whitelist=None, lanes=None,
+                 relay_pool=None):
         self.relay = relay
         self.spam = spam
         self.dcc = dcc
         self.pghost = pghost
         self.pgport = pgport
+        self.pgtimeout = pgtimeout
+        # Query Postgrey as soon as the first recipient is known, rather than
+        # after the whole message has been received. Note that this lets
+        # Postgrey see every triplet, not only those meeting the conditions.
+        self.early_lookup = early_lookup
+        # With a shared cache file, every process on the host using the same
+        # file sees the deferrals cached by the others
+        if shared_cache:
+            self.verdicts = SharedVerdictCache(shared_cache, defer_ttl)
+        else:
+            self.verdicts = VerdictCache(defer_ttl)
+        # Bound the cost of scanning the headers of any one message
+        self.max_header_bytes = max_header_bytes
+        self.max_line_length = max_line_length
+        self.truncated_scans = 0
+        # AdaptiveThresholds moving the thresholds with the load on Postgrey
+        self.adaptive = adaptive
+        # ClientRateLimit shedding the load of clients sending too much
+        self.rate_limit = rate_limit
+        # Spool keeping the messages the relay temporarily refuses
+        self.spool = spool
+        # Whitelist of clients and recipients never to look up in Postgrey
+        self.whitelist = whitelist
+        # Separate concurrency budgets and relay pools for clean mail and
+        # greylisting candidates, so that a slow Postgrey only holds up the latter
+        self.lanes = lanes if lanes is not None else TrafficLanes()
+        # RelayPool keeping (TLS) connections to the relay open between messages
+        self.relay_pool = relay_pool
+
+    def reconfigure(self, settings):
+        """
+        Apply settings as returned by config.load_config. There is no await
+        in here, so no session can see a partial update; sessions pick up
+        the new values from their next step on.
+        """
+        for name, value in settings.items():
+            if name == 'defer_ttl':
+                self.verdicts.ttl = value
+            elif name == 'relay_pool':
+                if self.relay_pool is not None:
+                    self.relay_pool.resize(value)
+                elif value:
+                    logger.warning('Not applied, the relay connection pool needs a restart: relay_pool=%d', value)
+            elif name not in LANE_SETTINGS:
+                setattr(self, name, value)
+
+        self.lanes.resize(*(settings.get(name) for name in LANE_SETTINGS))
+        if self.adaptive is not None:
+            self.adaptive.configure(self.spam, self.dcc)
+
+        logger.info('Configuration reloaded: %s', ', '.join('%s=%s' % item for item in sorted(settings.items())))
+
+    def status(self):
+        """
+        The current settings and counters, by name
+        """
+        spam, dcc = self.effective_thresholds()
+        status = {
+            'spam': spam,
+            'dcc': dcc,
+            'relay': self.relay,
+            'pghost': self.pghost,
+            'pgport': self.pgport,
+            'cached_deferrals': len(self.verdicts),
+            'cache_hits': self.verdicts.hits,
+            'cache_misses': self.verdicts.misses,
+            'truncated_scans': self.truncated_scans,
+        }
+        status.update(self.lanes.metrics())
+        if self.relay_pool is not None:
+            status.update(self.relay_pool.metrics())
+        if self.whitelist is not None:
+            status['whitelisted'] = self.whitelist.hits
+        if self.spool is not None:
+            status['spooled'] = len(self.spool)
+            status['spool_delivered'] = self.spool.delivered
+            status['spool_failed'] = self.spool.failed
+        if self.rate_limit is not None:
+            status['rate_limited'] = self.rate_limit.limited
+            status['top_clients'] = ','.join('%s:%d' % item for item in self.rate_limit.top_clients())
+        if self.adaptive is not None:
+            state = self.adaptive.state()
+            status.update(('adaptive_%s' % name, state[name]) for name in ('level', 'latency', 'pending'))
+        return status
 
     async def handle_DATA(self, server, session, envelope):
         logger.debug('Processing message from %s', session.peer)
 
-        do_grey = await self.process_data(session, envelope)
+        candidate = envelope.skip_scoring or self.greylist_conditions_met(envelope.content)
+
+        async with self.lanes.lane(candidate) as lane:
+            return await self.deliver(session, envelope, candidate, lane)
+
+    async def deliver(self, session, envelope, candidate, lane):
+        """
+        Look up a candidate message in Postgrey, and relay the message
+        unless it is to be greylisted, returning the reply to give
+        """
+        do_grey = await self.process_data(session, envelope, candidate)
 
         add_header = None
         result = None
@@ -87,47 +458,172 @@ class PostfixProxyHandler:
 
         if not result:
             try:
-                self.relay_mail(envelope, add_header)
-                result = OK_REPLY
+                refused = await lane.run_in_pool(self.relay_mail, envelope, add_header)
+                result = await self.relay_refused(envelope.mail_from, refused,
+                                                  lambda: self.message_data(envelope, add_header))
+            except smtplib.SMTPRecipientsRefused as ex:
+                logger.warning('Message could not be relayed to any recipient')
+                result = await self.relay_refused(envelope.mail_from, ex.recipients,
+                                                  lambda: self.message_data(envelope, add_header), delivered=False)
             except smtplib.SMTPResponseException as ex:
                 logger.warning('Message could not be relayed: %s', ex)
                 result = '%d %s' % (ex.smtp_code, ex.smtp_error.decode())
+                if ex.smtp_code < 500:
+                    result = await self.spool_mail(envelope, add_header, result)
             except Exception as ex:
                 logger.exception('Caught exception trying to relay mail to %s', self.relay)
                 result = ERROR_REPLY + ': %s' % ex
+                if isinstance(ex, SPOOLABLE_ERRORS):
+                    result = await self.spool_mail(envelope, add_header, result)
 
         return result
 
+    async def spool_mail(self, envelope, add_header, result):
+        """
+        Spool a message the relay refused for now, returning the reply to
+        give: OK once it is spooled, otherwise the relay's `result`
+        """
+        return await self.spool_data(envelope.mail_from, envelope.rcpt_tos, self.message_data(envelope, add_header),
+                                     result)
+
+    async def spool_data(self, mail_from, rcpt_tos, data, result):
+        """
+        Spool a message for `rcpt_tos`, as `spool_mail`
+        """
+        if self.spool is None:
+            return result
+
+        try:
+            await self.spool.append(mail_from, rcpt_tos, data)
+        except Exception:
+            logger.exception('Could not spool message')
+            return result
+
+        return OK_REPLY
+
+    async def relay_refused(self, mail_from, refused, get_data, delivered=True):
+        """
+        Deal with the recipients the relay refused, at RCPT or one by one
+        after the data as an LMTP relay does, whether or not it took the
+        message for others: those refused for good are logged, those
+        refused for now are spooled. Returns the reply to give, the relay's
+        temporary failure if they could not be spooled, so that Postfix
+        sends the message again rather than it being lost for them, or its
+        permanent one if the message was delivered to nobody.
+        """
+        temporary = []
+        for rcpt, (code, resp) in sorted((refused or {}).items()):
+            if code >= 500:
+                logger.error('Relay refused recipient %s of a message from %s: %d %s',
+                             rcpt, mail_from, code, resp.decode(errors='replace'))
+            else:
+                logger.warning('Relay refused recipient %s of a message from %s for now: %d %s',
+                               rcpt, mail_from, code, resp.decode(errors='replace'))
+                temporary.append(rcpt)
+
+        if not temporary:
+            if delivered:
+                return OK_REPLY
+            code, resp = refused[min(refused)]
+            return '%d %s' % (code, resp.decode())
+
+        code, resp = refused[temporary[0]]
+        return await self.spool_data(mail_from, temporary, get_data(), '%d %s' % (code, resp.decode()))
+
     async def handle_EHLO(self, server, session, envelope, hostname):
         session.host_name = hostname
+        for extension in ESMTP_EXTENSIONS:
+            await server.push('250-%s' % extension)
         await server.push('250-XFORWARD %s' % ' '.join(XFORWARD_ARGS))
         return '250 HELP'
 
-    async def handle_RSET(self, session, envelope, *args):
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        action = await self.check_client_rate(session.fwd_info.addr)
+        if action == TEMPFAIL:
+            return RATE_LIMIT_REPLY
+
+        envelope.skip_scoring = action == GREYLIST
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        return OK_REPLY
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        envelope.rcpt_tos.append(address)
+        envelope.rcpt_options.extend(rcpt_options)
+
+        if (self.early_lookup or envelope.skip_scoring) and len(envelope.rcpt_tos) == 1:
+            logger.debug('Starting early greylist lookup for %s', address)
+            envelope.greylist_lookup = asyncio.ensure_future(self.check_greylist(session, envelope))
+
+        return OK_REPLY
+
+    async def handle_RSET(self, server, session, envelope):
         logger.debug('Handle RSET, clearing fwd_info')
-        session.fwd_info = {}
+        session.fwd_info.reset()
         return OK_REPLY
 
+    async def check_client_rate(self, client_ip):
+        """
+        Count a transaction from the client, returning the rate limit
+        action to take against it, if any. A tarpit delay is served here.
+        """
+        if self.rate_limit is None:
+            return None
+
+        action = self.rate_limit.check(client_ip)
+        if action is not None:
+            logger.info('Client %s over its rate limit, action: %s', client_ip, action)
+        if action == TARPIT:
+            await asyncio.sleep(self.rate_limit.tarpit_delay)
+        return action
+
     async def check_greylist(self, session, envelope):
         recipient = envelope.rcpt_tos[0]
         sender = envelope.mail_from
-        client_ip = session.fwd_info['ADDR']
-        client_name = session.fwd_info['NAME']
+        client_ip = session.fwd_info.addr
+        client_name = session.fwd_info.name or 'unknown'
+
+        if client_ip is None:
+            raise ValueError('No client address was forwarded')
+
+        return await self.lookup_triplet(recipient, sender, client_ip, client_name)
 
-        result = await greylist_status(recipient, sender, client_ip, client_name,
-                                       self.pghost, self.pgport)
+    async def lookup_triplet(self, recipient, sender, client_ip, client_name):
+        if self.whitelist is not None and self.whitelist.matches(client_ip, client_name, recipient):
+            logger.debug('Whitelisted: %s, %s, %s', client_ip, client_name, recipient)
+            return WHITELISTED_REPLY
+
+        key = (client_ip, sender.lower(), recipient.lower())
+        result = await self.verdicts.lookup(key, lambda: self.query_postgrey(
+            recipient, sender, client_ip, client_name))
 
         logger.debug('greylist result: %s', result)
 
         return result
 
-    async def process_data(self, session, envelope):
+    async def query_postgrey(self, recipient, sender, client_ip, client_name):
+        if self.adaptive is None:
+            return await greylist_status(recipient, sender, client_ip, client_name,
+                                         self.pghost, self.pgport, self.pgtimeout)
+
+        self.adaptive.lookup_started()
+        start = time.monotonic()
+        try:
+            return await greylist_status(recipient, sender, client_ip, client_name,
+                                         self.pghost, self.pgport, self.pgtimeout)
+        finally:
+            self.adaptive.lookup_finished(time.monotonic() - start)
+
+    async def process_data(self, session, envelope, candidate):
 
         do_grey = []
 
-        if self.greylist_conditions_met(envelope.content):
+        if candidate:
             try:
-                response = await self.check_greylist(session, envelope)
+                if envelope.greylist_lookup is not None:
+                    response = await envelope.greylist_lookup
+                else:
+                    response = await self.check_greylist(session, envelope)
                 do_grey = response.split(' ', 1)
             except Exception as ex:
                 logger.error('Problem while checking with greylisting server: %s', ex)
@@ -135,50 +631,75 @@ class PostfixProxyHandler:
         return do_grey
 
     def greylist_conditions_met(self, data):
-        status = self.get_spam_status(data)
+        return self.status_conditions_met(self.get_spam_status(data))
 
+    def effective_thresholds(self):
+        """
+        The (spam, dcc) thresholds currently in force
+        """
+        if self.adaptive is None:
+            return self.spam, self.dcc
+        return self.adaptive.thresholds()
+
+    def status_conditions_met(self, status):
         conditions_met = False
+        spam, dcc = self.effective_thresholds()
 
-        if status['spam'] >= self.spam and status['dcc'] >= self.dcc:
+        if status['spam'] >= spam and status['dcc'] >= dcc:
             logger.debug('Spam score (%f) and DCC score (%d) conditions met, checking greylist',
                          status['spam'], status['dcc'])
             conditions_met = True
 
+        if self.adaptive is not None:
+            self.adaptive.observe_verdict(conditions_met)
+
         return conditions_met
 
     def get_spam_status(self, data):
         status = {}
+        scanned = 0
+        in_dcc = False
+
+        for line in byte_lines(data, self.max_header_bytes):
+            scanned += len(line)
 
-        for line in byte_lines(data):
             if line == b'\r\n':
                 logger.debug('End of headers')
                 break
 
-            line = line.decode('utf8', errors='replace')
-
-            match = RE_STATUS.match(line)
-            if match:
-                logger.debug('Got match for status')
-                status['spam'] = float(match.group(1))
+            if len(line) > self.max_line_length:
+                logger.debug('Skipping header line of %d bytes', len(line))
+                in_dcc = False
                 continue
 
-            match = RE_DCC.match(line)
-            if match:
-                logger.debug('Got match for dcc')
-                for grp in match.groups():
-                    if grp is not None:
-                        if grp == 'many':
-                            status['dcc'] = 999999
-                        else:
-                            val = int(grp)
-                            if 'dcc' in status and val > status['dcc']:
-                                status['dcc'] = val
-                            elif 'dcc' not in status:
-                                status['dcc'] = val
-
-            if len(status) == 2:
+            if in_dcc and line[:1] in (b' ', b'\t'):
+                # folded continuation of the DCC header
+                counts = parse_dcc(line)
+            elif line.startswith(DCC_HEADER):
+                in_dcc = True
+                counts = parse_dcc(line[len(DCC_HEADER):])
+            else:
+                in_dcc = False
+                counts = ()
+
+                if line.startswith(STATUS_HEADER):
+                    match = RE_STATUS.match(line.decode('utf8', errors='replace'))
+                    if match:
+                        logger.debug('Got match for status')
+                        status['spam'] = float(match.group(1))
+
+            for count in counts:
+                if count is not None and count > status.get('dcc', -1):
+                    logger.debug('Got match for dcc')
+                    status['dcc'] = count
+
+            if len(status) == 2 and not in_dcc:
                 logger.debug('Status fully retrieved: %s', status)
                 break
+        else:
+            if scanned < len(data) and len(status) < 2:
+                self.truncated_scans += 1
+                logger.info('Header scan truncated after %d bytes, no end of headers found', scanned)
 
         # If for some reason no matches were found, set some sane defaults
         if 'spam' not in status:
@@ -194,18 +715,32 @@ class PostfixProxyHandler:
             logger.debug('Relay is None, dropping message!')
             return
 
-        mail_from = envelope.mail_from
-        rcpt_tos = envelope.rcpt_tos
+        return self.send_to_relay(envelope.mail_from, envelope.rcpt_tos, self.message_data(envelope, add_header))
+
+    def message_data(self, envelope, add_header):
         if add_header:
-            data = add_header.encode() + b'\r\n' + envelope.content
-        else:
-            data = envelope.content
+            return add_header.encode() + b'\r\n' + envelope.content
+        return envelope.content
+
+    def send_to_relay(self, mail_from, rcpt_tos, data):
+        if self.relay_pool is not None:
+            return self.relay_pool.send(self.relay, mail_from, rcpt_tos, data)
 
-        client = smtplib.SMTP(self.relay)
+        with connect_relay(self.relay) as client:
+            return client.sendmail(mail_from, rcpt_tos, data)
 
-        return client.sendmail(mail_from, rcpt_tos, data)
+    async def redeliver(self, mail_from, rcpt_tos, data):
+        """
+        Deliver a spooled message, in an executor thread
+        """
+        loop = asyncio.get_event_loop()
+        refused = await loop.run_in_executor(None, self.send_to_relay, mail_from, rcpt_tos, data)
+        # The recipients refused for now are spooled again on their own
+        result = await self.relay_refused(mail_from, refused, lambda: data)
+        if result != OK_REPLY:
+            raise smtplib.SMTPRecipientsRefused(refused)
 
 
 class PostfixProxyController(Controller):
     def factory(self):
-        return PostfixProxyServer(self.handler)
+        return PostfixProxyServer(self.handler, data_size_limit=DATA_SIZE_LIMIT, decode_data=False)
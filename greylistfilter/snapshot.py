@@ -0,0 +1,157 @@
+"""
+Compact on-disk snapshot of the proxy's in-memory state, so that a
+restarted proxy doesn't have to rebuild it by querying Postgrey again.
+
+File layout, all integers little-endian:
+
+    header:  magic (4s) | version (H) | reserved (H) | count (I) | crc32 (I) | length (I)
+    entry:   expires (d) | key and reply lengths (4H) | key and reply bytes
+
+Expiry times are stored as wall-clock time, as the monotonic clock used at
+runtime does not survive a restart. The payload is parsed straight from a
+memory map, and checked against its CRC before anything is restored.
+"""
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+logger = logging.getLogger('SpamFilterProxy')
+
+MAGIC = b'GLPS'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHIII')
+ENTRY = struct.Struct('<d4H')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def encode_entries(entries, now=None):
+    """
+    Encode (key, reply, remaining seconds) entries into the snapshot format
+    """
+    now = time.time() if now is None else now
+    parts = []
+
+    for (client_ip, sender, recipient), reply, remaining in entries:
+        fields = [x.encode('utf8', errors='surrogateescape') for x in (client_ip, sender, recipient, reply)]
+        parts.append(ENTRY.pack(now + remaining, *(len(x) for x in fields)))
+        parts.extend(fields)
+
+    payload = b''.join(parts)
+    header = HEADER.pack(MAGIC, VERSION, 0, len(entries), zlib.crc32(payload), len(payload))
+
+    return header + payload
+
+
+def decode_entries(buf, now=None):
+    """
+    Decode a snapshot from a bytes-like object, returning the entries which
+    haven't expired yet as (key, reply, remaining seconds)
+    """
+    now = time.time() if now is None else now
+
+    if len(buf) < HEADER.size:
+        raise SnapshotError('Snapshot is truncated')
+
+    magic, version, _, count, crc, length = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise SnapshotError('Not a snapshot file')
+    if version != VERSION:
+        raise SnapshotError('Unsupported snapshot version: %d' % version)
+    if len(buf) != HEADER.size + length:
+        raise SnapshotError('Snapshot is truncated')
+
+    payload = memoryview(buf)[HEADER.size:]
+    try:
+        if zlib.crc32(payload) != crc:
+            raise SnapshotError('Snapshot checksum mismatch')
+
+        entries = []
+        pos = 0
+        for _ in range(count):
+            expires, *lengths = ENTRY.unpack_from(payload, pos)
+            pos += ENTRY.size
+            fields = []
+            for size in lengths:
+                fields.append(str(payload[pos:pos + size], 'utf8', errors='surrogateescape'))
+                pos += size
+
+            if expires > now:
+                entries.append((tuple(fields[:3]), fields[3], expires - now))
+    except struct.error:
+        raise SnapshotError('Snapshot entries are corrupt')
+    finally:
+        payload.release()
+
+    return entries
+
+
+def save_snapshot(path, entries):
+    """
+    Atomically replace the snapshot at `path`
+    """
+    data = encode_entries(entries)
+    tmp_path = '%s.tmp' % path
+
+    with open(tmp_path, 'wb') as output:
+        output.write(data)
+        output.flush()
+        os.fsync(output.fileno())
+
+    os.replace(tmp_path, path)
+    logger.debug('Saved %d entries to snapshot %s', len(entries), path)
+
+
+def load_snapshot(path):
+    """
+    Read the entries of the snapshot at `path`. Raises SnapshotError if the
+    file is unusable.
+    """
+    with open(path, 'rb') as input:
+        size = os.fstat(input.fileno()).st_size
+        if size == 0:
+            raise SnapshotError('Snapshot is empty')
+
+        with mmap.mmap(input.fileno(), size, access=mmap.ACCESS_READ) as buf:
+            return decode_entries(buf)
+
+
+def restore_state(path, cache):
+    """
+    Warm up `cache` from the snapshot at `path`, if there is a usable one
+    """
+    try:
+        entries = load_snapshot(path)
+    except FileNotFoundError:
+        logger.info('No state snapshot at %s, starting cold', path)
+        return 0
+    except (OSError, SnapshotError) as ex:
+        logger.warning('Ignoring state snapshot %s: %s', path, ex)
+        return 0
+
+    cache.restore(entries)
+    logger.info('Restored %d entries from state snapshot %s', len(entries), path)
+    return len(entries)
+
+
+async def snapshot_periodically(path, cache, interval, executor=None):
+    """
+    Save `cache` to `path` every `interval` seconds. The entries are taken on
+    the event loop, the file is written in `executor`. Cancelling this doesn't
+    stop a write in progress; shut down the executor to wait for it.
+    """
+    loop = asyncio.get_event_loop()
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(executor, save_snapshot, path, cache.export())
+        except OSError as ex:
+            logger.error('Could not save state snapshot %s: %s', path, ex)
@@ -0,0 +1,485 @@
+"""
+Local store-and-forward spool for messages the relay couldn't take.
+
+Rather than answering 450 and having Postfix send the whole message again
+later, a message which fails to relay for a temporary reason is appended
+to the spool and accepted. A background worker redelivers spooled
+messages, backing off between attempts.
+
+The spool is a directory of append-only segment files. Each record is
+
+    magic (4s) | type (B) | length (I) | crc32 (I) | payload
+
+where the payload of a message record is
+
+    spooled at (d) | sender length (H) | recipient count (H) | (length (H) | recipient)... | sender | data
+
+and that of a done record is the segment number and offset (II) of the
+message delivered. Appends are made durable by an fsync shared by all the
+appends within `sync_delay` seconds, before the message is accepted. The
+writes, the fsyncs and the reads of spooled messages are made in a thread
+of the spool's own, in order, so that the event loop never waits on the
+disk. A record which can't be written in full is truncated away, and the
+records queued after it in the same segment are refused, so that what is
+in a segment is always where the spool expects it. On
+startup the segments are read back, and every message without a done
+record is queued for delivery; new records always go to a new segment,
+so a record torn by a crash is never appended to. Segments are deleted
+oldest first, once they hold no undelivered message.
+
+A message the relay rejects, or still not delivered `max_age` seconds
+after it was spooled (as Postfix's maximal_queue_lifetime), has already
+been accepted, so rather than being dropped it is set aside in the
+`failed` subdirectory, in a file of its own holding its message record,
+for the postmaster to deal with.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import smtplib
+import struct
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('SpamFilterProxy')
+
+MAGIC = b'GLSP'
+MESSAGE = 1
+DONE = 2
+
+RECORD = struct.Struct('<4sBII')
+ENVELOPE = struct.Struct('<dHH')
+ADDRESS = struct.Struct('<H')
+POSITION = struct.Struct('<II')
+
+SEGMENT_NAME = 'segment-%010d.spool'
+FAILED_DIRECTORY = 'failed'
+# by the time the message was spooled, in milliseconds, and its position
+FAILED_NAME = 'message-%d-%d-%d.spool'
+# Postfix's default maximal_queue_lifetime
+MAX_AGE = 5 * 86400
+
+
+class SpoolError(Exception):
+    pass
+
+
+def encode_message(mail_from, rcpt_tos, data, spooled_at=0.0):
+    sender = mail_from.encode('utf8', errors='surrogateescape')
+    parts = [ENVELOPE.pack(spooled_at, len(sender), len(rcpt_tos))]
+    for rcpt in rcpt_tos:
+        address = rcpt.encode('utf8', errors='surrogateescape')
+        parts.append(ADDRESS.pack(len(address)))
+        parts.append(address)
+    parts.append(sender)
+    parts.append(data)
+    return b''.join(parts)
+
+
+def decode_envelope(payload):
+    """
+    Return the sender, the recipients, the offset of the data in a message
+    record's payload and the time it was spooled
+    """
+    spooled_at, sender_length, count = ENVELOPE.unpack_from(payload)
+    offset = ENVELOPE.size
+    rcpt_tos = []
+    for _ in range(count):
+        length = ADDRESS.unpack_from(payload, offset)[0]
+        offset += ADDRESS.size
+        rcpt_tos.append(payload[offset:offset + length].decode('utf8', errors='surrogateescape'))
+        offset += length
+    sender = payload[offset:offset + sender_length].decode('utf8', errors='surrogateescape')
+    return sender, rcpt_tos, offset + sender_length, spooled_at
+
+
+def encode_record(record_type, payload):
+    return RECORD.pack(MAGIC, record_type, len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path):
+    """
+    Generate the (offset, type, payload) of the intact records in a segment,
+    stopping at the first torn or corrupt one
+    """
+    with open(path, 'rb') as input:
+        buf = input.read()
+
+    offset = 0
+    while offset + RECORD.size <= len(buf):
+        magic, record_type, length, crc = RECORD.unpack_from(buf, offset)
+        start = offset + RECORD.size
+        payload = buf[start:start + length]
+        if magic != MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+            logger.warning('Spool segment %s is damaged at offset %d, ignoring the rest', path, offset)
+            return
+        yield offset, record_type, payload
+        offset = start + length
+
+
+def sync_directory(path):
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def is_permanent(ex):
+    if isinstance(ex, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in ex.recipients.values())
+    return getattr(ex, 'smtp_code', 0) >= 500
+
+
+class SpooledMessage:
+    __slots__ = ('position', 'mail_from', 'rcpt_tos', 'data_offset', 'data_length', 'spooled_at', 'attempts')
+
+    def __init__(self, position, mail_from, rcpt_tos, data_offset, data_length, spooled_at):
+        self.position = position
+        self.mail_from = mail_from
+        self.rcpt_tos = rcpt_tos
+        self.data_offset = data_offset
+        self.data_length = data_length
+        self.spooled_at = spooled_at
+        self.attempts = 0
+
+
+class Spool:
+    """
+    Durable queue of messages awaiting redelivery, see the module
+    documentation. All methods are to be called from the event loop's thread.
+    The age of messages is reckoned by the `wall_clock`, as it has to hold
+    across restarts.
+    """
+
+    def __init__(self, directory, segment_size=64 * 2**20, sync_delay=0.01, retry_delay=30, max_retry_delay=3600,
+                 max_age=MAX_AGE, clock=time.monotonic, wall_clock=time.time):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_delay = sync_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.delivered = 0
+        self.failed = 0
+
+        self._pending = {}
+        self._due = []
+        self._live = {}
+        self._sync_waiters = []
+        self._sync_handle = None
+        self._wakeup = None
+        self._fd = None
+        self._segment = None
+        # segment files written to, to be synced and closed by the next flush
+        self._retired_fds = []
+        self._directory_synced = False
+        # the writes, fsyncs and reads, one at a time and in order
+        self._io = ThreadPoolExecutor(1, thread_name_prefix='spool')
+        # segment files a record couldn't be written to, used by the spool's thread
+        self._torn_fds = set()
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self._open_segment(max(self._live, default=0) + 1)
+        sync_directory(directory)
+        self._directory_synced = True
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, SEGMENT_NAME % segment)
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('segment-') and name.endswith('.spool'):
+                try:
+                    segments.append(int(name[8:-6]))
+                except ValueError:
+                    pass
+        return sorted(segments)
+
+    def _recover(self):
+        done = set()
+        messages = []
+
+        for segment in self._segments():
+            self._live[segment] = 0
+            for offset, record_type, payload in read_records(self._path(segment)):
+                if record_type == MESSAGE:
+                    messages.append(((segment, offset), payload))
+                elif record_type == DONE:
+                    done.add(POSITION.unpack(payload))
+
+        now = self.clock()
+        for position, payload in messages:
+            if position in done:
+                continue
+            mail_from, rcpt_tos, data_start, spooled_at = decode_envelope(payload)
+            self._live[position[0]] += 1
+            self._add(SpooledMessage(position, mail_from, rcpt_tos, position[1] + RECORD.size + data_start,
+                                     len(payload) - data_start, spooled_at), now)
+
+        if self._pending:
+            logger.info('Recovered %d spooled messages', len(self._pending))
+        self._drop_delivered_segments()
+
+    def _add(self, message, due):
+        self._pending[message.position] = message
+        heapq.heappush(self._due, (due, message.position))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _open_segment(self, segment):
+        if self._fd is not None:
+            self._retired_fds.append(self._fd)
+
+        self._segment = segment
+        self._live.setdefault(segment, 0)
+        self._fd = os.open(self._path(segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._offset = 0
+        # the new file itself is made durable by the next flush
+        self._directory_synced = False
+
+    async def _write(self, record_type, payload):
+        """
+        Append a record in the spool's thread, returning its position
+        """
+        if self._offset >= self.segment_size:
+            self._open_segment(self._segment + 1)
+            self._drop_delivered_segments()
+
+        fd = self._fd
+        position = (self._segment, self._offset)
+        self._offset += RECORD.size + len(payload)
+        # a message keeps its segment from the moment it is written
+        if record_type == MESSAGE:
+            self._live[self._segment] += 1
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                self._io, self._write_record, fd, position[1], record_type, payload)
+        except OSError as ex:
+            if record_type == MESSAGE:
+                self._live[position[0]] -= 1
+            if fd == self._fd:
+                self._open_segment(self._segment + 1)
+            raise SpoolError('Could not write to the spool: %s' % ex)
+        return position
+
+    def _write_record(self, fd, offset, record_type, payload):
+        if fd in self._torn_fds:
+            raise OSError('an earlier record in the segment was not written')
+
+        record = memoryview(encode_record(record_type, payload))
+        written = 0
+        try:
+            while written < len(record):
+                written += os.write(fd, record[written:])
+        except OSError:
+            # No part of the record may be left, it would hide the ones after it on recovery
+            self._torn_fds.add(fd)
+            os.ftruncate(fd, offset)
+            raise
+
+    async def append(self, mail_from, rcpt_tos, data):
+        """
+        Spool a message, returning once it is on disk
+        """
+        spooled_at = self.wall_clock()
+        payload = encode_message(mail_from, rcpt_tos, data, spooled_at)
+        position = await self._write(MESSAGE, payload)
+        await self._sync()
+
+        message = SpooledMessage(position, mail_from, rcpt_tos, position[1] + RECORD.size + len(payload) - len(data),
+                                 len(data), spooled_at)
+        self._add(message, self.clock() + self.retry_delay)
+        logger.info('Spooled message from %s for redelivery', mail_from)
+        return position
+
+    async def _sync(self):
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self._sync_waiters.append(waiter)
+        if self._sync_handle is None:
+            self._sync_handle = loop.call_later(self.sync_delay, self._flush)
+        await waiter
+
+    def _flush(self):
+        """
+        Sync the segments written to in the spool's thread, resolving the
+        waiters once that is done
+        """
+        waiters, self._sync_waiters = self._sync_waiters, []
+        self._sync_handle = None
+
+        future = asyncio.get_event_loop().run_in_executor(self._io, self._sync_files, *self._take_unsynced())
+        future.add_done_callback(lambda future: self._resolve(waiters, future.exception()))
+
+    def _take_unsynced(self):
+        retired, self._retired_fds = self._retired_fds, []
+        directory = None if self._directory_synced else self.directory
+        self._directory_synced = True
+        return self._fd, retired, directory
+
+    def _sync_files(self, fd, retired, directory):
+        try:
+            for retired_fd in retired:
+                os.fsync(retired_fd)
+            os.fsync(fd)
+            if directory is not None:
+                sync_directory(directory)
+        finally:
+            for retired_fd in retired:
+                os.close(retired_fd)
+                self._torn_fds.discard(retired_fd)
+
+    @staticmethod
+    def _resolve(waiters, error):
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(SpoolError('Could not sync the spool: %s' % error))
+
+    def read_data(self, message):
+        with open(self._path(message.position[0]), 'rb') as input:
+            input.seek(message.data_offset)
+            return input.read(message.data_length)
+
+    async def load_data(self, message):
+        """
+        Read a spooled message's data in the spool's thread
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._io, self.read_data, message)
+
+    async def _done(self, message):
+        del self._pending[message.position]
+        try:
+            await self._write(DONE, POSITION.pack(*message.position))
+        except SpoolError as ex:
+            logger.error('Spooled message from %s will be delivered again after a restart: %s', message.mail_from, ex)
+        self._live[message.position[0]] -= 1
+        self._drop_delivered_segments()
+
+    def _drop_delivered_segments(self):
+        # Oldest first, so that no done record outlives the message it refers to
+        for segment in sorted(self._live):
+            if segment == self._segment or self._live[segment]:
+                return
+            del self._live[segment]
+            os.unlink(self._path(segment))
+
+    def _write_failed(self, message):
+        directory = os.path.join(self.directory, FAILED_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, FAILED_NAME % ((message.spooled_at * 1000,) + message.position))
+        record = encode_record(MESSAGE, encode_message(message.mail_from, message.rcpt_tos, self.read_data(message),
+                                                       message.spooled_at))
+        with open(path, 'wb') as output:
+            output.write(record)
+            output.flush()
+            os.fsync(output.fileno())
+        sync_directory(directory)
+        return path
+
+    async def set_aside(self, message, reason):
+        """
+        Move a message which won't be delivered to the failed directory, in
+        the spool's thread. It is kept in the spool, and tried again, if it
+        can't be written there.
+        """
+        try:
+            path = await asyncio.get_event_loop().run_in_executor(self._io, self._write_failed, message)
+        except OSError as ex:
+            logger.error('Could not set aside spooled message from %s, keeping it: %s', message.mail_from, ex)
+            heapq.heappush(self._due, (self.clock() + self.backoff(message.attempts), message.position))
+            return
+
+        logger.error('Spooled message from %s to %s %s, moved to %s',
+                     message.mail_from, ', '.join(message.rcpt_tos), reason, path)
+        self.failed += 1
+        await self._done(message)
+
+    def backoff(self, attempts):
+        return min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+
+    async def deliver_one(self, message, deliver):
+        """
+        Attempt to deliver a spooled message with the coroutine function
+        `deliver(mail_from, rcpt_tos, data)`, rescheduling it on failure
+        """
+        message.attempts += 1
+        try:
+            await deliver(message.mail_from, message.rcpt_tos, await self.load_data(message))
+        except Exception as ex:
+            if is_permanent(ex):
+                await self.set_aside(message, 'rejected by the relay: %s' % ex)
+                return False
+
+            age = self.wall_clock() - message.spooled_at
+            if age >= self.max_age:
+                await self.set_aside(message, 'not delivered in %d attempts over %ds: %s' % (message.attempts, age, ex))
+                return False
+
+            delay = self.backoff(message.attempts)
+            logger.warning('Spooled message from %s not delivered, attempt %d, retrying in %ds: %s',
+                           message.mail_from, message.attempts, delay, ex)
+            heapq.heappush(self._due, (self.clock() + delay, message.position))
+            return False
+
+        logger.info('Delivered spooled message from %s', message.mail_from)
+        self.delivered += 1
+        await self._done(message)
+        return True
+
+    async def run(self, deliver):
+        """
+        Redeliver spooled messages as they fall due, until cancelled
+        """
+        self._wakeup = asyncio.Event()
+
+        while True:
+            now = self.clock()
+            while self._due and self._due[0][0] <= now:
+                _, position = heapq.heappop(self._due)
+                message = self._pending.get(position)
+                if message is not None:
+                    await self.deliver_one(message, deliver)
+                now = self.clock()
+
+            timeout = self._due[0][0] - now if self._due else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        """
+        Sync and close the spool, once its event loop has stopped
+        """
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        self._io.shutdown(wait=True)
+
+        if self._fd is not None:
+            error = None
+            try:
+                self._sync_files(*self._take_unsynced())
+            except OSError as ex:
+                error = ex
+            os.close(self._fd)
+            self._torn_fds.discard(self._fd)
+            self._fd = None
+            waiters, self._sync_waiters = self._sync_waiters, []
+            self._resolve(waiters, error)
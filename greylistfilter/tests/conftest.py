@@ -2,6 +2,9 @@ import asyncio
 import getpass
 import os
 import shutil
+import socket
+import struct
+import subprocess
 import time
 
 from distutils.spawn import find_executable
@@ -15,6 +18,9 @@ import unittest.mock
 from aiosmtpd.controller import Controller
 from async_generator import async_generator, yield_
 
+from ..controller import ServerController
+from ..milter import SMFIP_NR_HDR, encode_packet
+from ..simulators import PostgreySimulator
 from ..smtpproxy import (PostfixProxyController, PostfixProxyHandler,
                          PostfixProxyServer, OK_REPLY)
 
@@ -25,6 +31,14 @@ PG_RESPONSE_TEXT = 'Greylisted, see this URL'
 PG_RESPONSE_HEADER = 'X-Greylist: The message was greylisted'
 
 
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
 async def handle_conn(reader, writer):
     while True:
         line = await reader.readline()
@@ -39,6 +53,112 @@ async def handle_conn(reader, writer):
     writer.close()
 
 
+SPAM_HEADERS = (
+    (b'X-Spam-Status', b'No, score=2.1 required=5.0 tests=BAYES_00\n\tautolearn=no version=3.4.1'),
+    (b'X-Spam-DCC', b'URT:bloggs 1060; Body=1 Fuz1=5 Fuz2=many'),
+)
+HAM_HEADERS = (
+    (b'X-Spam-Status', b'No, score=0.1 required=5.0 tests=BAYES_00 autolearn=no version=3.4.1'),
+)
+
+
+class MilterClient:
+    """
+    Plays the MTA's side of the milter protocol
+    """
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.reader = self.sock.makefile('rb')
+        self.protocol = 0
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def send(self, command, data=b''):
+        self.sock.sendall(encode_packet(command, data))
+
+    def reply(self):
+        length = struct.unpack('>I', self.reader.read(4))[0]
+        packet = self.reader.read(length)
+        return packet[:1], packet[1:]
+
+    def negotiate(self, actions=0x1ff, protocol=0x1fffff):
+        self.send(b'O', struct.pack('>III', 6, actions, protocol))
+        version, actions, self.protocol = struct.unpack('>III', self.reply()[1])
+        return version, actions, self.protocol
+
+    def message(self, headers, address=b'192.0.2.1'):
+        """
+        Send a message's envelope and headers, returning the reply to the
+        end of headers
+        """
+        self.send(b'C', b'mail.example.com\x004\x00\x19%s\x00' % address)
+        assert self.reply() == (b'c', b'')
+        self.send(b'D', b'Mi\x004A1B2C3D4E\x00')
+        self.send(b'M', b'<b@test.com>\x00SIZE=100\x00')
+        assert self.reply() == (b'c', b'')
+        for recipient in (b'<a@test.com>', b'<c@test.com>'):
+            self.send(b'R', recipient + b'\x00')
+            assert self.reply() == (b'c', b'')
+        for name, value in headers:
+            self.send(b'L', b'%s\x00%s\x00' % (name, value))
+            if not self.protocol & SMFIP_NR_HDR:
+                assert self.reply() == (b'c', b'')
+        self.send(b'N')
+        return self.reply()
+
+
+class FixedReplySimulator(PostgreySimulator):
+    """
+    Policy server which records all requests and answers all of them with
+    the same `response`
+    """
+
+    def __init__(self, response=PG_RESPONSE_DEFER, latency=None):
+        super().__init__(latency=latency)
+        self.response = response
+
+    def decide(self, request):
+        return self.response
+
+    def wait_for_requests(self, count, timeout=5):
+        end = time.monotonic() + timeout
+        while len(self.requests) < count and time.monotonic() < end:
+            time.sleep(0.01)
+        return len(self.requests) >= count
+
+
+@pytest.fixture
+def policy_server(run_simulator):
+    """
+    A policy server running in its own thread, usable from synchronous
+    tests. It records all requests and always sends the same response.
+    """
+    return run_simulator(FixedReplySimulator())
+
+
+@pytest.fixture
+def run_simulator():
+    """
+    Runs a Postgrey or relay simulator on its own thread and a free port,
+    until the end of the test
+    """
+    controllers = []
+
+    def _run(simulator):
+        controller = ServerController(simulator)
+        controller.start()
+        controllers.append(controller)
+        return simulator
+
+    yield _run
+
+    for controller in controllers:
+        controller.stop()
+
+
 # c.f. pytest-asyncio/tests/async_fixtures/test_async_gen_fixtures_35.py
 @pytest.fixture
 @async_generator
@@ -97,11 +217,11 @@ def pf_proxy_server(request, unused_tcp_port_factory):
     port = unused_tcp_port_factory()
     servers = []
 
-    def _server(relay=None, spam=1.0, dcc=2, pghost='127.0.0.1', pgport=10023):
+    def _server(relay=None, spam=1.0, dcc=2, pghost='127.0.0.1', pgport=10023, **kwargs):
         for srv in servers:
             srv.stop()
 
-        handler = PostfixProxyHandler(relay, spam, dcc, pghost, pgport)
+        handler = PostfixProxyHandler(relay, spam, dcc, pghost, pgport, **kwargs)
         controller = PostfixProxyController(handler, hostname='127.0.0.1', port=port)
         servers.append(controller)
         controller.start()
@@ -334,3 +454,21 @@ async def _native_pg_server(pgtype, event_loop, unused_tcp_port_factory, postgre
 def real_pg_server(_native_pg_server, _docker_pg_server):
     choice = _docker_pg_server or _native_pg_server
     return choice
+
+
+@pytest.fixture(scope='session')
+def self_signed_cert(tmp_path_factory):
+    """
+    The paths of a self-signed certificate for 127.0.0.1 and its key
+    """
+    openssl = find_executable('openssl')
+    if openssl is None:
+        pytest.skip('openssl is needed to make a certificate')
+
+    directory = tmp_path_factory.mktemp('tls')
+    cert, key = str(directory / 'cert.pem'), str(directory / 'key.pem')
+    subprocess.check_call([openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                           '-keyout', key, '-out', cert, '-subj', '/CN=localhost',
+                           '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
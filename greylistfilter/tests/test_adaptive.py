@@ -0,0 +1,152 @@
+import pytest
+
+from ..adaptive import AdaptiveThresholds
+from ..simulators import Latency
+from ..smtpproxy import DCC_MANY, PostfixProxyHandler
+
+from .conftest import PG_RESPONSE_DUNNO, FakeClock, FixedReplySimulator
+
+
+def thresholds(clock, **kwargs):
+    params = dict(spam_max=5.0, dcc_max=DCC_MANY, latency_target=0.5, max_pending=10, step=0.5, interval=5,
+                  clock=clock)
+    params.update(kwargs)
+    return AdaptiveThresholds(1.0, 2, **params)
+
+
+def test_unchanged_before_interval():
+    clock = FakeClock()
+    adaptive = thresholds(clock)
+
+    adaptive.lookup_finished(10.0)
+    clock.now += 4
+    assert adaptive.thresholds() == (1.0, 2)
+
+
+def test_raised_by_latency_then_lowered():
+    clock = FakeClock()
+    adaptive = thresholds(clock)
+
+    for _ in range(20):
+        adaptive.lookup_started()
+        adaptive.lookup_finished(2.0)
+
+    clock.now += 5
+    spam, dcc = adaptive.thresholds()
+    assert spam == 3.0
+    assert 2 < dcc < DCC_MANY
+
+    clock.now += 5
+    assert adaptive.thresholds() == (5.0, DCC_MANY)
+    # held at the upper bounds
+    clock.now += 5
+    assert adaptive.thresholds() == (5.0, DCC_MANY)
+
+    for _ in range(40):
+        adaptive.lookup_started()
+        adaptive.lookup_finished(0.0)
+
+    clock.now += 5
+    assert adaptive.thresholds()[0] == 3.0
+    clock.now += 5
+    assert adaptive.thresholds() == (1.0, 2)
+
+
+def test_lowered_once_lookups_stop():
+    clock = FakeClock()
+    adaptive = thresholds(clock)
+
+    for _ in range(20):
+        adaptive.lookup_started()
+        adaptive.lookup_finished(2.0)
+    for _ in range(2):
+        clock.now += 5
+        adaptive.thresholds()
+    assert adaptive.thresholds() == (5.0, DCC_MANY)
+
+    # no more lookups at the raised thresholds, yet the latency estimate decays
+    levels = []
+    for _ in range(12):
+        clock.now += 5
+        levels.append(adaptive.thresholds())
+
+    assert levels[0] == (5.0, DCC_MANY)
+    assert levels[-1] == (1.0, 2)
+    assert adaptive.latency < 0.1
+
+
+def test_raised_by_pending_lookups():
+    clock = FakeClock()
+    adaptive = thresholds(clock)
+
+    for _ in range(11):
+        adaptive.lookup_started()
+
+    clock.now += 5
+    assert adaptive.thresholds()[0] == 3.0
+    assert adaptive.state()['pending'] == 11
+
+
+def test_raised_by_verdict_rate():
+    clock = FakeClock()
+    adaptive = thresholds(clock, max_rate=1.0)
+
+    for _ in range(10):
+        adaptive.observe_verdict(True)
+    adaptive.observe_verdict(False)
+
+    clock.now += 5
+    assert adaptive.thresholds()[0] == 3.0
+
+
+def test_lowered_to_lower_bounds_when_idle():
+    clock = FakeClock()
+    adaptive = thresholds(clock, spam_min=0.5, dcc_min=2, step=1.0)
+
+    clock.now += 5
+    assert adaptive.thresholds() == (0.5, 2)
+    assert adaptive.state()['level'] == -1.0
+
+
+def test_raised_at_once_after_idling_without_lower_bounds():
+    clock = FakeClock()
+    adaptive = thresholds(clock)
+
+    # idle for a long while, with nothing below the configured thresholds to go down to
+    for _ in range(20):
+        clock.now += 5
+        assert adaptive.thresholds() == (1.0, 2)
+    assert adaptive.state()['level'] == 0.0
+
+    for _ in range(11):
+        adaptive.lookup_started()
+    clock.now += 5
+    assert adaptive.thresholds()[0] == 3.0
+
+
+def test_bounds_never_narrower_than_configured():
+    adaptive = AdaptiveThresholds(3.0, 10, spam_max=1.0, dcc_max=5, spam_min=4.0, dcc_min=20)
+
+    assert (adaptive.spam_min, adaptive.spam_max) == (3.0, 3.0)
+    assert (adaptive.dcc_min, adaptive.dcc_max) == (10, 10)
+
+
+@pytest.mark.asyncio
+async def test_handler_uses_effective_thresholds(run_simulator):
+    clock = FakeClock()
+    adaptive = thresholds(clock, step=1.0)
+    server = run_simulator(FixedReplySimulator(PG_RESPONSE_DUNNO, Latency('fixed', 0.1)))
+    handler = PostfixProxyHandler(None, 1.0, 2, pgport=server.port, adaptive=adaptive)
+    status = {'spam': 2.0, 'dcc': 5}
+
+    assert handler.status_conditions_met(status)
+    assert await handler.lookup_triplet('a@test.com', 'b@test.com', '192.0.2.1', 'mail.test.com') == \
+        PG_RESPONSE_DUNNO
+
+    assert adaptive.pending == 0
+    assert adaptive.latency > 0
+
+    adaptive.latency_target = 0.001
+    clock.now += 5
+    assert handler.effective_thresholds() == (5.0, DCC_MANY)
+    assert not handler.status_conditions_met(status)
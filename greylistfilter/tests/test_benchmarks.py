@@ -0,0 +1,35 @@
+import json
+
+from benchmarks import microbench
+
+
+def test_microbench_runs(tmp_path):
+    results = microbench.run(number=1, repeat=1, queries=10, messages=2)
+
+    names = set(results)
+    for fixture in microbench.header_fixtures():
+        assert 'byte_lines/%s' % fixture in names
+        assert 'get_spam_status/%s' % fixture in names
+    for fixture in microbench.dcc_fixtures():
+        assert 'parse_dcc/%s' % fixture in names
+    assert 'greylist_status/concurrency=10' in names
+    assert 'greylist_status/unix/concurrency=10' in names
+    for transport in ('smtp', 'smtp-unix', 'lmtp', 'lmtp-unix', 'smtp-pooled'):
+        assert 'relay/%s' % transport in names
+    assert 'startup/check-config' in names
+    assert all(seconds > 0 for seconds in results.values())
+
+    path = microbench.save(str(tmp_path), results)
+    with open(path) as input:
+        saved = json.load(input)
+    assert saved['results'] == results
+
+
+def test_startup_budget():
+    # generous, the point is to catch a heavy import creeping back in
+    assert microbench.time_startup(repeat=3) < 2.0
+
+    modules = microbench.imported_modules()
+    assert 'greylistfilter.config' in modules
+    for module in ('asyncio', 'aiosmtpd', 'greylistfilter.smtpproxy', 'logging.handlers', 'smtplib', 'ssl'):
+        assert module not in modules
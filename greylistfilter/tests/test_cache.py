@@ -0,0 +1,258 @@
+import asyncio
+import gc
+import multiprocessing
+
+import pytest
+
+from ..cache import BUCKET_SLOTS, SharedCacheError, SharedVerdictCache, VerdictCache, age_reply
+
+from .conftest import PG_RESPONSE_DEFER, PG_RESPONSE_DUNNO, FakeClock
+
+KEY = ('1.2.3.4', 'b@test.com', 'a@test.com')
+
+
+def fetcher(reply, delay=0.01):
+    calls = []
+
+    async def _fetch():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    return _fetch, calls
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_coalesced():
+    cache = VerdictCache()
+    fetch, calls = fetcher(PG_RESPONSE_DUNNO)
+
+    results = await asyncio.gather(*(cache.lookup(KEY, fetch) for _ in range(10)))
+
+    assert results == [PG_RESPONSE_DUNNO] * 10
+    assert len(calls) == 1
+    assert cache.misses == 1
+    assert cache.hits == 9
+
+    # nothing is cached for a pass, so the next lookup goes to the server
+    await cache.lookup(KEY, fetch)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_deferral_cached_until_ttl():
+    clock = FakeClock()
+    cache = VerdictCache(ttl=60, clock=clock)
+    fetch, calls = fetcher(PG_RESPONSE_DEFER + ' Greylisted')
+
+    assert await cache.lookup(KEY, fetch) == PG_RESPONSE_DEFER + ' Greylisted'
+    assert len(cache) == 1
+
+    clock.now += 59
+    assert cache.get_cached(KEY) == (PG_RESPONSE_DEFER + ' Greylisted', 1)
+    assert await cache.lookup(KEY, fetch) == PG_RESPONSE_DEFER + ' Greylisted'
+    assert len(calls) == 1
+
+    clock.now += 1
+    await cache.lookup(KEY, fetch)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_deferral_delay_counts_down():
+    clock = FakeClock()
+    cache = VerdictCache(ttl=60, clock=clock)
+    fetch, calls = fetcher(PG_RESPONSE_DEFER + ' Greylisted for 300 seconds')
+
+    await cache.lookup(KEY, fetch)
+    clock.now += 45
+
+    assert await cache.lookup(KEY, fetch) == PG_RESPONSE_DEFER + ' Greylisted for 255 seconds'
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('reply,elapsed,expected', (
+    ('action=DEFER_IF_PERMIT Greylisted, see http://example.com', 10,
+     'action=DEFER_IF_PERMIT Greylisted, see http://example.com'),
+    ('action=DEFER_IF_PERMIT Greylisted for 300 seconds', 0, 'action=DEFER_IF_PERMIT Greylisted for 300 seconds'),
+    ('action=DEFER_IF_PERMIT Greylisted for 30 seconds', 59.5, 'action=DEFER_IF_PERMIT Greylisted for 0 seconds'),
+))
+def test_age_reply(reply, elapsed, expected):
+    assert age_reply(reply, elapsed) == expected
+
+
+@pytest.mark.asyncio
+async def test_deferral_not_cached_without_ttl():
+    cache = VerdictCache()
+    fetch, calls = fetcher(PG_RESPONSE_DEFER)
+
+    await cache.lookup(KEY, fetch)
+    await cache.lookup(KEY, fetch)
+
+    assert len(calls) == 2
+    assert len(cache) == 0
+
+
+def test_maxsize():
+    cache = VerdictCache(ttl=60, maxsize=2)
+
+    for i in range(3):
+        cache.store(('1.2.3.%d' % i, 'b', 'a'), PG_RESPONSE_DEFER)
+
+    assert len(cache) == 2
+    assert cache.get_cached(('1.2.3.0', 'b', 'a')) == (None, 0)
+
+
+@pytest.mark.asyncio
+async def test_errors_shared_and_not_cached():
+    cache = VerdictCache(ttl=60)
+    fetch, calls = fetcher(ConnectionRefusedError('no server'))
+
+    results = await asyncio.gather(*(cache.lookup(KEY, fetch) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(r, ConnectionRefusedError) for r in results)
+    assert len(calls) == 1
+    assert len(cache) == 0
+
+    with pytest.raises(ConnectionRefusedError):
+        await cache.lookup(KEY, fetch)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_cancel_lookup():
+    cache = VerdictCache()
+    fetch, calls = fetcher(PG_RESPONSE_DUNNO, delay=0.05)
+
+    first = asyncio.ensure_future(cache.lookup(KEY, fetch))
+    second = asyncio.ensure_future(cache.lookup(KEY, fetch))
+    await asyncio.sleep(0.01)
+    first.cancel()
+
+    assert await second == PG_RESPONSE_DUNNO
+    assert first.cancelled()
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_lookup_without_waiters(caplog):
+    cache = VerdictCache()
+    fetch, calls = fetcher(ConnectionRefusedError('no server'), delay=0.02)
+
+    waiter = asyncio.ensure_future(cache.lookup(KEY, fetch))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    await asyncio.sleep(0.03)
+    del waiter
+    gc.collect()
+
+    assert len(calls) == 1
+    assert 'never retrieved' not in caplog.text
+
+
+@pytest.fixture
+def shared_path(tmp_path):
+    return str(tmp_path / 'verdicts')
+
+
+def _store_range(path, start, count):
+    cache = SharedVerdictCache(path, ttl=60)
+    for i in range(start, start + count):
+        cache.store(('10.0.%d.%d' % (i // 256, i % 256), 'b@test.com', 'a@test.com'), PG_RESPONSE_DEFER)
+    cache.close()
+
+
+def test_shared_cache_across_processes(shared_path):
+    cache = SharedVerdictCache(shared_path, ttl=60)
+
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_store_range, args=(shared_path, n * 100, 100)) for n in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    assert len(cache) == 400
+    reply, remaining = cache.get_cached(('10.0.1.44', 'b@test.com', 'a@test.com'))
+    assert reply == PG_RESPONSE_DEFER
+    assert 0 < remaining <= 60
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_lookup(shared_path):
+    clock = FakeClock()
+    first = SharedVerdictCache(shared_path, ttl=60, clock=clock)
+    second = SharedVerdictCache(shared_path, ttl=60, clock=clock)
+    fetch, calls = fetcher(PG_RESPONSE_DEFER + ' Greylisted')
+
+    assert await first.lookup(KEY, fetch) == PG_RESPONSE_DEFER + ' Greylisted'
+    assert await second.lookup(KEY, fetch) == PG_RESPONSE_DEFER + ' Greylisted'
+    assert len(calls) == 1
+    assert second.hits == 1
+
+    clock.now += 60
+    assert second.get_cached(KEY) == (None, 0)
+    assert len(second) == 0
+
+    # passes are never cached
+    second.store(KEY, PG_RESPONSE_DUNNO)
+    assert first.get_cached(KEY) == (None, 0)
+
+    first.close()
+    second.close()
+
+
+def test_shared_cache_full_bucket_evicts_oldest(shared_path):
+    clock = FakeClock()
+    # a single bucket
+    cache = SharedVerdictCache(shared_path, ttl=60, maxsize=1, clock=clock)
+
+    keys = [('1.2.3.%d' % i, 'b', 'a') for i in range(BUCKET_SLOTS + 1)]
+    for key in keys:
+        cache.store(key, PG_RESPONSE_DEFER)
+        clock.now += 1
+
+    assert len(cache) == BUCKET_SLOTS
+    assert cache.get_cached(keys[0]) == (None, 0)
+    assert cache.get_cached(keys[-1])[0] == PG_RESPONSE_DEFER
+
+    # storing an existing key updates it in place
+    cache.store(keys[-1], PG_RESPONSE_DEFER + ' again')
+    assert len(cache) == BUCKET_SLOTS
+    assert cache.get_cached(keys[-1]) == (PG_RESPONSE_DEFER + ' again', 60)
+    cache.close()
+
+
+def test_shared_cache_export_restore(shared_path, tmp_path):
+    cache = SharedVerdictCache(shared_path, ttl=60)
+    cache.store(KEY, PG_RESPONSE_DEFER)
+    cache.store(('5.6.7.8', 'x' * 1000, 'a'), PG_RESPONSE_DEFER)
+
+    entries = cache.export()
+    assert [(key, reply) for key, reply, _ in entries] == [(KEY, PG_RESPONSE_DEFER)]
+    cache.close()
+
+    other = SharedVerdictCache(str(tmp_path / 'other'), ttl=30)
+    other.restore(entries)
+    reply, remaining = other.get_cached(KEY)
+    assert reply == PG_RESPONSE_DEFER
+    assert remaining <= 30
+    other.close()
+
+
+def test_shared_cache_existing_file(shared_path):
+    SharedVerdictCache(shared_path, maxsize=100).close()
+
+    # the size of an existing file wins
+    cache = SharedVerdictCache(shared_path, maxsize=10000)
+    assert cache.buckets == 100 // BUCKET_SLOTS + 1
+    cache.close()
+
+    with open(shared_path, 'r+b') as output:
+        output.write(b'JUNK')
+    with pytest.raises(SharedCacheError):
+        SharedVerdictCache(shared_path)
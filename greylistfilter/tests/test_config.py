@@ -0,0 +1,143 @@
+import socket
+
+import pytest
+
+from ..adaptive import AdaptiveThresholds
+from ..config import ConfigError, load_config, reload_config
+from ..control import ControlServer
+from ..controller import ServerController
+from ..lanes import TrafficLanes
+from ..relay import RelayPool
+from ..smtpproxy import DCC_MANY, PostfixProxyHandler
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / 'greylistfilter.ini'
+
+    def _write(text):
+        path.write_text('[greylistfilter]\n' + text)
+        return str(path)
+
+    return _write
+
+
+def test_load_config(config_file):
+    path = config_file('spam = 2.5\ndcc = many\nrelay = None\npgport = 10024\nearly-lookup = yes\n')
+
+    assert load_config(path) == {
+        'spam': 2.5,
+        'dcc': DCC_MANY,
+        'relay': None,
+        'pgport': 10024,
+        'early_lookup': True,
+    }
+
+
+@pytest.mark.parametrize('text', (
+    'spam = lots\n',
+    'dcc = 1\n',
+    'early_lookup = perhaps\n',
+    'port = 25\n',
+    'pgport = -1\n',
+    'defer_ttl = -60\n',
+    'max_header_bytes = 0\n',
+))
+def test_load_config_invalid(config_file, text):
+    with pytest.raises(ConfigError):
+        load_config(config_file('pghost = 127.0.0.2\n' + text))
+
+
+def test_load_config_unreadable(tmp_path):
+    with pytest.raises(ConfigError):
+        load_config(str(tmp_path / 'missing.ini'))
+
+    path = tmp_path / 'other.ini'
+    path.write_text('[other]\nspam = 1\n')
+    with pytest.raises(ConfigError):
+        load_config(str(path))
+
+
+def test_reconfigure(config_file):
+    adaptive = AdaptiveThresholds(1.0, 2, spam_max=5.0, dcc_max=10)
+    handler = PostfixProxyHandler('127.0.0.1:10026', 1.0, 2, defer_ttl=60, adaptive=adaptive)
+
+    reload_config(config_file('spam = 3\ndcc = 4\nrelay = 127.0.0.1:10027\ndefer_ttl = 0\n'), handler)
+
+    assert handler.relay == '127.0.0.1:10027'
+    assert handler.verdicts.ttl == 0
+    assert handler.effective_thresholds() == (3.0, 4)
+    assert adaptive.spam_max == 5.0
+
+    # a bad file changes nothing
+    with pytest.raises(ConfigError):
+        reload_config(config_file('spam = 4\ndcc = 0\n'), handler)
+    assert (handler.spam, handler.dcc) == (3.0, 4)
+
+    # the settings given on the command line stay as they are
+    reload_config(config_file('spam = 5\ndcc = 6\n'), handler, fixed=('spam',))
+    assert (handler.spam, handler.dcc) == (3.0, 6)
+
+
+def test_reconfigure_pools(config_file, caplog):
+    pool = RelayPool(4)
+    handler = PostfixProxyHandler('127.0.0.1:10026', 1.0, 2, lanes=TrafficLanes(), relay_pool=pool)
+
+    reload_config(config_file('clean_concurrency = 50\ncandidate_relay_workers = 2\nrelay_pool = 8\n'), handler)
+
+    assert handler.lanes.clean.concurrency == 50
+    assert handler.lanes.candidate.concurrency == 20
+    assert handler.lanes.candidate.relay_workers == 2
+    assert pool.size == 8
+
+    with pytest.raises(ConfigError):
+        reload_config(config_file('candidate_concurrency = 0\n'), handler)
+
+    # without a pool to resize, the setting needs a restart
+    handler.relay_pool = None
+    reload_config(config_file('relay_pool = 2\n'), handler)
+    assert 'needs a restart' in caplog.text
+    handler.lanes.close()
+
+
+def control_command(path, command):
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        reader = sock.makefile('rb')
+        sock.sendall(command + b'\n')
+        reply = {}
+        for line in reader:
+            if line == b'\n':
+                break
+            name, _, value = line.decode().rstrip('\n').partition('=')
+            reply[name] = value
+        reader.close()
+        return reply
+
+
+class ControlOnly(ControlServer):
+    """
+    Runs the control server alone under a ServerController
+    """
+
+    async def start(self, host, port):
+        return await super().start(host)
+
+
+def test_control_socket(tmp_path, config_file):
+    handler = PostfixProxyHandler(None, 1.0, 2)
+    path = str(tmp_path / 'control.sock')
+    controller = ServerController(ControlOnly(handler, config_file('spam = 2\n')), hostname=path)
+    controller.start()
+
+    try:
+        status = control_command(path, b'status')
+        assert status['spam'] == '1.0'
+        assert status['cache_hits'] == '0'
+
+        assert control_command(path, b'reload') == {'reloaded': 'spam'}
+        assert control_command(path, b'status')['spam'] == '2.0'
+
+        assert 'error' in control_command(path, b'bogus')
+    finally:
+        controller.stop()
@@ -1,6 +1,8 @@
+import time
+
 import pytest
 
-from ..smtpproxy import PostfixProxyHandler, byte_lines
+from ..smtpproxy import DCC_MANY, PostfixProxyHandler, byte_lines, parse_dcc
 
 header_tpl = b'''
 To: Will Harris <host@domain.com>
@@ -60,32 +62,35 @@ def test_status_spam_and_dcc_from_data(pf_handler, data_bytes):
     assert status['dcc'] == 2
 
 
-@pytest.mark.parametrize('vals,groups', (
-    ((1, 2, 3), ('1', '2', '3')),
-    ((None, 2, 3), (None, '2', '3')),
-    ((1, None, 3), ('1', None, '3')),
-    ((1, 2, None), ('1', '2', None)),
-    ((-1, 2, 3), (None, '2', '3')),
-    ((1, -2, 3), ('1', None, '3')),
-    ((1, 2, -3), ('1', '2', None)),
+@pytest.mark.parametrize('vals,counts', (
+    ((1, 2, 3), (1, 2, 3)),
+    ((None, 2, 3), (None, 2, 3)),
+    ((1, None, 3), (1, None, 3)),
+    ((1, 2, None), (1, 2, None)),
+    ((-1, 2, 3), (None, 2, 3)),
+    ((1, -2, 3), (1, None, 3)),
+    ((1, 2, -3), (1, 2, None)),
+    (('many', '1x', 'x1'), (DCC_MANY, None, None)),
 ))
-def test_dcc_regex(vals, groups):
-    from ..smtpproxy import RE_DCC
-
-    comps = ['X-Spam-DCC: URT:bloggs 1060;']
+def test_parse_dcc(vals, counts):
+    comps = [b' URT:bloggs 1060;']
     if vals[0]:
-        comps.append('Body=%s' % vals[0])
+        comps.append(b'Body=%s' % str(vals[0]).encode())
     if vals[1]:
-        comps.append('Fuz1=%s' % vals[1])
+        comps.append(b'Fuz1=%s' % str(vals[1]).encode())
     if vals[2]:
-        comps.append('Fuz2=%s' % vals[2])
+        comps.append(b'Fuz2=%s' % str(vals[2]).encode())
+
+    assert parse_dcc(b' '.join(comps)) == counts
+
 
-    string = ' '.join(comps)
+def test_parse_dcc_pathological():
+    start = time.perf_counter()
 
-    match = RE_DCC.match(string)
+    assert parse_dcc(b' ' * 100000 + b'x') == (None, None, None)
+    assert parse_dcc(b'Body=' * 100000) == (None, None, None)
 
-    assert match
-    assert match.groups() == groups
+    assert time.perf_counter() - start < 1
 
 
 @pytest.mark.parametrize('body,fuz1,fuz2,result', (
@@ -143,3 +148,54 @@ def test_no_status_found(pf_handler):
     assert len(status) == 2
     assert status['spam'] == PostfixProxyHandler.DEFAULT_SPAM_SCORE
     assert status['dcc'] == PostfixProxyHandler.DEFAULT_DCC_SCORE
+
+
+def test_byte_lines_limit():
+    data = b'a\n\nbb\nccc'
+
+    assert list(byte_lines(data)) == [b'a\n', b'\n', b'bb\n', b'ccc']
+    assert list(byte_lines(data, 3)) == [b'a\n', b'\n']
+    assert list(byte_lines(data, 5)) == [b'a\n', b'\n', b'bb']
+
+
+def test_folded_dcc(pf_handler):
+    headers = (b'X-Spam-DCC: URT:bloggs 1060;\r\n'
+               b'\tBody=3 Fuz1=4\r\n'
+               b'  Fuz2=7\r\n'
+               b'X-Spam-Status: No, score=1.5 required=5.0\r\n'
+               b'X-Other: Fuz2=9\r\n'
+               b'\r\n')
+
+    status = pf_handler.get_spam_status(headers)
+
+    assert status == {'spam': 1.5, 'dcc': 7}
+
+
+def test_header_scan_truncated():
+    handler = PostfixProxyHandler(None, 1.0, 1, max_header_bytes=1000)
+    status_line = b'X-Spam-Status: No, score=1.5 required=5.0\r\n'
+
+    status = handler.get_spam_status(b'X-Junk: xxxxxxxxxxxxxxxxxxxx\r\n' * 100 + status_line)
+
+    assert status['spam'] == PostfixProxyHandler.DEFAULT_SPAM_SCORE
+    assert handler.truncated_scans == 1
+
+    status = handler.get_spam_status(status_line + b'X-Junk: xxxxxxxxxxxxxxxxxxxx\r\n' * 100)
+
+    assert status['spam'] == 1.5
+    assert handler.truncated_scans == 2
+
+    handler.get_spam_status(status_line + b'\r\n' + b'body\r\n' * 1000)
+
+    assert handler.truncated_scans == 2
+
+
+def test_long_lines_skipped():
+    handler = PostfixProxyHandler(None, 1.0, 1, max_line_length=100)
+
+    status = handler.get_spam_status(b'X-Spam-Status: No, score=1.5 required=5.0 tests=' + b'A,' * 100 + b'\r\n'
+                                     b'X-Spam-DCC: URT:bloggs 1060; Body=3\r\n'
+                                     b'\r\n')
+
+    assert status['spam'] == PostfixProxyHandler.DEFAULT_SPAM_SCORE
+    assert status['dcc'] == 3
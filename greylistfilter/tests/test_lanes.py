@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from ..lanes import Lane, TrafficLanes
+from ..smtpproxy import OK_REPLY, PostfixProxyEnvelope, PostfixProxyHandler, PostfixProxySession
+
+from .conftest import FakeClock
+
+CLEAN_DATA = b'Subject: clean\r\n\r\nHello\r\n'
+
+
+def make_message(skip_scoring=False):
+    session = PostfixProxySession(asyncio.get_event_loop())
+    session.fwd_info.addr = '192.0.2.1'
+    envelope = PostfixProxyEnvelope()
+    envelope.mail_from = 'b@test.com'
+    envelope.rcpt_tos = ['a@test.com']
+    envelope.content = CLEAN_DATA
+    envelope.skip_scoring = skip_scoring
+    return session, envelope
+
+
+@pytest.mark.asyncio
+async def test_lane_budget_and_metrics():
+    clock = FakeClock()
+    lane = Lane('test', 2, 1, clock)
+    release = asyncio.Event()
+
+    async def process():
+        async with lane:
+            await release.wait()
+
+    tasks = [asyncio.ensure_future(process()) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert (lane.active, lane.waiting) == (2, 1)
+
+    clock.now += 4
+    release.set()
+    await asyncio.gather(*tasks)
+
+    metrics = lane.metrics()
+    assert metrics['active'] == metrics['waiting'] == 0
+    assert metrics['processed'] == 3
+    assert metrics['wait_max'] == 4
+    assert metrics['wait_avg'] == pytest.approx(4 / 3)
+    lane.close()
+
+
+@pytest.mark.asyncio
+async def test_lane_resize():
+    lane = Lane('test', 2, 1)
+    release = asyncio.Event()
+
+    async def process():
+        async with lane:
+            await release.wait()
+
+    tasks = [asyncio.ensure_future(process()) for _ in range(4)]
+    await asyncio.sleep(0)
+    assert (lane.active, lane.waiting) == (2, 2)
+
+    lane.resize(concurrency=3)
+    await asyncio.sleep(0)
+    assert (lane.active, lane.waiting) == (3, 1)
+
+    # lowered, the message waiting goes through only once the budget allows
+    lane.resize(concurrency=1, relay_workers=2)
+    release.set()
+    await asyncio.gather(*tasks)
+    assert lane.processed == 4
+
+    release.clear()
+    tasks = [asyncio.ensure_future(process()) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert (lane.active, lane.waiting) == (1, 1)
+    release.set()
+    await asyncio.gather(*tasks)
+
+    assert lane.executor._max_workers == 2
+    assert await lane.run_in_pool(sum, [1, 2]) == 3
+    lane.close()
+
+
+@pytest.mark.asyncio
+async def test_run_in_pool():
+    lanes = TrafficLanes(clean_workers=1, candidate_workers=1)
+
+    assert await lanes.clean.run_in_pool(sum, [1, 2, 3]) == 6
+    lanes.close()
+
+
+@pytest.mark.asyncio
+async def test_clean_mail_not_held_up_by_candidates():
+    stalled = asyncio.Event()
+
+    async def stall(reader, writer):
+        await stalled.wait()
+        writer.close()
+
+    server = await asyncio.start_server(stall, host='127.0.0.1', port=0)
+    port = server.sockets[0].getsockname()[1]
+    lanes = TrafficLanes(clean_concurrency=2, candidate_concurrency=2)
+    handler = PostfixProxyHandler(None, 1.0, 2, pgport=port, lanes=lanes)
+
+    candidates = [asyncio.ensure_future(handler.handle_DATA(None, *make_message(skip_scoring=True)))
+                  for _ in range(5)]
+    await asyncio.sleep(0.1)
+
+    results = await asyncio.wait_for(
+        asyncio.gather(*(handler.handle_DATA(None, *make_message()) for _ in range(10))), 2)
+    assert results == [OK_REPLY] * 10
+
+    status = handler.status()
+    assert status['lane_clean_processed'] == 10
+    assert status['lane_candidate_active'] == 2
+    assert status['lane_candidate_waiting'] == 3
+    assert status['lane_candidate_processed'] == 0
+
+    stalled.set()
+    await asyncio.gather(*candidates)
+    assert handler.lanes.candidate.processed == 5
+    server.close()
+    handler.lanes.close()
@@ -0,0 +1,143 @@
+import pytest
+
+from ..controller import ServerController
+from ..milter import (
+    PROTOCOL_FLAGS, SMFIF_ADDHDRS, SMFIP_NOHELO, MilterMessage, MilterServer,
+)
+from ..ratelimit import ClientRateLimit
+from ..smtpproxy import RATE_LIMIT_REPLY, PostfixProxyHandler
+
+from .conftest import HAM_HEADERS, PG_RESPONSE_HEADER, PG_RESPONSE_PREPEND, SPAM_HEADERS, MilterClient
+
+
+@pytest.fixture
+def milter(policy_server, unused_tcp_port):
+    handler = PostfixProxyHandler(None, 1.0, 2, pgport=policy_server.port)
+    controller = ServerController(MilterServer(handler), port=unused_tcp_port)
+    controller.start()
+    client = MilterClient(unused_tcp_port)
+
+    yield client
+
+    client.close()
+    controller.stop()
+
+
+def test_negotiate(milter):
+    version, actions, protocol = milter.negotiate()
+    assert version == 6
+    assert actions == SMFIF_ADDHDRS
+    assert protocol == PROTOCOL_FLAGS
+
+
+def test_negotiate_masks_offered_flags(milter):
+    _, actions, protocol = milter.negotiate(actions=0, protocol=SMFIP_NOHELO)
+    assert actions == 0
+    assert protocol == SMFIP_NOHELO
+
+
+def test_headers_replied_to_unless_negotiated(milter, policy_server):
+    # the MTA offers none of the protocol options, so waits for a reply to each header
+    assert milter.negotiate(protocol=0)[2] == 0
+
+    command, data = milter.message(SPAM_HEADERS)
+    assert command == b'y'
+    assert data.startswith(b'451 4.7.1 ')
+
+
+def test_greylisted(milter, policy_server):
+    milter.negotiate()
+
+    command, data = milter.message(SPAM_HEADERS)
+    assert command == b'y'
+    assert data.startswith(b'451 4.7.1 ')
+
+    assert len(policy_server.requests) == 1
+    request = policy_server.requests[0]
+    assert request['recipient'] == 'a@test.com'
+    assert request['sender'] == 'b@test.com'
+    assert request['client_address'] == '192.0.2.1'
+    assert request['client_name'] == 'mail.example.com'
+
+
+def test_not_greylisted(milter, policy_server):
+    milter.negotiate()
+
+    assert milter.message(HAM_HEADERS) == (b'c', b'')
+    milter.send(b'E')
+    assert milter.reply() == (b'c', b'')
+    assert policy_server.requests == []
+
+
+def test_prepend_header(milter, policy_server):
+    policy_server.response = '%s %s' % (PG_RESPONSE_PREPEND, PG_RESPONSE_HEADER)
+    milter.negotiate()
+
+    assert milter.message(SPAM_HEADERS) == (b'c', b'')
+    milter.send(b'E')
+    name, value = PG_RESPONSE_HEADER.encode().split(b': ', 1)
+    # prepended, at index 0
+    assert milter.reply() == (b'i', b'\x00\x00\x00\x00%s\x00%s\x00' % (name, value))
+    assert milter.reply() == (b'c', b'')
+
+
+def test_prepend_header_not_allowed(milter, policy_server):
+    policy_server.response = '%s %s' % (PG_RESPONSE_PREPEND, PG_RESPONSE_HEADER)
+    milter.negotiate(actions=0)
+
+    assert milter.message(SPAM_HEADERS) == (b'c', b'')
+    milter.send(b'E')
+    assert milter.reply() == (b'c', b'')
+
+
+def test_abort_resets_message(milter, policy_server):
+    policy_server.response = '%s %s' % (PG_RESPONSE_PREPEND, PG_RESPONSE_HEADER)
+    milter.negotiate()
+
+    assert milter.message(SPAM_HEADERS) == (b'c', b'')
+    milter.send(b'A')
+    assert milter.message(HAM_HEADERS) == (b'c', b'')
+    milter.send(b'E')
+    assert milter.reply() == (b'c', b'')
+
+
+def test_lookup_failure_continues(unused_tcp_port_factory):
+    handler = PostfixProxyHandler(None, 1.0, 2, pgport=unused_tcp_port_factory())
+    port = unused_tcp_port_factory()
+    controller = ServerController(MilterServer(handler), port=port)
+    controller.start()
+
+    client = MilterClient(port)
+    try:
+        client.negotiate()
+        assert client.message(SPAM_HEADERS) == (b'c', b'')
+    finally:
+        client.close()
+        controller.stop()
+
+
+def test_rate_limit_tempfail(unused_tcp_port):
+    handler = PostfixProxyHandler(None, 1.0, 2, rate_limit=ClientRateLimit(1))
+    controller = ServerController(MilterServer(handler), port=unused_tcp_port)
+    controller.start()
+
+    client = MilterClient(unused_tcp_port)
+    try:
+        client.negotiate()
+        client.send(b'C', b'mail.example.com\x004\x00\x19192.0.2.1\x00')
+        assert client.reply() == (b'c', b'')
+        for expected in ((b'c', b''), (b'y', RATE_LIMIT_REPLY.encode() + b'\x00')):
+            client.send(b'M', b'<b@test.com>\x00')
+            assert client.reply() == expected
+            client.send(b'A')
+    finally:
+        client.close()
+        controller.stop()
+
+
+def test_header_lines_are_crlf():
+    server = MilterServer(PostfixProxyHandler(None, 1.0, 2))
+    message = MilterMessage()
+
+    server.add_header_line(b'X-Spam-Status\x00No,\n\tscore=2.1\x00', message)
+    assert message.headers == [b'X-Spam-Status: No,\r\n\tscore=2.1\r\n']
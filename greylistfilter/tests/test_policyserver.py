@@ -0,0 +1,86 @@
+import socket
+
+import pytest
+
+from ..controller import ServerController
+from ..policyserver import DUNNO, RATE_LIMIT_ACTION, PolicyServer
+from ..ratelimit import GREYLIST, TEMPFAIL, ClientRateLimit
+from ..smtpproxy import PostfixProxyHandler
+
+from .conftest import PG_RESPONSE_DEFER
+
+
+def policy_request(queue_id='4A1B2C3D4E', state='END-OF-MESSAGE', **attrs):
+    request = {
+        'request': 'smtpd_access_policy',
+        'protocol_state': state,
+        'queue_id': queue_id,
+        'client_address': '192.0.2.1',
+        'client_name': 'mail.example.com',
+        'sender': 'b@test.com',
+        'recipient': 'a@test.com',
+    }
+    request.update(attrs)
+    return request
+
+
+@pytest.fixture
+def policy(mocker):
+    handler = PostfixProxyHandler(None, 1.0, 2)
+    lookups = []
+
+    async def lookup_triplet(*args):
+        lookups.append(args)
+        return PG_RESPONSE_DEFER + ' Greylisted'
+
+    mocker.patch.object(handler, 'lookup_triplet', side_effect=lookup_triplet)
+    mocker.patch.object(handler, 'check_client_rate', return_value=GREYLIST)
+    server = PolicyServer(handler)
+    server.lookups = lookups
+    return server
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('action,request_attrs,expected', (
+    (GREYLIST, {}, PG_RESPONSE_DEFER + ' Greylisted'),
+    (TEMPFAIL, {}, RATE_LIMIT_ACTION),
+    (None, {}, DUNNO),
+    (GREYLIST, {'state': 'RCPT'}, DUNNO),
+    # with several recipients, Postfix doesn't give one
+    (GREYLIST, {'recipient': ''}, DUNNO),
+))
+async def test_decide(policy, action, request_attrs, expected):
+    policy.handler.check_client_rate.return_value = action
+
+    assert await policy.decide(policy_request(**request_attrs)) == expected
+    assert len(policy.lookups) == (1 if expected.startswith(PG_RESPONSE_DEFER) else 0)
+
+
+@pytest.mark.asyncio
+async def test_decide_lookup_failure(policy):
+    policy.handler.lookup_triplet.side_effect = ConnectionRefusedError()
+
+    assert await policy.decide(policy_request()) == DUNNO
+
+
+def test_policy_service(policy_server, unused_tcp_port):
+    # the client is over its limit from its second message on
+    handler = PostfixProxyHandler(None, 1.0, 2, pgport=policy_server.port,
+                                  rate_limit=ClientRateLimit(1, GREYLIST))
+    controller = ServerController(PolicyServer(handler), port=unused_tcp_port)
+    controller.start()
+
+    try:
+        with socket.create_connection(('127.0.0.1', unused_tcp_port)) as sock:
+            reader = sock.makefile('rb')
+            # Postfix sends all of its requests over one connection
+            for queue_id, expected in (('QUEUE1', DUNNO), ('QUEUE2', PG_RESPONSE_DEFER)):
+                request = policy_request(queue_id)
+                sock.sendall(''.join('%s=%s\n' % item for item in request.items()).encode() + b'\n')
+                assert reader.readline().decode().rstrip() == expected
+                assert reader.readline() == b'\n'
+    finally:
+        controller.stop()
+
+    assert len(policy_server.requests) == 1
+    assert policy_server.requests[0]['client_address'] == '192.0.2.1'
@@ -1,8 +1,10 @@
+import asyncio
+
 import pytest
 
-from ..postgrey_client import greylist_status
+from ..postgrey_client import PolicyError, greylist_status, percentile, run_bench
 
-from .conftest import PG_RESPONSE_DEFER
+from .conftest import PG_RESPONSE_DEFER, PG_RESPONSE_DUNNO, handle_conn
 
 
 @pytest.mark.asyncio
@@ -10,3 +12,99 @@ async def test_postgrey_client(pg_server):
     result = await greylist_status('a', 'b', 'c', 'd', port=pg_server.port)
 
     assert result == PG_RESPONSE_DEFER
+
+
+async def start_server(handler):
+    server = await asyncio.start_server(handler, host='127.0.0.1', port=0)
+    server.port = server.sockets[0].getsockname()[1]
+    return server
+
+
+@pytest.mark.asyncio
+async def test_reply():
+    server = await start_server(handle_conn)
+
+    result = await greylist_status('a', 'b', 'c', 'd', port=server.port)
+
+    assert result == PG_RESPONSE_DEFER
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_timeout():
+    async def stall(reader, writer):
+        await asyncio.sleep(1)
+        writer.close()
+
+    server = await start_server(stall)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await greylist_status('a', 'b', 'c', 'd', port=server.port, timeout=0.1)
+
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_truncated_reply():
+    async def hang_up(reader, writer):
+        await reader.readline()
+        writer.write(b'action=DUNNO\n')
+        writer.close()
+
+    server = await start_server(hang_up)
+
+    with pytest.raises(PolicyError):
+        await greylist_status('a', 'b', 'c', 'd', port=server.port, timeout=1)
+
+    server.close()
+
+
+def test_percentile():
+    values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+
+    assert percentile([], 0.5) == 0.0
+    assert percentile(values, 0.5) == 5
+    assert percentile(values, 0.9) == 9
+    assert percentile(values, 0.99) == 10
+    assert percentile(values, 1.0) == 10
+
+
+@pytest.mark.asyncio
+async def test_bench():
+    requests = []
+
+    async def dunno(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line or line == b'\n':
+                break
+            requests.append(line)
+        writer.write(b'%s\n\n' % PG_RESPONSE_DUNNO.encode())
+        writer.close()
+
+    server = await start_server(dunno)
+
+    stats = await run_bench(port=server.port, requests=50, concurrency=5, timeout=1, triplets=10)
+
+    assert stats['completed'] == 50
+    assert stats['errors'] == {}
+    assert stats['actions'] == {PG_RESPONSE_DUNNO: 50}
+    assert stats['qps'] > 0
+    assert 0 < stats['latency']['p50'] <= stats['latency']['p99'] <= stats['latency']['max']
+    assert len(set(r for r in requests if r.startswith(b'recipient='))) == 10
+
+    server.close()
+    stats = await run_bench(port=server.port, requests=5, concurrency=2, timeout=1)
+    assert stats['completed'] == 0
+    assert sum(stats['errors'].values()) == 5
+
+
+@pytest.mark.asyncio
+async def test_unix_socket(tmp_path):
+    path = str(tmp_path / 'postgrey.sock')
+    server = await asyncio.start_unix_server(handle_conn, path)
+
+    result = await greylist_status('a', 'b', 'c', 'd', host='unix:%s' % path)
+
+    assert result == PG_RESPONSE_DEFER
+    server.close()
@@ -0,0 +1,88 @@
+import pytest
+
+from ..ratelimit import GREYLIST, TARPIT, TEMPFAIL, ClientRateLimit, CountMinSketch
+
+from .conftest import FakeClock
+
+
+def test_sketch_never_underestimates():
+    sketch = CountMinSketch(width=64, depth=4)
+    counts = {'10.0.0.%d' % i: i % 7 + 1 for i in range(200)}
+
+    for key, count in counts.items():
+        sketch.add(sketch.indexes(key), count)
+
+    for key, count in counts.items():
+        assert sketch.estimate(sketch.indexes(key)) >= count
+
+    sketch.clear()
+    assert sketch.estimate(sketch.indexes('10.0.0.1')) == 0
+
+
+def test_sliding_window():
+    clock = FakeClock()
+    limit = ClientRateLimit(3, window=60, slices=6, clock=clock)
+
+    for _ in range(3):
+        assert limit.check('192.0.2.1') is None
+        clock.now += 15
+    assert limit.check('192.0.2.1') == TEMPFAIL
+    assert limit.limited == 1
+
+    # the first messages have slid out of the window
+    clock.now += 30
+    assert limit.count('192.0.2.1') == 3
+
+    clock.now += 600
+    assert limit.count('192.0.2.1') == 1
+
+
+@pytest.mark.parametrize('addr,key', (
+    ('192.0.2.77', '192.0.2.0/24'),
+    ('2001:db8::1:2', '2001:db8::/48'),
+    ('unknown', 'unknown'),
+))
+def test_client_key(addr, key):
+    limit = ClientRateLimit(1, ipv4_prefix=24, ipv6_prefix=48)
+    assert limit.client_key(addr) == key
+
+
+def test_subnet_counted_together():
+    limit = ClientRateLimit(2, TARPIT, ipv4_prefix=24)
+
+    assert limit.check('192.0.2.1') is None
+    assert limit.check('192.0.2.2') is None
+    assert limit.check('192.0.2.3') == TARPIT
+    assert limit.check('198.51.100.1') is None
+    assert limit.check(None) is None
+
+
+def test_top_clients():
+    limit = ClientRateLimit(100, GREYLIST, top=2)
+
+    for n, addr in enumerate(('192.0.2.1', '192.0.2.2', '192.0.2.3')):
+        for _ in range(n + 1):
+            limit.count(addr)
+
+    assert limit.top_clients() == [('192.0.2.3/32', 3), ('192.0.2.2/32', 2)]
+
+
+def test_top_clients_age_with_window():
+    clock = FakeClock()
+    limit = ClientRateLimit(100, GREYLIST, window=60, top=2, clock=clock)
+    for addr in ('192.0.2.1', '192.0.2.2'):
+        for _ in range(50):
+            limit.count(addr)
+
+    # once the burst has left the window, lighter clients take its place
+    clock.now += 61
+    limit.count('198.51.100.1')
+    limit.count('198.51.100.2')
+    limit.count('198.51.100.2')
+
+    assert limit.top_clients() == [('198.51.100.2/32', 2), ('198.51.100.1/32', 1)]
+
+
+def test_unknown_action():
+    with pytest.raises(ValueError):
+        ClientRateLimit(1, 'drop')
@@ -0,0 +1,374 @@
+import asyncio
+import smtplib
+import ssl
+import time
+
+import pytest
+
+from aiosmtpd.lmtp import LMTP
+from aiosmtpd.smtp import SMTP
+
+from ..controller import ServerController
+from ..relay import RelayPool, connect_relay, make_tls_context
+from ..relayaddress import RelayAddress, parse_relay_address
+from ..simulators import RelaySimulator
+from ..smtpproxy import OK_REPLY, PostfixProxyEnvelope, PostfixProxyHandler, PostfixProxySession
+from ..spool import Spool
+
+from .conftest import FakeClock
+
+DATA = b'Subject: relayed\r\n\r\nHello\r\n'
+
+
+class RecipientHandler:
+    """
+    Answers the end of data once for every recipient, as an LMTP server
+    does, with the code given for the recipient, or refuses the recipients
+    given `rcpt_codes` at RCPT
+    """
+
+    def __init__(self, codes=None, rcpt_codes=None):
+        self.codes = codes or {}
+        self.rcpt_codes = rcpt_codes or {}
+        self.envelope = None
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.rcpt_codes:
+            return '%d refused %s' % (self.rcpt_codes[address], address)
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelope = envelope
+        replies = ['%d reply for %s' % (self.codes.get(rcpt, 250), rcpt) for rcpt in envelope.rcpt_tos]
+        if isinstance(server, LMTP):
+            return '\r\n'.join(replies)
+        return replies[0]
+
+
+class RelayServer:
+    """
+    An aiosmtpd SMTP or LMTP server on a Unix socket or a TCP port, to be
+    run by a ServerController
+    """
+
+    def __init__(self, handler, protocol=SMTP, path=None):
+        self.handler = handler
+        self.protocol = protocol
+        self.path = path
+        self._server = None
+
+    async def start(self, hostname, port):
+        loop = asyncio.get_event_loop()
+        if self.path:
+            self._server = await loop.create_unix_server(lambda: self.protocol(self.handler), self.path)
+        else:
+            self._server = await loop.create_server(lambda: self.protocol(self.handler), hostname, port)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+@pytest.fixture
+def relay_factory(tmp_path, unused_tcp_port_factory):
+    controllers = []
+
+    def _relay(transport, codes=None, rcpt_codes=None):
+        """
+        Start a relay, returning its name and handler
+        """
+        handler = RecipientHandler(codes, rcpt_codes)
+        protocol = LMTP if transport.startswith('lmtp') else SMTP
+        if transport.endswith('unix'):
+            path = str(tmp_path / ('%s.sock' % transport))
+            controller = ServerController(RelayServer(handler, protocol, path))
+            name = '%sunix:%s' % ('lmtp:' if protocol is LMTP else '', path)
+        else:
+            controller = ServerController(RelayServer(handler, protocol), port=unused_tcp_port_factory())
+            name = '%s127.0.0.1:%d' % ('lmtp:' if protocol is LMTP else '', controller.port)
+        controller.start()
+        controllers.append(controller)
+        return name, handler
+
+    yield _relay
+
+    for controller in controllers:
+        controller.stop()
+
+
+@pytest.mark.parametrize('value,address', (
+    ('127.0.0.1:10026', RelayAddress('smtp', '127.0.0.1', 10026, None)),
+    ('mail.example.com', RelayAddress('smtp', 'mail.example.com', 25, None)),
+    ('unix:/run/relay.sock', RelayAddress('smtp', None, None, '/run/relay.sock')),
+    ('lmtp:127.0.0.1:24', RelayAddress('lmtp', '127.0.0.1', 24, None)),
+    ('lmtp:inet:localhost', RelayAddress('lmtp', 'localhost', 2003, None)),
+    ('lmtp:unix:/run/lmtp', RelayAddress('lmtp', None, None, '/run/lmtp')),
+))
+def test_parse_relay_address(value, address):
+    assert parse_relay_address(value) == address
+
+
+@pytest.mark.parametrize('value', ('', ':25', 'host:port', 'unix:relay.sock', 'lmtp:unix:'))
+def test_parse_invalid_relay_address(value):
+    with pytest.raises(ValueError):
+        parse_relay_address(value)
+
+
+@pytest.mark.parametrize('transport', ('smtp', 'smtp-unix', 'lmtp', 'lmtp-unix'))
+def test_send_to_relay(relay_factory, transport):
+    relay, received = relay_factory(transport)
+    handler = PostfixProxyHandler(relay, 1.0, 2)
+
+    assert handler.send_to_relay('b@test.com', ['a@test.com', 'c@test.com'], DATA) == {}
+
+    assert received.envelope.mail_from == 'b@test.com'
+    assert received.envelope.rcpt_tos == ['a@test.com', 'c@test.com']
+    assert received.envelope.content == DATA
+
+
+def test_lmtp_replies_per_recipient(relay_factory):
+    relay, _ = relay_factory('lmtp-unix', {'c@test.com': 452})
+
+    with connect_relay(relay) as client:
+        refused = client.sendmail('b@test.com', ['a@test.com', 'c@test.com'], DATA)
+        # every reply has been read, so the connection can be used again
+        assert client.noop()[0] == 250
+
+    assert refused == {'c@test.com': (452, b'reply for c@test.com')}
+
+
+def test_lmtp_nothing_delivered(relay_factory):
+    relay, _ = relay_factory('lmtp', {'a@test.com': 451, 'c@test.com': 550})
+
+    with connect_relay(relay) as client:
+        with pytest.raises(smtplib.SMTPRecipientsRefused) as error:
+            client.sendmail('b@test.com', ['a@test.com', 'c@test.com'], DATA)
+
+    # each recipient with its own reply, not all with the first
+    assert error.value.recipients == {'a@test.com': (451, b'reply for a@test.com'),
+                                      'c@test.com': (550, b'reply for c@test.com')}
+
+
+async def deliver_through_proxy(handler, rcpt_tos=('a@test.com', 'c@test.com', 'd@test.com')):
+    session = PostfixProxySession(asyncio.get_event_loop())
+    session.fwd_info.addr = '192.0.2.1'
+    envelope = PostfixProxyEnvelope()
+    envelope.mail_from = 'b@test.com'
+    envelope.rcpt_tos = list(rcpt_tos)
+    envelope.content = DATA
+    envelope.skip_scoring = True
+    return await handler.handle_DATA(None, session, envelope)
+
+
+@pytest.mark.asyncio
+async def test_lmtp_recipient_refused_for_now(relay_factory, caplog):
+    relay, _ = relay_factory('lmtp', {'c@test.com': 451, 'd@test.com': 550})
+    handler = PostfixProxyHandler(relay, 1.0, 2)
+
+    # Postfix must try again rather than the message being lost for c@test.com
+    assert await deliver_through_proxy(handler) == '451 reply for c@test.com'
+    assert 'Relay refused recipient d@test.com' in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_lmtp_recipient_refused_for_now_spooled(relay_factory, tmp_path):
+    relay, received = relay_factory('lmtp', {'c@test.com': 451, 'd@test.com': 550})
+    spool = Spool(str(tmp_path))
+    handler = PostfixProxyHandler(relay, 1.0, 2, spool=spool)
+
+    assert await deliver_through_proxy(handler) == OK_REPLY
+
+    assert len(spool) == 1
+    message, = spool._pending.values()
+    assert message.rcpt_tos == ['c@test.com']
+    data = await spool.load_data(message)
+
+    received.codes['c@test.com'] = 250
+    assert await spool.deliver_one(message, handler.redeliver)
+    assert len(spool) == 0
+    assert received.envelope.rcpt_tos == ['c@test.com']
+    assert received.envelope.original_content == data
+    spool.close()
+
+
+@pytest.fixture
+def tls_relay(run_simulator, self_signed_cert):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(*self_signed_cert)
+    simulator = run_simulator(RelaySimulator(tls_context=context))
+    return '127.0.0.1:%d' % simulator.port, simulator
+
+
+def test_pool_reuses_connections(run_simulator):
+    simulator = run_simulator(RelaySimulator())
+    pool = RelayPool(size=2)
+    handler = PostfixProxyHandler('127.0.0.1:%d' % simulator.port, 1.0, 2, relay_pool=pool)
+
+    for _ in range(5):
+        assert handler.send_to_relay('b@test.com', ['a@test.com'], DATA) == {}
+
+    assert len(simulator.messages) == 5
+    assert simulator.connections == 1
+    assert (pool.opened, pool.reused, len(pool)) == (1, 4, 1)
+    assert handler.status()['relay_connections_reused'] == 4
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_pool_retires_connections(run_simulator):
+    clock = FakeClock()
+    simulator = run_simulator(RelaySimulator())
+    relay = '127.0.0.1:%d' % simulator.port
+    pool = RelayPool(size=2, max_idle=60, max_messages=3, clock=clock)
+
+    for _ in range(3):
+        pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+    # the connection has had its share of messages
+    assert (pool.opened, len(pool)) == (1, 0)
+
+    pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+    clock.now += 61
+    pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+    assert pool.opened == 3
+    pool.close()
+
+
+def test_pool_replaces_broken_connection(run_simulator):
+    simulator = run_simulator(RelaySimulator())
+    relay = '127.0.0.1:%d' % simulator.port
+    pool = RelayPool(size=2)
+
+    pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+    pool._idle[0].client.close()
+    pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+
+    assert (pool.opened, pool.reused) == (2, 0)
+    assert len(simulator.messages) == 2
+    pool.close()
+
+
+def test_pool_resize(run_simulator, mocker):
+    simulator = run_simulator(RelaySimulator())
+    relay = '127.0.0.1:%d' % simulator.port
+    pool = RelayPool(size=2)
+
+    clients = [pool.connect(relay) for _ in range(2)]
+    for client in clients:
+        pool._checkin(relay, client, 0)
+    assert len(pool) == 2
+    quit = mocker.spy(clients[0], 'quit')
+
+    pool.resize(1)
+    assert len(pool) == 1
+    # the connection over the size is quit, in a thread of its own
+    for _ in range(100):
+        if clients[0].sock is None:
+            break
+        time.sleep(0.02)
+    assert quit.call_count == 1
+    assert clients[0].sock is None
+    pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+    assert pool.reused == 1
+    pool.close()
+
+
+def test_starttls(tls_relay, self_signed_cert):
+    relay, simulator = tls_relay
+    pool = RelayPool(size=2, tls_context=make_tls_context(cafile=self_signed_cert[0]))
+
+    for _ in range(3):
+        pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+
+    assert len(simulator.messages) == 3
+    assert simulator.connections == 1
+    client = pool._idle[0].client
+    assert isinstance(client.sock, ssl.SSLSocket)
+    assert client.has_extn('starttls') is False
+    pool.close()
+
+
+def test_tls_session_resumed(tls_relay, self_signed_cert):
+    relay, simulator = tls_relay
+    # no idle connections kept, so each message has a connection of its own
+    pool = RelayPool(size=0, tls_context=make_tls_context(cafile=self_signed_cert[0]))
+
+    for _ in range(3):
+        pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+
+    assert simulator.connections == 3
+    assert pool.tls_resumed == 2
+
+
+def test_starttls_verifies_relay(tls_relay):
+    relay, simulator = tls_relay
+    pool = RelayPool(tls_context=make_tls_context())
+
+    with pytest.raises(ssl.SSLCertVerificationError):
+        pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+    assert simulator.messages == []
+
+
+def test_starttls_unix_socket(self_signed_cert, tmp_path):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(*self_signed_cert)
+    path = str(tmp_path / 'relay.sock')
+    simulator = RelaySimulator(tls_context=context)
+    controller = ServerController(simulator, hostname='unix:%s' % path)
+    controller.start()
+    relay = 'unix:%s' % path
+
+    try:
+        # no host name to check the certificate against
+        pool = RelayPool(tls_context=make_tls_context(cafile=self_signed_cert[0]))
+        with pytest.raises(smtplib.SMTPException):
+            pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+
+        pool = RelayPool(tls_context=make_tls_context(cafile=self_signed_cert[0]), tls_name='localhost')
+        pool.send(relay, 'b@test.com', ['a@test.com'], DATA)
+        assert isinstance(pool._idle[0].client.sock, ssl.SSLSocket)
+        pool.close()
+    finally:
+        controller.stop()
+
+    assert len(simulator.messages) == 1
+
+
+def test_starttls_not_offered(run_simulator):
+    simulator = run_simulator(RelaySimulator())
+    pool = RelayPool(tls_context=make_tls_context(verify=False))
+
+    with pytest.raises(smtplib.SMTPNotSupportedError):
+        pool.send('127.0.0.1:%d' % simulator.port, 'b@test.com', ['a@test.com'], DATA)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('transport,codes,rcpt_codes', (
+    # refused at RCPT by an SMTP relay
+    ('smtp', {}, {'a@test.com': 450, 'c@test.com': 550}),
+    # refused after the data by an LMTP relay, the temporary refusal first
+    ('lmtp', {'a@test.com': 450, 'c@test.com': 550}, {}),
+))
+async def test_nothing_delivered_refused_for_now(relay_factory, tmp_path, transport, codes, rcpt_codes):
+    relay, _ = relay_factory(transport, codes, rcpt_codes)
+    rcpt_tos = ('a@test.com', 'c@test.com')
+
+    # the relay's own reply for the recipient, rather than an exception
+    handler = PostfixProxyHandler(relay, 1.0, 2)
+    assert (await deliver_through_proxy(handler, rcpt_tos)).startswith('450 ')
+
+    # only the recipient refused for now is spooled
+    spool = Spool(str(tmp_path))
+    handler = PostfixProxyHandler(relay, 1.0, 2, spool=spool)
+    assert await deliver_through_proxy(handler, rcpt_tos) == OK_REPLY
+    message, = spool._pending.values()
+    assert message.rcpt_tos == ['a@test.com']
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_nothing_delivered_refused_for_good(relay_factory):
+    relay, _ = relay_factory('smtp', rcpt_codes={'a@test.com': 550, 'c@test.com': 553})
+    handler = PostfixProxyHandler(relay, 1.0, 2)
+
+    assert await deliver_through_proxy(handler, ('a@test.com', 'c@test.com')) == '550 refused a@test.com'
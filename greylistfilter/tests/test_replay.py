@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from ..replay import header_block, mbox_spans, replay
+
+from .test_handler import header_tpl
+
+
+def make_message(spam_score, dcc_scores):
+    headers = header_tpl % {b'spam_score': spam_score, b'dcc_scores': dcc_scores}
+    return b'From: bob@test.com\n' + headers.lstrip(b'\n')
+
+
+MESSAGES = [
+    make_message(b'0.5', b'Body=1'),
+    make_message(b'1.5', b'Body=1'),
+    make_message(b'1.5', b'Body=5 Fuz1=many'),
+    make_message(b'3.0', b'Body=3'),
+]
+
+THRESHOLDS = [(1.0, 2), (1.0, 5), (2.0, 2), (0.0, 0)]
+EXPECTED = {(1.0, 2): 2, (1.0, 5): 1, (2.0, 2): 1, (0.0, 0): 4}
+
+
+@pytest.fixture
+def mbox(tmp_path):
+    path = tmp_path / 'mbox'
+    path.write_bytes(b''.join(b'From bob@test.com Thu Jan  1 00:00:00 2019\n' + msg + b'\n' for msg in MESSAGES))
+    return str(path)
+
+
+@pytest.fixture
+def maildir(tmp_path):
+    for subdir in ('cur', 'new', 'tmp'):
+        os.mkdir(str(tmp_path / subdir))
+    for i, msg in enumerate(MESSAGES):
+        (tmp_path / ('cur' if i % 2 else 'new') / ('%d.host' % i)).write_bytes(msg.replace(b'\n', b'\r\n'))
+    (tmp_path / 'cur' / 'empty.host').write_bytes(b'')
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('data,header', (
+    (b'A: 1\nB: 2\n\nbody\n\nmore', b'A: 1\nB: 2\n\n'),
+    (b'A: 1\r\nB: 2\r\n\r\nbody\r\n', b'A: 1\r\nB: 2\r\n\r\n'),
+    (b'A: 1\nB: 2\n', b'A: 1\nB: 2\n'),
+))
+def test_header_block(data, header):
+    assert header_block(data, 0, len(data)) == header
+
+
+def test_mbox_spans():
+    data = b'From a\nX: 1\n\nFrom here\n>From b\nFrom b\nX: 2\n\nbody\n'
+
+    spans = list(mbox_spans(data))
+
+    assert [data[start:end] for start, end in spans] == [
+        b'From a\nX: 1\n\n', b'From here\n>From b\n', b'From b\nX: 2\n\nbody\n']
+    assert list(mbox_spans(b'')) == []
+
+
+@pytest.mark.parametrize('processes', (0, 2))
+def test_replay_mbox(mbox, processes):
+    report = replay(mbox, THRESHOLDS, processes=processes, chunksize=3)
+
+    assert report['messages'] == len(MESSAGES)
+    assert report['greylisted'] == EXPECTED
+    assert report['header_bytes'] > 0
+
+
+def test_replay_maildir(maildir):
+    report = replay(maildir, THRESHOLDS, processes=0)
+
+    assert report['messages'] == len(MESSAGES)
+    assert report['greylisted'] == EXPECTED
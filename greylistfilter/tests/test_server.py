@@ -1,10 +1,19 @@
+import asyncio
+import socket
+
 import pytest
 
 from smtplib import SMTP
 from aiosmtplib import SMTP as aioSMTP, SMTPDataError
 
 
-from ..smtpproxy import XFORWARD_ARGS, OK_REPLY, ERROR_REPLY
+from ..ratelimit import GREYLIST, ClientRateLimit
+from ..simulators import Latency
+from ..spool import Spool
+from ..smtpproxy import (DATA_SIZE_LIMIT, ESMTP_EXTENSIONS, XFORWARD_ARGS,
+                         OK_REPLY, ERROR_REPLY, ForwardInfo, parse_xforward, pending_input)
+
+from .conftest import PG_RESPONSE_DUNNO
 
 
 def test_ehlo(pf_proxy_server):
@@ -26,25 +35,59 @@ async def test_xforward(simple_proxy_server):
     assert simple_proxy_server.responses[0] == ok
 
     fi = simple_proxy_server.session.fwd_info
-    assert len(fi) == 3
-    assert fi['NAME'] == 'spike.porcupine.org'
-    assert fi['ADDR'] == '168.100.189.2'
-    assert fi['PROTO'] == 'ESMTP'
+    assert fi.name == 'spike.porcupine.org'
+    assert fi.addr == '168.100.189.2'
+    assert fi.proto == 'ESMTP'
+    assert fi.helo is None
 
     await simple_proxy_server.smtp_XFORWARD('HELO=a.b.c')
 
     assert simple_proxy_server.responses[1] == ok
 
-    assert len(fi) == 4
-    assert fi['HELO'] == 'a.b.c'
+    assert fi.name == 'spike.porcupine.org'
+    assert fi.helo == 'a.b.c'
 
     await simple_proxy_server.smtp_XFORWARD('FOO=bar')
 
-    assert len(fi) == 4
-
     assert simple_proxy_server.responses[2] == b'501 Syntax error\r\n'
 
 
+@pytest.mark.parametrize('args,attrs', (
+    ('NAME=spike.porcupine.org ADDR=168.100.189.2 PROTO=ESMTP',
+     [('name', 'spike.porcupine.org'), ('addr', '168.100.189.2'), ('proto', 'ESMTP')]),
+    ('name=[UNAVAILABLE] addr=[TEMPUNAVAIL] port=25', [('name', None), ('addr', None), ('port', '25')]),
+    ('ADDR=IPV6:2001:db8::1', [('addr', '2001:db8::1')]),
+    ('IDENT=abc+3Ddef SOURCE=REMOTE', [('ident', 'abc=def'), ('source', 'REMOTE')]),
+    ('HELO=a+2Bb+20c', [('helo', 'a+b c')]),
+))
+def test_parse_xforward(args, attrs):
+    assert parse_xforward(args) == attrs
+
+
+@pytest.mark.parametrize('args', (
+    '', 'FOO=bar', 'NAME', 'NAME=a FOO=bar',
+))
+def test_parse_xforward_invalid(args):
+    with pytest.raises(ValueError):
+        parse_xforward(args)
+
+
+def test_forward_info():
+    fi = ForwardInfo()
+    assert all(getattr(fi, slot) is None for slot in ForwardInfo.__slots__)
+
+    fi.update([('name', 'a.b.c'), ('addr', '1.2.3.4')])
+    assert fi.name == 'a.b.c'
+    assert fi.addr == '1.2.3.4'
+
+    with pytest.raises(AttributeError):
+        fi.foo = 'bar'
+
+    fi.reset()
+    assert fi.name is None
+    assert fi.addr is None
+
+
 def test_no_greylist_server_still_relays(pf_proxy_server, data_bytes, mocker):
     server = pf_proxy_server()
 
@@ -185,3 +228,278 @@ def test_deferred_mail(pf_proxy_server, mail_relay, pg_server, data_bytes, event
     event_loop.run_until_complete(client.quit())
 
     assert mail_relay.content is None
+
+
+def test_ehlo_extensions(pf_proxy_server):
+    server = pf_proxy_server()
+
+    with SMTP(server.hostname, server.port) as client:
+        code, _ = client.ehlo()
+        assert code == 250
+        for extension in ESMTP_EXTENSIONS + ('8BITMIME', 'SIZE'):
+            assert client.has_extn(extension)
+        assert int(client.esmtp_features['size']) == DATA_SIZE_LIMIT
+
+
+def read_replies(sock, count):
+    """
+    Read `count` complete (possibly multi-line) replies, returning the
+    final line of each one
+    """
+    data = b''
+    replies = []
+    while len(replies) < count:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+        *lines, data = data.split(b'\r\n')
+        replies.extend(line.decode() for line in lines if line[3:4] != b'-')
+    return replies
+
+
+def test_pipelined_transaction(pf_proxy_server, mail_relay):
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port)
+    content = b'Subject: pipelined\r\n\r\nHello\r\n'
+
+    with socket.create_connection((server.hostname, server.port)) as sock:
+        assert read_replies(sock, 1)[0].startswith('220')
+
+        sock.sendall(b'EHLO client.local\r\n'
+                     b'XFORWARD NAME=spike.porcupine.org ADDR=168.100.189.2 PROTO=ESMTP\r\n'
+                     b'MAIL FROM:<bob@test.com> BODY=8BITMIME SIZE=%d\r\n'
+                     b'RCPT TO:<fred@test.com>\r\n'
+                     b'RCPT TO:<barney@test.com>\r\n'
+                     b'DATA\r\n' % len(content))
+
+        replies = read_replies(sock, 6)
+        assert replies[-1].startswith('354')
+        assert [r[:3] for r in replies[-5:-1]] == ['250'] * 4
+
+        sock.sendall(content + b'.\r\nQUIT\r\n')
+        replies = read_replies(sock, 2)
+        assert replies[0] == OK_REPLY
+        assert replies[1].startswith('221')
+
+    assert mail_relay.envelope.rcpt_tos == ['fred@test.com', 'barney@test.com']
+    assert mail_relay.content == content
+
+
+def test_bdat_transaction(pf_proxy_server, mail_relay):
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port)
+    first = b'Subject: chunked\r\n\r\n'
+    last = b'Hello\r\n'
+
+    with socket.create_connection((server.hostname, server.port)) as sock:
+        read_replies(sock, 1)
+        sock.sendall(b'EHLO client.local\r\n')
+        read_replies(sock, 1)
+
+        sock.sendall(b'MAIL FROM:<bob@test.com>\r\n'
+                     b'RCPT TO:<fred@test.com>\r\n'
+                     b'BDAT %d\r\n%s'
+                     b'BDAT %d LAST\r\n%s'
+                     b'DATA\r\n' % (len(first), first, len(last), last))
+
+        replies = read_replies(sock, 5)
+        assert replies[:2] == [OK_REPLY, OK_REPLY]
+        assert replies[2] == '250 %d octets received' % len(first)
+        assert replies[3] == OK_REPLY
+        # the transaction is finished, so there are no recipients any more
+        assert replies[4].startswith('503')
+
+    assert mail_relay.content == first + last
+
+
+@pytest.mark.parametrize('commands,expected', (
+    (b'BDAT 2\r\nxxDATA\r\n', ['250 2 octets received', '503 Error: DATA not permitted after BDAT']),
+    (b'BDAT two\r\n', ['501 Syntax: BDAT chunk-size [LAST]']),
+    (b'BDAT 2 FIRST\r\n', ['501 Syntax: BDAT chunk-size [LAST]']),
+    (b'BDAT %d LAST\r\n%s' % (DATA_SIZE_LIMIT + 1, b'x' * (DATA_SIZE_LIMIT + 1)), ['552 Error: Too much mail data']),
+))
+def test_bdat_errors(pf_proxy_server, commands, expected):
+    server = pf_proxy_server()
+
+    with socket.create_connection((server.hostname, server.port)) as sock:
+        read_replies(sock, 1)
+        sock.sendall(b'EHLO client.local\r\n')
+        read_replies(sock, 1)
+
+        sock.sendall(b'MAIL FROM:<bob@test.com>\r\nRCPT TO:<fred@test.com>\r\n' + commands)
+        replies = read_replies(sock, 2 + len(expected))
+
+    assert replies[2:] == expected
+
+
+def test_bdat_oversized_chunk_not_buffered(pf_proxy_server):
+    server = pf_proxy_server()
+
+    with socket.create_connection((server.hostname, server.port)) as sock:
+        read_replies(sock, 1)
+        sock.sendall(b'EHLO client.local\r\n')
+        read_replies(sock, 1)
+
+        # rejected as soon as announced, without waiting for the chunk
+        sock.sendall(b'MAIL FROM:<bob@test.com>\r\nRCPT TO:<fred@test.com>\r\n'
+                     b'BDAT 4000000000 LAST\r\n' + b'x' * 100000)
+        replies = read_replies(sock, 3)
+
+    assert replies[2] == '552 Error: Too much mail data'
+
+
+@pytest.mark.asyncio
+async def test_pending_input():
+    reader = asyncio.StreamReader()
+    assert pending_input(reader) == 0
+
+    reader.feed_data(b'NOOP\r\nQUIT\r\n')
+    assert pending_input(reader) == 12
+
+
+def test_xforward_per_transaction(pf_proxy_server, mail_relay):
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port)
+
+    with socket.create_connection((server.hostname, server.port)) as sock:
+        read_replies(sock, 1)
+        sock.sendall(b'EHLO client.local\r\n'
+                     b'XFORWARD NAME=spike.porcupine.org ADDR=168.100.189.2\r\n'
+                     b'XFORWARD PROTO=ESMTP HELO=spike.porcupine.org\r\n'
+                     b'MAIL FROM:<bob@test.com>\r\n'
+                     b'XFORWARD NAME=other.host\r\n'
+                     b'RSET\r\n'
+                     b'XFORWARD NAME=ok.host\r\n')
+        replies = read_replies(sock, 7)
+
+    assert [r[:3] for r in replies] == ['250', '250', '250', '250', '503', '250', '250']
+
+
+def open_transaction(client, mail_from='bob@test.com', rcpt_to='fred@test.com'):
+    code, _ = client.ehlo()
+    assert code == 250
+    code, _ = client.docmd('xforward', 'NAME=spike.porcupine.org ADDR=168.100.189.2 PROTO=ESMTP')
+    assert code == 250
+    code, _ = client.mail(mail_from)
+    assert code == 250
+    code, _ = client.rcpt(rcpt_to)
+    assert code == 250
+
+
+def test_early_lookup_deferred(pf_proxy_server, mail_relay, policy_server, data_bytes):
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port, pgport=policy_server.port, early_lookup=True)
+
+    with SMTP(server.hostname, server.port) as client:
+        open_transaction(client)
+        # the lookup has been made before any data was sent
+        assert policy_server.wait_for_requests(1)
+        assert policy_server.requests[0]['client_address'] == '168.100.189.2'
+        assert policy_server.requests[0]['recipient'] == 'fred@test.com'
+
+        code, _ = client.data(data_bytes)
+        assert code == 451
+
+    assert len(policy_server.requests) == 1
+    assert mail_relay.content is None
+
+
+def test_early_lookup_conditions_not_met(pf_proxy_server, mail_relay, policy_server, data_bytes):
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port, spam=5.0,
+                             pgport=policy_server.port, early_lookup=True)
+
+    with SMTP(server.hostname, server.port) as client:
+        open_transaction(client)
+        code, _ = client.data(data_bytes)
+        assert code == 250
+
+    assert mail_relay.content is not None
+
+
+def test_early_lookup_discarded_on_rset(pf_proxy_server, mail_relay, policy_server, data_bytes):
+    policy_server.latency = Latency('fixed', 0.5)
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port, pgport=policy_server.port, early_lookup=True)
+    lookups = []
+    check_greylist = server.handler.check_greylist
+
+    async def recording_check_greylist(session, envelope):
+        lookups.append(asyncio.current_task())
+        return await check_greylist(session, envelope)
+
+    server.handler.check_greylist = recording_check_greylist
+
+    with SMTP(server.hostname, server.port) as client:
+        open_transaction(client)
+        assert policy_server.wait_for_requests(1)
+        code, _ = client.rset()
+        assert code == 250
+        code, _ = client.noop()
+        assert code == 250
+        assert lookups[0].cancelled()
+
+        # the deferral on its way for the first transaction is not used for the next
+        policy_server.response = PG_RESPONSE_DUNNO
+        open_transaction(client, rcpt_to='barney@test.com')
+        code, _ = client.data(data_bytes)
+        assert code == 250
+
+    assert len(lookups) == 2
+    assert [request['recipient'] for request in policy_server.requests] == ['fred@test.com', 'barney@test.com']
+    assert mail_relay.content is not None
+
+
+def test_deferral_cached(pf_proxy_server, mail_relay, policy_server, data_bytes):
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port, pgport=policy_server.port, defer_ttl=60)
+
+    for _ in range(2):
+        with SMTP(server.hostname, server.port) as client:
+            open_transaction(client)
+            code, _ = client.data(data_bytes)
+            assert code == 451
+
+    assert len(policy_server.requests) == 1
+    assert server.handler.verdicts.hits == 1
+
+
+def test_rate_limit_tempfail(pf_proxy_server, mail_relay, data_bytes):
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port, spam=5.0, rate_limit=ClientRateLimit(1))
+
+    with SMTP(server.hostname, server.port) as client:
+        open_transaction(client)
+        code, _ = client.data(data_bytes)
+        assert code == 250
+
+        client.docmd('xforward', 'NAME=spike.porcupine.org ADDR=168.100.189.2 PROTO=ESMTP')
+        code, _ = client.mail('bob@test.com')
+        assert code == 450
+        code, _ = client.rcpt('fred@test.com')
+        assert code == 503
+
+    assert server.handler.rate_limit.limited == 1
+
+
+def test_rate_limit_greylist_skips_scoring(pf_proxy_server, mail_relay, policy_server, data_bytes):
+    server = pf_proxy_server('127.0.0.1:%d' % mail_relay.port, spam=5.0, pgport=policy_server.port,
+                             rate_limit=ClientRateLimit(0, GREYLIST))
+
+    with SMTP(server.hostname, server.port) as client:
+        open_transaction(client)
+        # the conditions are not met, but the client is greylisted anyway
+        code, _ = client.data(data_bytes)
+        assert code == 451
+
+    assert len(policy_server.requests) == 1
+    assert mail_relay.content is None
+
+
+def test_relay_failure_spooled(pf_proxy_server, unused_tcp_port, tmp_path, data_bytes):
+    spool = Spool(str(tmp_path))
+    # nothing listens on the relay port
+    server = pf_proxy_server('127.0.0.1:%d' % unused_tcp_port, spam=5.0, spool=spool)
+
+    with SMTP(server.hostname, server.port) as client:
+        open_transaction(client)
+        code, _ = client.data(data_bytes)
+        assert code == 250
+
+    assert len(spool) == 1
+    message = next(iter(spool._pending.values()))
+    assert message.rcpt_tos == ['fred@test.com']
+    assert spool.read_data(message).startswith(data_bytes.splitlines()[0])
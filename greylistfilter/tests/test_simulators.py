@@ -0,0 +1,146 @@
+import asyncio
+import random
+import smtplib
+
+import pytest
+
+from ..lanes import TrafficLanes
+from ..postgrey_client import PolicyError, greylist_status
+from ..simulators import ERROR, RESET, STALL, Latency, PostgreySimulator, RelaySimulator, Simulator
+from ..smtpproxy import OK_REPLY, PostfixProxyEnvelope, PostfixProxyHandler, PostfixProxySession
+
+from .conftest import FakeClock
+
+DATA = b'Subject: simulated\r\n\r\nHello\r\n'
+
+
+def lookup(simulator, recipient='a@test.com', timeout=2):
+    return asyncio.get_event_loop().run_until_complete(
+        greylist_status(recipient, 'b@test.com', '192.0.2.1', 'mail.example.com', port=simulator.port,
+                        timeout=timeout))
+
+
+@pytest.mark.parametrize('spec,expected', (
+    ('0.25', 'fixed:0.25'),
+    ('uniform:0.01,0.1', 'uniform:0.01,0.1'),
+    ('lognormal:0.02,0.8', 'lognormal:0.02,0.8'),
+    ('exponential:0.05', 'exponential:0.05'),
+))
+def test_parse_latency(spec, expected):
+    assert repr(Latency.parse(spec)) == expected
+
+
+@pytest.mark.parametrize('spec', ('gamma:1,2', 'uniform:1', 'fixed:x'))
+def test_parse_invalid_latency(spec):
+    with pytest.raises(ValueError):
+        Latency.parse(spec)
+
+
+def test_latency_samples():
+    rng = random.Random(1)
+
+    assert all(0.01 <= Latency('uniform', 0.01, 0.1).sample(rng) <= 0.1 for _ in range(100))
+    assert all(Latency('normal', 0.0, 1.0).sample(rng) >= 0 for _ in range(100))
+    samples = sorted(Latency('lognormal', 0.02, 0.5).sample(rng) for _ in range(1001))
+    assert samples[500] == pytest.approx(0.02, rel=0.2)
+
+
+def test_fault_rates():
+    simulator = Simulator(error_rate=0.1, reset_rate=0.2, stall_rate=0.3, seed=1)
+
+    for _ in range(10000):
+        simulator.fault()
+
+    assert simulator.stats[RESET] == pytest.approx(2000, rel=0.1)
+    assert simulator.stats[STALL] == pytest.approx(3000, rel=0.1)
+    assert simulator.stats[ERROR] == pytest.approx(1000, rel=0.1)
+
+
+def test_stateful_greylisting(run_simulator):
+    clock = FakeClock()
+    simulator = run_simulator(PostgreySimulator(delay=300, clock=clock))
+
+    assert lookup(simulator).startswith('action=DEFER_IF_PERMIT ')
+    clock.now += 100
+    assert lookup(simulator).startswith('action=DEFER_IF_PERMIT ')
+    assert lookup(simulator, 'c@test.com').startswith('action=DEFER_IF_PERMIT ')
+
+    clock.now += 200
+    assert lookup(simulator) == 'action=PREPEND X-Greylist: delayed 300 seconds by the Postgrey simulator'
+    assert lookup(simulator) == 'action=DUNNO'
+    assert lookup(simulator, 'c@test.com').startswith('action=DEFER_IF_PERMIT ')
+
+    assert len(simulator.requests) == 6
+    assert simulator.stats['action=DEFER_IF_PERMIT'] == 4
+
+
+def test_postgrey_faults(run_simulator):
+    simulator = run_simulator(PostgreySimulator(error_rate=1.0))
+    assert lookup(simulator) == simulator.error_reply
+
+    simulator.error_rate, simulator.reset_rate = 0.0, 1.0
+    with pytest.raises((PolicyError, ConnectionError)):
+        lookup(simulator)
+
+    simulator.reset_rate, simulator.stall_rate = 0.0, 1.0
+    with pytest.raises(asyncio.TimeoutError):
+        lookup(simulator, timeout=0.2)
+
+
+def test_postgrey_latency(run_simulator):
+    simulator = run_simulator(PostgreySimulator(latency=Latency('fixed', 0.3)))
+
+    with pytest.raises(asyncio.TimeoutError):
+        lookup(simulator, timeout=0.1)
+    assert lookup(simulator, timeout=1).startswith('action=DEFER_IF_PERMIT ')
+
+
+@pytest.mark.parametrize('lmtp', (False, True))
+def test_relay(run_simulator, lmtp):
+    simulator = run_simulator(RelaySimulator(lmtp=lmtp))
+    handler = PostfixProxyHandler('%s127.0.0.1:%d' % ('lmtp:' if lmtp else '', simulator.port), 1.0, 2)
+
+    assert handler.send_to_relay('b@test.com', ['a@test.com', 'c@test.com'], DATA) == {}
+    assert simulator.messages == [('b@test.com', ['a@test.com', 'c@test.com'], DATA)]
+
+
+def test_relay_faults(run_simulator):
+    simulator = run_simulator(RelaySimulator(error_rate=1.0))
+    handler = PostfixProxyHandler('127.0.0.1:%d' % simulator.port, 1.0, 2)
+
+    with pytest.raises(smtplib.SMTPDataError) as error:
+        handler.send_to_relay('b@test.com', ['a@test.com'], DATA)
+    assert error.value.smtp_code == 451
+
+    simulator.error_rate, simulator.reset_rate = 0.0, 1.0
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        handler.send_to_relay('b@test.com', ['a@test.com'], DATA)
+    assert simulator.messages == []
+
+
+@pytest.mark.asyncio
+async def test_proxy_fails_open_on_stalled_postgrey():
+    simulator = PostgreySimulator(stall_rate=1.0)
+    await simulator.start('127.0.0.1', 0)
+    handler = PostfixProxyHandler(None, 1.0, 2, pgport=simulator.port, pgtimeout=0.2,
+                                  lanes=TrafficLanes(candidate_concurrency=2))
+
+    async def candidate(n):
+        session = PostfixProxySession(asyncio.get_event_loop())
+        session.fwd_info.addr = '192.0.2.1'
+        envelope = PostfixProxyEnvelope()
+        envelope.mail_from = 'b@test.com'
+        envelope.rcpt_tos = ['a%d@test.com' % n]
+        envelope.content = DATA
+        envelope.skip_scoring = True
+        return await handler.handle_DATA(None, session, envelope)
+
+    # every lookup times out, two at a time
+    results = await asyncio.wait_for(asyncio.gather(*(candidate(n) for n in range(4))), 2)
+
+    assert results == [OK_REPLY] * 4
+    assert simulator.stats[STALL] == 4
+    assert handler.lanes.candidate.max_wait >= 0.15
+
+    await simulator.stop()
+    handler.lanes.close()
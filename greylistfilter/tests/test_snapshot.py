@@ -0,0 +1,125 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from .. import snapshot
+from ..cache import VerdictCache
+from ..snapshot import (HEADER, SnapshotError, decode_entries, encode_entries, load_snapshot,
+                        restore_state, save_snapshot, snapshot_periodically)
+
+from .conftest import PG_RESPONSE_DEFER
+
+ENTRIES = [
+    (('1.2.3.4', 'b@test.com', 'a@test.com'), PG_RESPONSE_DEFER + ' Greylisted', 30.0),
+    (('2001:db8::1', '', 'ü@test.com'), PG_RESPONSE_DEFER, 10.0),
+]
+
+
+def test_roundtrip(tmp_path):
+    path = str(tmp_path / 'state')
+
+    save_snapshot(path, ENTRIES)
+    entries = load_snapshot(path)
+
+    assert [e[:2] for e in entries] == [e[:2] for e in ENTRIES]
+    for (_, _, remaining), (_, _, expected) in zip(entries, ENTRIES):
+        assert expected - 1 < remaining <= expected
+
+
+def test_expired_entries_dropped():
+    data = encode_entries(ENTRIES, now=1000)
+
+    entries = decode_entries(data, now=1020)
+
+    assert len(entries) == 1
+    assert entries[0][0] == ENTRIES[0][0]
+    assert entries[0][2] == 10
+
+
+@pytest.mark.parametrize('corrupt', (
+    lambda d: b'XXXX' + d[4:],
+    lambda d: d[:4] + b'\x02\x00' + d[6:],
+    lambda d: d[:-1],
+    lambda d: d[:HEADER.size - 1],
+    lambda d: d[:-1] + bytes([d[-1] ^ 0xff]),
+))
+def test_corruption_detected(corrupt):
+    data = encode_entries(ENTRIES)
+
+    with pytest.raises(SnapshotError):
+        decode_entries(corrupt(data))
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / 'state'
+    path.write_bytes(b'')
+
+    with pytest.raises(SnapshotError):
+        load_snapshot(str(path))
+
+
+def test_restore_state(tmp_path):
+    path = str(tmp_path / 'state')
+    cache = VerdictCache(ttl=60)
+
+    assert restore_state(path, cache) == 0
+
+    (tmp_path / 'state').write_bytes(b'garbage')
+    assert restore_state(path, cache) == 0
+
+    save_snapshot(path, ENTRIES)
+    assert restore_state(path, cache) == 2
+    assert cache.get_cached(ENTRIES[0][0])[0] == ENTRIES[0][1]
+
+
+def test_restore_capped_to_ttl():
+    cache = VerdictCache(ttl=5)
+
+    cache.restore(ENTRIES)
+
+    assert all(remaining <= 5 for _, _, remaining in cache.export())
+
+
+@pytest.mark.asyncio
+async def test_snapshot_periodically(tmp_path):
+    path = str(tmp_path / 'state')
+    cache = VerdictCache(ttl=60)
+    cache.store(ENTRIES[0][0], ENTRIES[0][1])
+
+    task = asyncio.ensure_future(snapshot_periodically(path, cache, 0.01))
+    await asyncio.sleep(0.1)
+    task.cancel()
+
+    entries = load_snapshot(path)
+    assert len(entries) == 1
+    assert entries[0][:2] == ENTRIES[0][:2]
+
+
+@pytest.mark.asyncio
+async def test_snapshot_periodically_shutdown(tmp_path, monkeypatch):
+    path = str(tmp_path / 'state')
+    cache = VerdictCache(ttl=60)
+    cache.store(ENTRIES[0][0], ENTRIES[0][1])
+    writing = threading.Event()
+    release = threading.Event()
+
+    def slow_save(path, entries):
+        writing.set()
+        release.wait(5)
+        save_snapshot(path, entries)
+
+    monkeypatch.setattr(snapshot, 'save_snapshot', slow_save)
+    executor = ThreadPoolExecutor(1)
+    task = asyncio.ensure_future(snapshot_periodically(path, cache, 0.01, executor))
+    while not writing.is_set():
+        await asyncio.sleep(0.01)
+    task.cancel()
+
+    # cancelling leaves the write running, shutting down the executor waits for it
+    threading.Timer(0.05, release.set).start()
+    executor.shutdown()
+    assert load_snapshot(path)[0][:2] == ENTRIES[0][:2]
+    assert not os.path.exists(path + '.tmp')
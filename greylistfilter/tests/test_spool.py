@@ -0,0 +1,269 @@
+import asyncio
+import errno
+import os
+import smtplib
+import threading
+
+import pytest
+
+from ..spool import MESSAGE, Spool, SpoolError, decode_envelope, encode_message, read_records
+
+from .conftest import FakeClock
+
+DATA = b'Subject: spooled\r\n\r\nHello\r\n'
+
+
+def failed_messages(directory):
+    """
+    Return the envelope and data of the messages set aside in a spool
+    """
+    messages = []
+    failed = os.path.join(str(directory), 'failed')
+    for name in sorted(os.listdir(failed)):
+        (_, record_type, payload), = read_records(os.path.join(failed, name))
+        assert record_type == MESSAGE
+        mail_from, rcpt_tos, offset, _ = decode_envelope(payload)
+        messages.append((mail_from, rcpt_tos, payload[offset:]))
+    return messages
+
+
+class Relay:
+    """
+    Stands in for the relay, failing with the given exceptions in turn
+    """
+
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.delivered = []
+
+    async def __call__(self, mail_from, rcpt_tos, data):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.delivered.append((mail_from, rcpt_tos, data))
+
+
+def test_encode_message():
+    payload = encode_message('b@test.com', ['a@test.com', 'c@test.com'], DATA, 1500000000.5)
+    mail_from, rcpt_tos, offset, spooled_at = decode_envelope(payload)
+
+    assert mail_from == 'b@test.com'
+    assert rcpt_tos == ['a@test.com', 'c@test.com']
+    assert payload[offset:] == DATA
+    assert spooled_at == 1500000000.5
+
+
+@pytest.mark.asyncio
+async def test_append_and_recover(tmp_path):
+    spool = Spool(str(tmp_path))
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    await spool.append('', ['c@test.com'], DATA * 2)
+    assert len(spool) == 2
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    assert len(spool) == 2
+    relay = Relay()
+    for message in list(spool._pending.values()):
+        assert await spool.deliver_one(message, relay)
+    spool.close()
+
+    assert sorted(relay.delivered) == [('', ['c@test.com'], DATA * 2), ('b@test.com', ['a@test.com'], DATA)]
+
+    # nothing left to deliver, and the delivered segments are gone
+    spool = Spool(str(tmp_path))
+    assert len(spool) == 0
+    assert len(os.listdir(str(tmp_path))) == 1
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_appends_share_fsync(tmp_path, mocker):
+    spool = Spool(str(tmp_path), sync_delay=0.05)
+    fsync = mocker.patch('os.fsync')
+
+    await asyncio.gather(*(spool.append('b@test.com', ['a@test.com'], DATA) for _ in range(10)))
+
+    assert fsync.call_count == 1
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_disk_io_off_the_event_loop(tmp_path, mocker):
+    spool = Spool(str(tmp_path))
+    threads = []
+    fsync = os.fsync
+
+    def recording_fsync(fd):
+        threads.append(threading.current_thread())
+        fsync(fd)
+
+    mocker.patch('os.fsync', side_effect=recording_fsync)
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    message = next(iter(spool._pending.values()))
+    assert await spool.load_data(message) == DATA
+
+    assert threads
+    assert threading.current_thread() not in threads
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_short_writes_completed(tmp_path, mocker):
+    spool = Spool(str(tmp_path))
+    write = os.write
+    mocker.patch('os.write', side_effect=lambda fd, data: write(fd, data[:7]))
+
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    message, = spool._pending.values()
+    assert await spool.load_data(message) == DATA
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_write_truncated(tmp_path, mocker):
+    spool = Spool(str(tmp_path))
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    write = os.write
+    calls = []
+
+    def failing_write(fd, data):
+        # the disk fills up part way through the second record
+        calls.append(fd)
+        if len(calls) == 1:
+            return write(fd, data[:10])
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    mocker.patch('os.write', side_effect=failing_write)
+    with pytest.raises(SpoolError):
+        await spool.append('c@test.com', ['a@test.com'], DATA)
+    mocker.stopall()
+
+    await spool.append('d@test.com', ['a@test.com'], DATA)
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    assert sorted(m.mail_from for m in spool._pending.values()) == ['b@test.com', 'd@test.com']
+    for message in list(spool._pending.values()):
+        assert await spool.load_data(message) == DATA
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_torn_record_ignored(tmp_path):
+    spool = Spool(str(tmp_path))
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    await spool.append('d@test.com', ['a@test.com'], DATA)
+    path = spool._path(spool._segment)
+    spool.close()
+
+    with open(path, 'r+b') as output:
+        output.truncate(os.path.getsize(path) - 5)
+
+    assert [offset for offset, _, _ in read_records(path)] == [0]
+    spool = Spool(str(tmp_path))
+    assert [m.mail_from for m in spool._pending.values()] == ['b@test.com']
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_backoff_and_permanent_failure(tmp_path):
+    clock = FakeClock()
+    spool = Spool(str(tmp_path), retry_delay=10, max_retry_delay=25, clock=clock)
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    message = next(iter(spool._pending.values()))
+    relay = Relay(ConnectionRefusedError(), smtplib.SMTPResponseException(451, b'later'),
+                  ConnectionRefusedError(), smtplib.SMTPResponseException(550, b'no such user'))
+
+    for delay in (10, 20, 25):
+        assert not await spool.deliver_one(message, relay)
+        assert max(due for due, _ in spool._due) == clock.now + delay
+
+    assert not await spool.deliver_one(message, relay)
+    assert len(spool) == 0
+    assert spool.failed == 1
+    spool.close()
+
+    # the message has been accepted, so it is set aside rather than lost
+    assert failed_messages(tmp_path) == [('b@test.com', ['a@test.com'], DATA)]
+
+
+@pytest.mark.asyncio
+async def test_set_aside_after_max_age(tmp_path):
+    wall_clock = FakeClock()
+    spool = Spool(str(tmp_path), max_age=3600, wall_clock=wall_clock)
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    spool.close()
+
+    # the age holds across a restart
+    spool = Spool(str(tmp_path), max_age=3600, wall_clock=wall_clock)
+    message = next(iter(spool._pending.values()))
+    relay = Relay(*[ConnectionRefusedError()] * 2)
+
+    wall_clock.now += 3599
+    assert not await spool.deliver_one(message, relay)
+    assert len(spool) == 1
+
+    wall_clock.now += 1
+    assert not await spool.deliver_one(message, relay)
+    assert len(spool) == 0
+    assert spool.failed == 1
+    spool.close()
+
+    assert failed_messages(tmp_path) == [('b@test.com', ['a@test.com'], DATA)]
+
+
+@pytest.mark.asyncio
+async def test_kept_if_not_set_aside(tmp_path):
+    clock = FakeClock()
+    spool = Spool(str(tmp_path), clock=clock)
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    message = next(iter(spool._pending.values()))
+    # the failed directory can't be created
+    with open(os.path.join(str(tmp_path), 'failed'), 'w'):
+        pass
+
+    assert not await spool.deliver_one(message, Relay(smtplib.SMTPResponseException(550, b'no such user')))
+    assert len(spool) == 1
+    assert spool.failed == 0
+    assert max(due for due, _ in spool._due) > clock.now
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_worker_redelivers(tmp_path):
+    spool = Spool(str(tmp_path), retry_delay=0.05)
+    relay = Relay(ConnectionRefusedError())
+    worker = asyncio.ensure_future(spool.run(relay))
+
+    await spool.append('b@test.com', ['a@test.com'], DATA)
+    for _ in range(100):
+        if relay.delivered:
+            break
+        await asyncio.sleep(0.02)
+
+    worker.cancel()
+    await asyncio.gather(worker, return_exceptions=True)
+    spool.close()
+
+    assert relay.delivered == [('b@test.com', ['a@test.com'], DATA)]
+    assert spool.delivered == 1
+    assert len(spool) == 0
+
+
+@pytest.mark.asyncio
+async def test_segments_roll_over(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=1)
+    for n in range(3):
+        await spool.append('b%d@test.com' % n, ['a@test.com'], DATA)
+    assert spool._segment == 3
+
+    relay = Relay()
+    for message in sorted(spool._pending.values(), key=lambda m: m.position):
+        await spool.deliver_one(message, relay)
+
+    # only the current segment is left
+    assert os.listdir(str(tmp_path)) == [os.path.basename(spool._path(spool._segment))]
+    spool.close()
@@ -0,0 +1,137 @@
+import ipaddress
+import os
+
+import pytest
+
+from ..smtpproxy import WHITELISTED_REPLY, PostfixProxyHandler
+from ..whitelist import DomainIndex, PrefixTrie, Whitelist, parse_network
+
+from .conftest import FakeClock
+
+CLIENTS = """\
+# Postgrey style client whitelist
+example.com
+mail.example.org       # a single host
+/^smtp\\d+\\.example\\.net$/
+192.0.2.17
+198.51.100
+2001:db8:1::/48
+"""
+
+RECIPIENTS = """\
+postmaster@
+abuse@example.com
+example.org
+/^list-.*@example\\.net$/
+"""
+
+IPS = """\
+:127.0.0.2:Listed
+$TTL 3600
+203.0.113.0/24
+!203.0.113.128/25
+203.0.113.200
+192.0.2.100-110
+"""
+
+
+@pytest.fixture
+def whitelist_files(tmp_path):
+    paths = {}
+    for name, text in (('clients', CLIENTS), ('recipients', RECIPIENTS), ('ips', IPS)):
+        path = tmp_path / name
+        path.write_text(text)
+        paths[name] = str(path)
+    return paths
+
+
+@pytest.mark.parametrize('value,network', (
+    ('192.0.2.1', '192.0.2.1/32'),
+    ('192.0.2', '192.0.2.0/24'),
+    ('10.', '10.0.0.0/8'),
+    ('2001:db8::/32', '2001:db8::/32'),
+))
+def test_parse_network(value, network):
+    assert parse_network(value) == ipaddress.ip_network(network)
+
+
+def test_prefix_trie_longest_match():
+    trie = PrefixTrie()
+    trie.add(ipaddress.ip_network('10.0.0.0/8'), 'eight')
+    trie.add(ipaddress.ip_network('10.1.0.0/16'), 'sixteen')
+    trie.add(ipaddress.ip_network('10.1.2.3/32'), 'host')
+
+    assert trie.lookup(ipaddress.ip_address('10.9.9.9')) == 'eight'
+    assert trie.lookup(ipaddress.ip_address('10.1.9.9')) == 'sixteen'
+    assert trie.lookup(ipaddress.ip_address('10.1.2.3')) == 'host'
+    assert trie.lookup(ipaddress.ip_address('11.0.0.1')) is None
+    assert trie.lookup(ipaddress.ip_address('::1')) is None
+    assert len(trie) == 3
+
+
+def test_domain_index():
+    index = DomainIndex()
+    index.add('example.com')
+
+    assert index.matches('example.com')
+    assert index.matches('MX1.Example.COM.')
+    assert not index.matches('badexample.com')
+    assert not index.matches('com')
+
+
+@pytest.mark.parametrize('client_ip,client_name,recipient,expected', (
+    ('192.0.2.1', 'mx.example.com', 'fred@test.com', True),
+    ('192.0.2.1', 'mail.example.org', 'fred@test.com', True),
+    ('192.0.2.1', 'other.example.org', 'fred@test.com', False),
+    ('192.0.2.1', 'smtp12.example.net', 'fred@test.com', True),
+    ('192.0.2.17', 'unknown', 'fred@test.com', True),
+    ('198.51.100.99', 'unknown', 'fred@test.com', True),
+    ('2001:db8:1:2::5', 'unknown', 'fred@test.com', True),
+    ('192.0.2.1', 'unknown', 'postmaster@test.com', True),
+    ('192.0.2.1', 'unknown', 'abuse@example.com', True),
+    ('192.0.2.1', 'unknown', 'abuse@test.com', False),
+    ('192.0.2.1', 'unknown', 'fred@lists.example.org', True),
+    ('192.0.2.1', 'unknown', 'list-users@example.net', True),
+    ('203.0.113.5', 'unknown', 'fred@test.com', True),
+    ('203.0.113.130', 'unknown', 'fred@test.com', False),
+    ('203.0.113.200', 'unknown', 'fred@test.com', True),
+    ('192.0.2.105', 'unknown', 'fred@test.com', True),
+    ('192.0.2.111', 'unknown', 'fred@test.com', False),
+    ('not an address', 'unknown', 'fred@test.com', False),
+))
+def test_whitelist_matches(whitelist_files, client_ip, client_name, recipient, expected):
+    whitelist = Whitelist([whitelist_files['clients']], [whitelist_files['recipients']], [whitelist_files['ips']])
+
+    assert whitelist.matches(client_ip, client_name, recipient) == expected
+
+
+def test_changed_file_reloaded(whitelist_files):
+    clock = FakeClock()
+    whitelist = Whitelist([whitelist_files['clients']], check_interval=10, clock=clock)
+    stamp = os.stat(whitelist_files['clients']).st_mtime_ns
+
+    with open(whitelist_files['clients'], 'a') as output:
+        output.write('example.info\n')
+    os.utime(whitelist_files['clients'], ns=(stamp + 10**9, stamp + 10**9))
+
+    assert not whitelist.matches('192.0.2.1', 'mx.example.info', 'fred@test.com')
+    clock.now += 10
+    assert whitelist.matches('192.0.2.1', 'mx.example.info', 'fred@test.com')
+
+    # a file which has gone keeps its entries
+    os.unlink(whitelist_files['clients'])
+    clock.now += 10
+    assert whitelist.matches('192.0.2.1', 'mx.example.info', 'fred@test.com')
+
+
+@pytest.mark.asyncio
+async def test_whitelisted_never_looked_up(whitelist_files, unused_tcp_port):
+    # nothing listens on the Postgrey port, a lookup would fail
+    handler = PostfixProxyHandler(None, 1.0, 2, pgport=unused_tcp_port,
+                                  whitelist=Whitelist([whitelist_files['clients']]))
+
+    reply = await handler.lookup_triplet('fred@test.com', 'b@test.com', '192.0.2.17', 'unknown')
+
+    assert reply == WHITELISTED_REPLY
+    assert handler.whitelist.hits == 1
+    assert handler.verdicts.misses == 0
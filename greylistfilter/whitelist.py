@@ -0,0 +1,282 @@
+"""
+Local whitelists, so that whitelisted mail is never looked up in Postgrey.
+
+Three kinds of file are understood:
+
+clients      Postgrey's whitelist_clients: client host names, matching
+             their subdomains too, IP addresses, partial addresses such as
+             `192.0.2` or networks in CIDR notation, and /regexps/
+recipients   Postgrey's whitelist_recipients: domains, matching their
+             subdomains too, full addresses, local parts such as
+             `postmaster@`, and /regexps/
+ips          rbldnsd ip4set/ip6trie style lists: addresses, partial
+             addresses, networks, ranges `a-b` and exclusions `!network`
+
+Addresses are looked up by longest prefix in a binary trie, names label
+by label in a trie of reversed domains. Each file is checked for changes
+every `check_interval` seconds, and only the files which changed are
+read again.
+"""
+import ipaddress
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger('SpamFilterProxy')
+
+CLIENTS = 'clients'
+RECIPIENTS = 'recipients'
+IPS = 'ips'
+
+# Marks the end of a domain in a DomainIndex, can't be a label
+TERMINAL = ''
+
+RE_PARTIAL_IPV4 = re.compile(r'^\d{1,3}(\.\d{1,3}){0,2}\.?$')
+
+
+class PrefixTrie:
+    """
+    Binary trie of IPv4 and IPv6 networks, each with a value. Lookups
+    return the value of the longest matching network.
+    """
+
+    def __init__(self):
+        # node: [zero child, one child, value]
+        self._roots = {4: [None, None, None], 6: [None, None, None]}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, network, value=True):
+        node = self._roots[network.version]
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+
+        for shift in range(width - 1, width - 1 - network.prefixlen, -1):
+            bit = (bits >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+
+        if node[2] is None:
+            self._count += 1
+        node[2] = value
+
+    def lookup(self, address):
+        node = self._roots[address.version]
+        bits = int(address)
+        found = node[2]
+
+        for shift in range(address.max_prefixlen - 1, -1, -1):
+            node = node[(bits >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+
+        return found
+
+
+class DomainIndex:
+    """
+    Trie of domains by reversed labels, matching the domains and their
+    subdomains
+    """
+
+    def __init__(self):
+        self._root = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, domain):
+        node = self._root
+        for label in reversed(domain.lower().strip('.').split('.')):
+            node = node.setdefault(label, {})
+        if TERMINAL not in node:
+            self._count += 1
+            node[TERMINAL] = True
+
+    def matches(self, name):
+        node = self._root
+        for label in reversed(name.lower().rstrip('.').split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+            if TERMINAL in node:
+                return True
+        return False
+
+
+def parse_network(value):
+    """
+    Parse an address, a network or a partial IPv4 address such as 192.0.2
+    """
+    if RE_PARTIAL_IPV4.match(value):
+        octets = value.rstrip('.').split('.')
+        value = '%s/%d' % ('.'.join(octets + ['0'] * (4 - len(octets))), 8 * len(octets))
+    return ipaddress.ip_network(value, strict=False)
+
+
+def parse_range(value):
+    first, _, last = value.partition('-')
+    first = ipaddress.ip_address(first)
+    if '.' in last or ':' in last:
+        last = ipaddress.ip_address(last)
+    else:
+        # rbldnsd allows the last octet alone, as in 192.0.2.1-20
+        last = ipaddress.ip_address(int(first) - int(first) % 256 + int(last))
+    return ipaddress.summarize_address_range(first, last)
+
+
+def entries(lines):
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if line:
+            yield line
+
+
+def compile_regexp(entry):
+    return re.compile(entry[1:-1], re.IGNORECASE)
+
+
+class WhitelistFile:
+    """
+    The index of one whitelist file of the given kind
+    """
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.stamp = None
+        self.networks = PrefixTrie()
+        self.domains = DomainIndex()
+        self.addresses = set()
+        self.local_parts = set()
+        self.regexps = []
+
+    def changed(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino) != self.stamp
+
+    def load(self):
+        stat = os.stat(self.path)
+        with open(self.path, encoding='utf8', errors='replace') as input:
+            lines = list(entries(input))
+
+        fresh = WhitelistFile(self.path, self.kind)
+        for entry in lines:
+            try:
+                getattr(fresh, 'add_%s' % self.kind)(entry)
+            except ValueError as ex:
+                logger.warning('%s: ignoring invalid entry %r: %s', self.path, entry, ex)
+
+        # swap the whole index at once
+        self.networks, self.domains, self.addresses, self.local_parts, self.regexps = (
+            fresh.networks, fresh.domains, fresh.addresses, fresh.local_parts, fresh.regexps)
+        self.stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def add_clients(self, entry):
+        if entry.startswith('/') and entry.endswith('/') and len(entry) > 1:
+            self.regexps.append(compile_regexp(entry))
+            return
+        try:
+            self.networks.add(parse_network(entry))
+        except ValueError:
+            self.domains.add(entry)
+
+    def add_recipients(self, entry):
+        if entry.startswith('/') and entry.endswith('/') and len(entry) > 1:
+            self.regexps.append(compile_regexp(entry))
+        elif entry.endswith('@'):
+            self.local_parts.add(entry[:-1].lower())
+        elif '@' in entry:
+            self.addresses.add(entry.lower())
+        else:
+            self.domains.add(entry)
+
+    def add_ips(self, entry):
+        if entry[0] in ':$':
+            # default value and directive lines
+            return
+
+        value = True
+        if entry[0] == '!':
+            value, entry = False, entry[1:]
+
+        entry = entry.split()[0]
+        networks = parse_range(entry) if '-' in entry else [parse_network(entry)]
+        for network in networks:
+            self.networks.add(network, value)
+
+    def matches_client(self, address, client_name):
+        if address is not None and self.networks.lookup(address):
+            return True
+        if client_name and client_name != 'unknown':
+            if self.domains.matches(client_name):
+                return True
+            return any(regexp.search(client_name) for regexp in self.regexps)
+        return False
+
+    def matches_recipient(self, recipient):
+        recipient = recipient.lower()
+        local_part, _, domain = recipient.rpartition('@')
+        return (recipient in self.addresses or local_part in self.local_parts or
+                bool(domain) and self.domains.matches(domain) or
+                any(regexp.search(recipient) for regexp in self.regexps))
+
+
+class Whitelist:
+    """
+    The whitelist files taken together
+    """
+
+    def __init__(self, clients=(), recipients=(), ips=(), check_interval=10, clock=time.monotonic):
+        self.files = ([WhitelistFile(path, CLIENTS) for path in clients] +
+                      [WhitelistFile(path, RECIPIENTS) for path in recipients] +
+                      [WhitelistFile(path, IPS) for path in ips])
+        self.check_interval = check_interval
+        self.clock = clock
+        self.hits = 0
+
+        for whitelist in self.files:
+            whitelist.load()
+        self._next_check = clock() + check_interval
+
+    def refresh(self):
+        """
+        Read again the files which have changed. A file which can't be read
+        keeps its previous entries.
+        """
+        for whitelist in self.files:
+            try:
+                if whitelist.changed():
+                    whitelist.load()
+                    logger.info('Reloaded whitelist %s', whitelist.path)
+            except OSError as ex:
+                logger.error('Could not reload whitelist %s: %s', whitelist.path, ex)
+
+    def matches(self, client_ip, client_name, recipient):
+        now = self.clock()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self.refresh()
+
+        try:
+            address = ipaddress.ip_address(client_ip) if client_ip else None
+        except ValueError:
+            address = None
+
+        for whitelist in self.files:
+            if whitelist.kind == RECIPIENTS:
+                matched = whitelist.matches_recipient(recipient)
+            else:
+                matched = whitelist.matches_client(address, client_name)
+            if matched:
+                self.hits += 1
+                return True
+
+        return False